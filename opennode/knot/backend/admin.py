@@ -31,7 +31,6 @@ from opennode.oms.security.principals import Group
 from opennode.oms.security.permissions import Role
 from opennode.oms.zodb import db
 
-from opennode.knot.model.compute import IVirtualCompute
 from opennode.knot.backend.compute import ShutdownComputeAction
 
 
@@ -46,14 +45,7 @@ class StopAllVmsCmd(Cmd):
 
     @db.ro_transact
     def get_computes(self, args):
-        computes = db.get_root()['oms_root']['computes']
-        user_vms = []
-        for c in map(follow_symlinks, computes.listcontent()):
-            if not IVirtualCompute.providedBy(c):
-                continue
-            if c.__owner__ == args.u:
-                user_vms.append(c)
-        return user_vms
+        return db.get_root()['oms_root']['computes'].search(owner=args.u, virtual=True)
 
     @require_admins_only
     @defer.inlineCallbacks
@@ -69,6 +61,25 @@ class StopAllVmsCmd(Cmd):
         log.msg('Stopping done. %s VMs of "%s" stopped' % (len(computes), args.u), system='stopallvms')
 
 
+class ReindexCmd(Cmd):
+    """Rebuilds the indexes maintained by model events, e.g. after changes made with events suppressed"""
+    implements(ICmdArgumentsSyntax)
+    command('reindex')
+
+    def arguments(self):
+        return VirtualConsoleArgumentParser()
+
+    @require_admins_only
+    @db.transact
+    def execute(self, args):
+        oms_root = db.get_root()['oms_root']
+        self.write("Indexed %s computes\n" % oms_root['computes'].reindex())
+        self.write("Indexed %s templates\n" % oms_root['templates'].reindex())
+        computes = map(follow_symlinks, oms_root['computes'].listcontent())
+        self.write("Reserved %s OpenVZ CTIDs\n" % oms_root['computes'].ctids.reseed(computes))
+        self.write("Cataloged %s computes\n" % oms_root['computes'].build_catalog())
+
+
 class ExportMetadataCmd(Cmd, SetAclMixin):
     implements(ICmdArgumentsSyntax)
     command('importexport')
@@ -76,8 +87,8 @@ class ExportMetadataCmd(Cmd, SetAclMixin):
     serialize_action_map = {'json': json.dumps, 'yaml': yaml.dump}
     deserialize_action_map = {'json': json.loads, 'yaml': yaml.load}
 
-    traverse_paths = (('/machines/', True), ('/ippools/', False), ('/templates/', False),
-                      ('/home/', False))
+    traverse_paths = (('/machines/', True), ('/ippools/', False), ('/ip6pools/', False),
+                      ('/templates/', False), ('/home/', False))
 
     type_blacklist = ('IncomingMachines',
                       'ByNameContainer',
@@ -27,13 +27,13 @@ from opennode.knot.backend.operation import ISuspendVM
 from opennode.knot.backend.operation import IUndeployVM
 from opennode.knot.backend.operation import OperationRemoteError
 from opennode.knot.backend.v12ncontainer import IVirtualizationContainerSubmitter
+from opennode.knot.model.catalog import compute_ipv6
 from opennode.knot.model.common import IPreDeployHook
 from opennode.knot.model.common import IPostUndeployHook
 from opennode.knot.model.compute import IAllocating
 from opennode.knot.model.compute import ICompute, Compute, IVirtualCompute
 from opennode.knot.model.compute import IUndeployed, IDeployed, IDeploying
 from opennode.knot.model.compute import IManageable
-from opennode.knot.model.template import ITemplate
 from opennode.knot.model.user import IUserStatisticsProvider
 from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
 from opennode.knot.utils import mac_addr_kvm_generator
@@ -309,6 +309,7 @@ class VComputeAction(ComputeAction):
             alsoProvides(self.context, self.inprogress_marker)
         if self.state is not None:
             self.context.state = self.state
+        db.get_root()['oms_root']['computes'].index(self.context)
 
     @defer.inlineCallbacks
     def _execute(self, cmd, args):
@@ -380,7 +381,12 @@ class AllocateAction(ComputeAction):
 
         @db.ro_transact
         def get_matching_machines(container):
-            all_machines = db.get_root()['oms_root']['machines']
+            machines = db.get_root()['oms_root']['machines']
+            candidates = [m for m in db.get_root()['oms_root']['computes'].search(virtual=False,
+                                                                                  backend=container,
+                                                                                  state=u'active')
+                          if m.__parent__ is machines]
+            global_templates = db.get_root()['oms_root']['templates']
             param = unicode(get_config().getstring('allocate', 'diskspace_filter_param',
                                                    default=u'/storage'))
 
@@ -405,10 +411,7 @@ class AllocateAction(ComputeAction):
                 else:
                     log.msg('\'Total # of cores\' filtering is disabled.', system='action-allocate')
 
-                templates = m['vms-%s' % container]['templates']
-                yield self.context.template in map(lambda t: t.name,
-                                                   filter(lambda t: ITemplate.providedBy(t),
-                                                          templates.listcontent() if templates else []))
+                yield self.context.template in global_templates.names_on(m, container)
 
             def unwind_until_false(generator):
                 fail_description = ['Not a compute',
@@ -429,10 +432,10 @@ class AllocateAction(ComputeAction):
                     log.err(system='action-allocate')
                     return 'Fail (exception)' % (fail_description, e)
 
-            results = map(lambda m: (str(m), unwind_until_false(condition_generator(m))), all_machines)
+            results = map(lambda m: (str(m), unwind_until_false(condition_generator(m))), candidates)
             log.msg('Searching in: %s' % (results), logLevel=DEBUG, system='action-allocate')
 
-            return filter(lambda m: all(condition_generator(m)), all_machines)
+            return filter(lambda m: all(condition_generator(m)), candidates)
 
         try:
             log.msg('Allocating %s: searching for targets...' % self.context, system='action-allocate')
@@ -489,10 +492,9 @@ def mv_compute_model(context_path, target_path):
         log.msg('Model NOT moved: already moved by sync?', system='deploy')
 
 
-@db.ro_transact(proxy=False)
-def get_current_ctid():
-    ctidlist = db.get_root()['oms_root']['computes']['openvz']
-    return max([follow_symlinks(symlink).ctid for symlink in ctidlist.listcontent()] + [100])
+@db.transact
+def reserve_ctid(compute):
+    return db.get_root()['oms_root']['computes'].ctids.reserve(compute.__name__)
 
 
 class DeployAction(VComputeAction):
@@ -526,6 +528,18 @@ class DeployAction(VComputeAction):
             else:
                 raise Exception('Could not allocate IP for the new compute: pools exhausted or undefined')
 
+        @db.transact
+        def allocate_ipv6_address(hw_address):
+            """Returns the IPv6 address of the compute, allocating one if it has none and IPv6 pools are
+            defined"""
+            if compute_ipv6(self.context) is not None:
+                return self.context.ipv6_address
+            ip6pools = db.get_root()['oms_root']['ip6pools']
+            ip = ip6pools.allocate(hw_address)
+            if ip is not None:
+                self._action_log(cmd, 'Allocated IPv6: %s for %s' % (ip, self.context), system='deploy')
+                return u'%s/%s' % (ip, ip6pools.find_pool(ip).prefixlen)
+
         @db.transact
         def cleanup_root_password():
             if getattr(self.context, 'root_password', None) is not None:
@@ -540,11 +554,16 @@ class DeployAction(VComputeAction):
             log.msg("Updating cpulimit to %s" % cpu_limit, system='deploy')
             self.context.cpu_limit = cpu_limit
 
+        @db.transact
+        def set_deploying():
+            alsoProvides(self.context, IDeploying)
+            db.get_root()['oms_root']['computes'].index(self.context)
+
         target = (args if IVirtualizationContainer.providedBy(args)
                   else (yield db.get(self.context, '__parent__')))
 
         try:
-            yield db.transact(alsoProvides)(self.context, IDeploying)
+            yield set_deploying()
 
             vm_parameters = yield self.get_parameters()
 
@@ -553,6 +572,10 @@ class DeployAction(VComputeAction):
                 ipaddr = yield allocate_ip_address()
                 vm_parameters.update({'ip_address': str(ipaddr)})
 
+            ip6addr = yield allocate_ipv6_address(vm_parameters['mac_address'])
+            if ip6addr is not None:
+                vm_parameters.update({'ipv6_address': ip6addr.split('/')[0]})
+
             utils = getAllUtilitiesRegisteredFor(IPreDeployHook)
             for util in utils:
                 yield defer.maybeDeferred(util.execute, self.context, cmd, vm_parameters)
@@ -603,6 +626,8 @@ class DeployAction(VComputeAction):
                 new_compute.__owner__ = owner_obj
                 new_compute.template = unicode(template)
                 new_compute._ipv4_address = unicode(ipaddr)
+                if ip6addr is not None:
+                    new_compute.ipv6_address = unicode(ip6addr)
                 new_compute.mac_address = getattr(c, 'mac_address', None)
                 new_compute.memory = getattr(c, 'memory', 0)
                 new_compute.diskspace = getattr(c, 'diskspace', {u'total': 0})
@@ -616,6 +641,7 @@ class DeployAction(VComputeAction):
 
                 container = c.__parent__
                 del container[name]
+                db.get_root()['oms_root']['computes'].index(new_compute)
 
                 timestamp = int(time.time() * 1000)
                 IStream(new_compute).add((timestamp, {'event': 'change',
@@ -642,6 +668,7 @@ class DeployAction(VComputeAction):
             @db.transact
             def cleanup_deploying():
                 noLongerProvides(self.context, IDeploying)
+                db.get_root()['oms_root']['computes'].index(self.context)
 
             yield cleanup_deploying()
             raise e
@@ -727,15 +754,11 @@ class PreDeployHookOpenVZ(GlobalUtility):
         cmd = args[0]
         vm_parameters = args[1]
 
-        ctid = yield get_current_ctid()
+        ctid = yield reserve_ctid(context)
 
-        if ctid is not None:
-            log.msg('Deploying %s to %s: hinting CTID (%s)' % (context, context.__parent__, ctid),
-                    system='deploy-hook-openvz')
-            vm_parameters.update({'ctid': ctid + 1})
-        else:
-            self._action_log(cmd, 'Information about current global CTID is unavailable yet, '
-                             'will let it use HN-local value instead', system='deploy-hook-openvz')
+        log.msg('Deploying %s to %s: hinting CTID (%s)' % (context, context.__parent__, ctid),
+                system='deploy-hook-openvz')
+        vm_parameters.update({'ctid': ctid})
 
 
 class UndeployAction(VComputeAction):
@@ -767,10 +790,17 @@ class UndeployAction(VComputeAction):
                                   subject=self.context, owner=self.context.__owner__)
                 ulog.log('Deallocated IP: %s', ip)
                 log.msg('Deallocated IP %s' % ip, system='ippool')
+            ipv6 = compute_ipv6(self.context)
+            if ipv6 is not None and db.get_root()['oms_root']['ip6pools'].free(ipv6):
+                log.msg('Deallocated IP %s' % ipv6, system='ippool')
             vm = traverse1(canonical_path(self.context))
             if vm is not None:
                 noLongerProvides(vm, IDeployed)
                 alsoProvides(vm, IUndeployed)
+                db.get_root()['oms_root']['computes'].index(vm)
+            ctid = db.get_root()['oms_root']['computes'].ctids.release(self.context.__name__)
+            if ctid is not None:
+                log.msg('Released CTID %s' % ctid, system='undeploy-action')
 
         yield finalize_vm()
 
@@ -15,6 +15,7 @@ from opennode.knot.backend.compute import DeployAction, UndeployAction, DestroyC
 from opennode.knot.backend.operation import IUpdateVM
 from opennode.knot.backend.operation import ISetOwner
 from opennode.knot.backend.v12ncontainer import IVirtualizationContainerSubmitter
+from opennode.knot.model.catalog import compute_ipv6
 from opennode.knot.model.compute import ICompute, IVirtualCompute
 from opennode.knot.model.compute import IDeployed
 from opennode.knot.model.hangar import IHangar
@@ -100,6 +101,9 @@ def delete_virtual_compute(model, event):
         ip = netaddr.IPAddress(model.ipv4_address.split('/')[0])
         if ippools.free(ip):
             ulog.log('Deallocated IP: %s', ip)
+        ipv6 = compute_ipv6(model)
+        if ipv6 is not None and db.get_root()['oms_root']['ip6pools'].free(ipv6):
+            ulog.log('Deallocated IP: %s', ipv6)
 
     yield deallocate_ip()
 
@@ -0,0 +1,204 @@
+"""Unified liveness tracking of the computes.
+
+Heartbeats come from successful ICMP pings, agent pings, syncs and Salt calls. Their timing differs
+widely, e.g. Salt calls are made every metrics interval while agent pings are sent every sync interval, so
+every source has its own phi accrual failure detector. A compute is as healthy as its healthiest source,
+and its health is published to the `health`, `suspicious` and `failure` attributes of the compute (only when
+it changes). The heartbeat sources keep probing computes that are down, so that they are found up again
+as soon as they respond.
+
+"""
+from grokcore.component import GlobalUtility, implements, subscribe
+from twisted.internet import defer
+from twisted.python import log
+from zope.component import getUtility, provideSubscriptionAdapter
+from zope.interface import Interface
+
+import threading
+import time
+
+from opennode.knot.model.compute import ICompute, IVirtualCompute
+from opennode.knot.utils.failuredetector import PhiAccrualDetector, UNKNOWN, SUSPECT, DOWN, best, worst
+from opennode.oms.config import get_config
+from opennode.oms.model.model.events import IModelDeletedEvent
+from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
+from opennode.oms.model.model.symlink import follow_symlinks
+from opennode.oms.util import subscription_factory, async_sleep
+from opennode.oms.zodb import db
+
+
+class IFailureDetector(Interface):
+
+    def heartbeat(key, source):
+        """Records a sign of life of the compute named `key` from `source` (e.g. 'icmp', 'salt')"""
+
+    def expect(key, source):
+        """Records that a heartbeat of the compute named `key` was solicited from `source` (e.g. a ping was
+        dispatched), so that a compute never heard of is found down after the bootstrap timeout"""
+
+    def set_condition(key, name, state):
+        """Sets a sticky health state `name` (e.g. an agent version mismatch) of the compute, which worsens
+        its health until it is cleared by setting it to None"""
+
+    def health(key):
+        """Returns the health state of the compute: 'unknown', 'up', 'suspect' or 'down'"""
+
+
+class FailureDetector(GlobalUtility):
+    implements(IFailureDetector)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> {source: detector}
+        self._detectors = {}
+        self._last_seen = {}
+        self._conditions = {}
+
+    def _config(self):
+        config = get_config()
+        return dict((option, config.getfloat('failure-detector', option, default))
+                    for option, default in (('suspect_threshold', 3.0), ('down_threshold', 8.0),
+                                            ('window_size', 100), ('min_std', 1.0),
+                                            ('acceptable_pause', 0.0),
+                                            ('first_interval', config.getint('sync', 'interval')),
+                                            ('bootstrap_timeout', 3 * config.getint('sync', 'interval'))))
+
+    def _detector(self, key, source):
+        detectors = self._detectors.setdefault(key, {})
+        detector = detectors.get(source)
+        if detector is None:
+            config = self._config()
+            detector = detectors[source] = PhiAccrualDetector(int(config['window_size']),
+                                                              config['min_std'],
+                                                              config['acceptable_pause'],
+                                                              config['first_interval'])
+        return detector
+
+    def expect(self, key, source, now=None):
+        now = now if now is not None else time.time()
+        with self._lock:
+            self._detector(key, source).expect(now)
+
+    def heartbeat(self, key, source, now=None):
+        now = now if now is not None else time.time()
+        with self._lock:
+            self._detector(key, source).heartbeat(now)
+            self._last_seen.setdefault(key, {})[source] = now
+
+    def set_condition(self, key, name, state):
+        with self._lock:
+            if state is None:
+                self._conditions.get(key, {}).pop(name, None)
+            else:
+                self._conditions.setdefault(key, {})[name] = state
+
+    def phi(self, key, now=None):
+        """Returns the suspicion level of the compute by heartbeat source"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            return dict((source, detector.phi(now))
+                        for source, detector in self._detectors.get(key, {}).iteritems())
+
+    def last_seen(self, key):
+        with self._lock:
+            return dict(self._last_seen.get(key, {}))
+
+    def health(self, key, now=None):
+        now = now if now is not None else time.time()
+        config = self._config()
+        with self._lock:
+            states = [detector.health(now, config['suspect_threshold'], config['down_threshold'],
+                                      config['bootstrap_timeout'])
+                      for detector in self._detectors.get(key, {}).itervalues()]
+            conditions = self._conditions.get(key, {}).values()
+        # a single source answering is enough to tell the compute is alive
+        return worst(best(UNKNOWN, *states), *conditions)
+
+    def forget(self, key):
+        with self._lock:
+            for registry in (self._detectors, self._last_seen, self._conditions):
+                registry.pop(key, None)
+
+
+def heartbeat(key, source):
+    getUtility(IFailureDetector).heartbeat(key, source)
+
+
+def expect(key, source):
+    getUtility(IFailureDetector).expect(key, source)
+
+
+@subscribe(ICompute, IModelDeletedEvent)
+def forget_compute(model, event):
+    getUtility(IFailureDetector).forget(model.__name__)
+
+
+class FailureDetectorDaemonProcess(DaemonProcess):
+    """Publishes the health state of the computes when it changes"""
+    implements(IProcess)
+
+    __name__ = "failure-detector"
+
+    def __init__(self):
+        super(FailureDetectorDaemonProcess, self).__init__()
+        self.interval = get_config().getint('failure-detector', 'interval', 5)
+
+    @defer.inlineCallbacks
+    def run(self):
+        while True:
+            try:
+                if not self.paused:
+                    yield self.publish()
+            except Exception:
+                if get_config().getboolean('debug', 'print_exceptions'):
+                    log.err(system='failure-detector')
+
+            yield async_sleep(self.interval)
+
+    @db.ro_transact
+    def get_computes(self):
+        res = []
+        for compute in map(follow_symlinks, db.get_root()['oms_root']['computes'].listcontent()):
+            if not ICompute.providedBy(compute):
+                continue
+            host = None
+            if IVirtualCompute.providedBy(compute) and compute.__parent__ is not None:
+                host = compute.__parent__.__parent__
+            res.append((compute.__name__, host.__name__ if ICompute.providedBy(host) else None,
+                        compute.health))
+        return res
+
+    @db.transact
+    def set_health(self, changes):
+        computes = db.get_root()['oms_root']['computes']
+        for key, health in changes.iteritems():
+            compute = follow_symlinks(computes[key])
+            if compute is None:
+                continue
+            compute.health = unicode(health)
+            compute.suspicious = health in (SUSPECT, DOWN)
+            compute.failure = health == DOWN
+
+    @defer.inlineCallbacks
+    def publish(self):
+        detector = getUtility(IFailureDetector)
+        now = time.time()
+        computes = yield self.get_computes()
+
+        states = dict((key, detector.health(key, now)) for key, host, published in computes)
+
+        changes = {}
+        for key, host, published in computes:
+            state = states[key]
+            # VMs are unreachable when their host is down
+            if host is not None and states.get(host) == DOWN:
+                state = DOWN
+            if state != UNKNOWN and state != published:
+                changes[key] = state
+
+        if changes:
+            log.msg('Health changes: %s' % changes, system='failure-detector')
+            yield self.set_health(changes)
+
+
+provideSubscriptionAdapter(subscription_factory(FailureDetectorDaemonProcess), adapts=(Proc,))
@@ -1,17 +1,27 @@
 import logging
 import datetime
+import threading
 import time
 
-from grokcore.component import Adapter, context
+from grokcore.component import Adapter, context, subscribe
 from twisted.internet import defer
 from twisted.python import log
 from zope.component import provideSubscriptionAdapter, queryAdapter
 from zope.interface import implements, Interface
 
+from opennode.knot.backend.metricsink import active_sinks
 from opennode.knot.backend.operation import IGetGuestMetrics, IGetHostMetrics, OperationRemoteError
 from opennode.knot.backend.v12ncontainer import IVirtualizationContainerSubmitter
-from opennode.knot.model.compute import IManageable, ICompute, IVirtualCompute
+from opennode.knot.model.compute import IManageable, ICompute, IVirtualCompute, ComputeTags
+from opennode.knot.model.rollup import fleet_rollups
+from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
+from opennode.knot.utils.timeseries import DeltaEncoder, change_points
 from opennode.oms.config import get_config
+from opennode.oms.model.model.events import IModelCreatedEvent
+from opennode.oms.model.model.events import IModelDeletedEvent
+from opennode.oms.model.model.events import IModelModifiedEvent
+from opennode.oms.model.model.events import IModelMovedEvent
+from opennode.oms.model.model.events import IOwnerChangedEvent
 from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
 from opennode.oms.model.model.symlink import follow_symlinks
 from opennode.oms.model.model.stream import IStream
@@ -32,6 +42,7 @@ class MetricsDaemonProcess(DaemonProcess):
     def __init__(self):
         super(MetricsDaemonProcess, self).__init__()
         self.interval = get_config().getint('metrics', 'interval')
+        self.rollup_max_missed = get_config().getint('metrics', 'rollup_max_missed', 3)
         self.outstanding_requests = {}
 
     @defer.inlineCallbacks
@@ -43,6 +54,7 @@ class MetricsDaemonProcess(DaemonProcess):
                 # and maintain the gatherers via add/remove events.
                 if not self.paused:
                     yield self.gather_machines()
+                    self.expire_rollups()
             except Exception:
                 self.log_err()
 
@@ -54,12 +66,19 @@ class MetricsDaemonProcess(DaemonProcess):
     def log_err(self, msg=None, **kwargs):
         log.err(msg, system='metrics', **kwargs)
 
+    def expire_rollups(self):
+        # VMs which sent no sample for a few intervals, e.g. the VMs of a failed host, leave the rollups
+        timestamp = int(time.time() * 1000)
+        for rollup in fleet_rollups.expire(timestamp - self.rollup_max_missed * self.interval * 1000):
+            IStream(rollup).add((timestamp, rollup.data_point()))
+
     @defer.inlineCallbacks
     def gather_machines(self):
         @db.ro_transact
         def get_gatherers():
             oms_root = db.get_root()['oms_root']
-            computes = filter(lambda c: c and ICompute.providedBy(c) and not c.failure,
+            # failed computes are gathered as well, their salt calls are heartbeats of the failure detector
+            computes = filter(lambda c: c and ICompute.providedBy(c),
                          map(follow_symlinks, oms_root['computes'].listcontent()))
             gatherers = filter(None, (queryAdapter(c, IMetricsGatherer) for c in computes))
             return gatherers
@@ -107,6 +126,253 @@ class MetricsDaemonProcess(DaemonProcess):
 provideSubscriptionAdapter(subscription_factory(MetricsDaemonProcess), adapts=(Proc,))
 
 
+class ChangeOnlyStream(object):
+    """Stream wrapper storing a data point only when the metric value changes.
+
+    Range queries return the stored change points, starting with the one holding the value at the beginning
+    of the range.
+
+    """
+    implements(IStream)
+
+    def __init__(self, stream, encoder):
+        self.stream = stream
+        self.encoder = encoder
+
+    def add(self, item):
+        timestamp, value = item
+        if self.encoder.accept(timestamp, value):
+            return self.stream.add(item)
+
+    def events(self, after, limit=None):
+        # heartbeats guarantee that the value valid at `after` was stored at most max_gap ms before
+        lookback = after - self.encoder.max_gap if self.encoder.max_gap is not None else 0
+        stored = sorted(self.stream.events(max(0, lookback)), key=lambda e: e[0])
+        return change_points(stored, after=after, limit=limit)
+
+
+def encoding_params(metric):
+    """Returns the (epsilon, max gap in ms) of the change-only encoding of a metric, configured in the
+    `metrics-encoding` section as `<metric> = <epsilon>[, <max gap in seconds>]`, or None if the metric is
+    stored as is."""
+    config = get_config()
+    if not config.has_section('metrics-encoding') or not config.has_option('metrics-encoding', metric):
+        return None
+
+    params = [p.strip() for p in config.get('metrics-encoding', metric).split(',')]
+    epsilon = float(params[0])
+    max_gap = float(params[1]) if len(params) > 1 and params[1] else 300.0
+    return epsilon, int(max_gap * 1000)
+
+
+class EncoderRegistry(object):
+    """Delta encoders of the change-only metric streams by (compute __name__, metric).
+
+    Shared by all the writers of a stream. A new encoder starts from the last point stored in its stream, so
+    that the encoding carries on after the stream cache is invalidated or OMS is restarted.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._encoders = {}
+
+    def get(self, key, stream, epsilon, max_gap):
+        with self._lock:
+            encoder = self._encoders.get(key)
+            if encoder is None or (encoder.epsilon, encoder.max_gap) != (epsilon, max_gap):
+                encoder = self._encoders[key] = DeltaEncoder(epsilon, max_gap)
+                stored = stream.events(max(0, int(time.time() * 1000) - max_gap))
+                if stored:
+                    encoder.last = max(stored, key=lambda e: e[0])
+                    encoder.last_seen = encoder.last[0]
+            return encoder
+
+    def forget(self, uuid):
+        with self._lock:
+            for key in [key for key in self._encoders if key[0] == uuid]:
+                del self._encoders[key]
+
+    def clear(self):
+        with self._lock:
+            self._encoders.clear()
+
+
+encoders = EncoderRegistry()
+
+
+def encoded_stream(key, metric):
+    """Returns the stream of the metric `metric` of the compute named `key`, wrapped in a `ChangeOnlyStream`
+    if change-only encoding is configured for the metric."""
+    stream = IStream(metric)
+    params = encoding_params(metric.__name__)
+    if params is None:
+        return stream
+
+    epsilon, max_gap = params
+    return ChangeOnlyStream(stream, encoders.get((key, metric.__name__), stream, epsilon, max_gap))
+
+
+class MetricStreamCache(object):
+    """Per-compute cache of the ZODB oids of the metrics.
+
+    Maps (uuid, metric key) to the oid of the metric object, so that steady-state metrics ticks load the
+    metrics by oid instead of traversing the ZODB. Only oids are cached: persistent objects belong to the
+    connection they were loaded by, so they are loaded again in the transaction of every tick (see `load`).
+    Entries are filled lazily by the gatherers and invalidated by model events. A `None` oid is cached for
+    metrics that have no stream in the model.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = {}
+        # uuid of a VM -> keys of the computes whose entries reference it
+        self._owners = {}
+        # uuid of a VM -> (kind, group) pairs of the rollups the VM is accounted in
+        self._groups = {}
+
+    def _entry(self, key):
+        return self._entries.setdefault(key, {'vms': None, 'streams': {}})
+
+    def get_vms(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry['vms'] if entry else None
+
+    def set_vms(self, key, oid, uuids):
+        with self._lock:
+            self._entry(key)['vms'] = oid
+            for uuid in uuids:
+                self._owners.setdefault(uuid, set()).add(key)
+
+    def lookup(self, key, wanted):
+        """Returns a tuple of (found, missing), where found is a list of (uuid, metric, oid) and
+        missing is a list of (uuid, metric) pairs that are not cached yet."""
+        found, missing = [], []
+        with self._lock:
+            streams = self._entry(key)['streams']
+            for pair in wanted:
+                if pair in streams:
+                    if streams[pair] is not None:
+                        found.append(pair + (streams[pair],))
+                else:
+                    missing.append(pair)
+        return found, missing
+
+    def update(self, key, oids):
+        with self._lock:
+            cached = self._entry(key)['streams']
+            for (uuid, k), oid in oids.iteritems():
+                cached[(uuid, k)] = oid
+                self._owners.setdefault(uuid, set()).add(key)
+
+    def get_groups(self, uuid):
+        with self._lock:
+            return self._groups.get(uuid)
+
+    def set_groups(self, groups):
+        with self._lock:
+            self._groups.update(groups)
+            for uuid, member_groups in groups.iteritems():
+                fleet_rollups.regroup(uuid, member_groups)
+
+    def invalidate_groups(self, *uuids):
+        """Forgets the rollup groups of the VMs, which are looked up again on the next gather. The VMs stay
+        in their current rollups until then."""
+        with self._lock:
+            for uuid in uuids:
+                self._groups.pop(uuid, None)
+
+    def invalidate(self, *uuids):
+        with self._lock:
+            for uuid in uuids:
+                for key in self._owners.pop(uuid, ()):
+                    self._entries.pop(key, None)
+                self._entries.pop(uuid, None)
+            self.invalidate_groups(*uuids)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+            self._groups.clear()
+
+
+stream_cache = MetricStreamCache()
+
+
+def load(oid):
+    """Returns the object stored under `oid` as seen by the current transaction, or None if it is gone"""
+    try:
+        return db.get_root()._p_jar.get(oid)
+    except KeyError:
+        return None
+
+
+def load_streams(found):
+    """Returns the (uuid, metric, stream) of the cached (uuid, metric, oid) which still exist"""
+    metrics = ((uuid, k, load(oid)) for uuid, k, oid in found)
+    return [(uuid, k, encoded_stream(uuid, metric)) for uuid, k, metric in metrics if metric is not None]
+
+
+def _invalidate_stream_cache(model):
+    uuids = [model.__name__]
+    parent = model.__parent__
+    if parent is not None and ICompute.providedBy(parent.__parent__):
+        uuids.append(parent.__parent__.__name__)
+    stream_cache.invalidate(*uuids)
+
+
+@subscribe(ICompute, IModelCreatedEvent)
+def invalidate_stream_cache_on_create(model, event):
+    _invalidate_stream_cache(model)
+
+
+@subscribe(ICompute, IModelDeletedEvent)
+def invalidate_stream_cache_on_delete(model, event):
+    _invalidate_stream_cache(model)
+    encoders.forget(model.__name__)
+    fleet_rollups.remove_member(model.__name__)
+
+
+@subscribe(ICompute, IModelMovedEvent)
+def invalidate_stream_cache_on_move(model, event):
+    _invalidate_stream_cache(model)
+
+
+@subscribe(IVirtualCompute, IModelModifiedEvent)
+def invalidate_rollup_groups_on_modify(model, event):
+    # env tags follow the IP address; owner and container changes have their own events
+    modified = event.modified or {}
+    if 'ipv4_address' in modified:
+        stream_cache.invalidate_groups(model.__name__)
+    # a stopped VM leaves its rollups at once, it joins them again when it reports metrics
+    if modified.get('state', u'active') != u'active':
+        fleet_rollups.remove_member(model.__name__)
+
+
+@subscribe(IVirtualCompute, IOwnerChangedEvent)
+def invalidate_rollup_groups_on_owner_change(model, event):
+    stream_cache.invalidate_groups(model.__name__)
+
+
+def rollup_groups(vm):
+    """Returns the (kind, group) pairs of the fleet rollups a VM is accounted in."""
+    groups = []
+    vms = vm.__parent__
+    if IVirtualizationContainer.providedBy(vms) and ICompute.providedBy(vms.__parent__):
+        groups.append(('by-container', '%s:%s' % (vms.__parent__.hostname, vms.__name__)))
+
+    if vm.__owner__:
+        groups.append(('by-owner', vm.__owner__))
+
+    for tag in ComputeTags(vm).auto_tags():
+        if tag.startswith(u'env:'):
+            groups.append(('by-env', tag[len(u'env:'):]))
+    return groups
+
+
 class VirtualComputeMetricGatherer(Adapter):
     """Gathers VM metrics using IVirtualizationContainerSubmitter"""
 
@@ -124,21 +390,31 @@ class VirtualComputeMetricGatherer(Adapter):
 
     @defer.inlineCallbacks
     def gather_vms(self):
+        key = self.context.__name__
 
-        @db.ro_transact
-        def get_vms_if_not_empty():
-            vms = follow_symlinks(self.context['vms']) or []
+        def get_vms():
+            oid = stream_cache.get_vms(key)
+            vms = load(oid) if oid is not None else None
+            if vms is not None:
+                return vms
 
-            for vm in vms:
-                if IVirtualCompute.providedBy(vm):
-                    return vms
+            vms = follow_symlinks(self.context['vms']) or []
+            uuids = [vm.__name__ for vm in vms if IVirtualCompute.providedBy(vm)]
+            if uuids:
+                stream_cache.set_vms(key, vms._p_oid, uuids)
+                return vms
 
-            log.msg('%s: no VMs' % (self.context.hostname), system='metrics', logLevel=logging.DEBUG)
+        @db.ro_transact
+        def get_vms_if_not_empty():
+            vms = get_vms()
+            if vms is None:
+                log.msg('%s: no VMs' % (self.context.hostname), system='metrics', logLevel=logging.DEBUG)
+            return vms
 
         vms = yield get_vms_if_not_empty()
 
         # get the metrics for all running VMS
-        if not vms or self.context.state != u'active':
+        if not vms or (yield db.get(self.context, 'state')) != u'active':
             return
 
         name = yield db.get(self.context, 'hostname')
@@ -165,21 +441,66 @@ class VirtualComputeMetricGatherer(Adapter):
         log.msg('%s: VM metrics received: %s' % (name, len(metrics)), system='metrics')
         timestamp = int(time.time() * 1000)
 
-        # db transact is needed only to traverse the zodb.
+        found, missing = stream_cache.lookup(key, [(uuid, k) for uuid, data in metrics.items()
+                                                   for k in data])
+        ungrouped = [uuid for uuid in metrics if stream_cache.get_groups(uuid) is None]
+
+        # the cached metrics are loaded by oid, the zodb is traversed only for the data not cached yet.
         @db.ro_transact
         def get_streams():
-            streams = []
-            for uuid, data in metrics.items():
-                if vms[uuid] and vms[uuid]['metrics']:
-                    vm_metrics = vms[uuid]['metrics']
-                    for k in data:
-                        if vm_metrics[k]:
-                            streams.append((IStream(vm_metrics[k]), (timestamp, data[k])))
-            return streams
+            if not fleet_rollups.attached:
+                fleet_rollups.attach(db.get_root()['oms_root']['rollups'])
+
+            streams = load_streams(found)
+            vms = get_vms() if missing or ungrouped else None
+
+            resolved = {}
+            for uuid, k in missing:
+                vm_metrics = vms[uuid]['metrics'] if vms and vms[uuid] else None
+                metric = vm_metrics[k] if vm_metrics else None
+                resolved[(uuid, k)] = metric._p_oid if metric else None
+                if metric:
+                    streams.append((uuid, k, encoded_stream(uuid, metric)))
+
+            groups = {}
+            for uuid in ungrouped:
+                vm = follow_symlinks(vms[uuid]) if vms else None
+                groups[uuid] = rollup_groups(vm) if IVirtualCompute.providedBy(vm) else []
+            return streams, resolved, groups
+
+        streams, resolved, groups = yield get_streams()
+        stream_cache.update(key, resolved)
+        stream_cache.set_groups(groups)
 
         # streams could defer the data appending but we don't care
-        for stream, data_point in (yield get_streams()):
-            stream.add(data_point)
+        for uuid, k, stream in streams:
+            stream.add((timestamp, metrics[uuid][k]))
+
+        self.update_rollups(metrics, timestamp)
+        self.forward(metrics, timestamp)
+
+    def forward(self, metrics, timestamp):
+        """Queues the samples of all series in `metrics` to the enabled external metrics sinks"""
+        for sink in active_sinks():
+            for series, data in metrics.iteritems():
+                for k, value in data.iteritems():
+                    sink.add(series, k, timestamp, value)
+
+    def update_rollups(self, metrics, timestamp):
+        updated = set()
+        for uuid, data in metrics.iteritems():
+            if data.get('state', u'active') != u'active':
+                updated.update(fleet_rollups.remove_member(uuid))
+                continue
+            groups = stream_cache.get_groups(uuid)
+            if not groups:
+                continue
+            for k, value in data.iteritems():
+                if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                    updated.update(fleet_rollups.update(uuid, groups, k, float(value), timestamp))
+
+        for rollup in updated:
+            IStream(rollup).add((timestamp, rollup.data_point()))
 
     @defer.inlineCallbacks
     def gather_phy(self):
@@ -191,19 +512,29 @@ class VirtualComputeMetricGatherer(Adapter):
                     logLevel=logging.DEBUG)
             timestamp = int(time.time() * 1000)
 
-            # db transact is needed only to traverse the zodb.
+            key = self.context.__name__
+            found, missing = stream_cache.lookup(key, [(key, k) for k in data])
+
+            # the cached metrics are loaded by oid, the zodb is traversed only for the ones not cached yet.
             @db.ro_transact
             def get_streams():
-                streams = []
-                host_metrics = self.context['metrics']
-                if host_metrics:
-                    for k in data:
-                        if host_metrics[k]:
-                            streams.append((IStream(host_metrics[k]), (timestamp, data[k])))
-                return streams
-
-            for stream, data_point in (yield get_streams()):
-                stream.add(data_point)
+                streams = load_streams(found)
+                host_metrics = self.context['metrics'] if missing else None
+                resolved = {}
+                for uuid, k in missing:
+                    metric = host_metrics[k] if host_metrics else None
+                    resolved[(uuid, k)] = metric._p_oid if metric else None
+                    if metric:
+                        streams.append((uuid, k, encoded_stream(uuid, metric)))
+                return streams, resolved
+
+            streams, resolved = yield get_streams()
+            stream_cache.update(key, resolved)
+
+            for uuid, k, stream in streams:
+                stream.add((timestamp, data[k]))
+
+            self.forward({key: data}, timestamp)
         except OperationRemoteError as e:
             log.msg('%s: remote error: %s' % (name, e), system='metrics', logLevel=logging.WARNING)
         except Exception:
@@ -0,0 +1,332 @@
+"""Batched forwarding of metrics to external time-series databases."""
+from grokcore.component import GlobalUtility, baseclass, implements, name
+from twisted.internet import defer, threads
+from twisted.python import log
+from zope.component import getAllUtilitiesRegisteredFor, provideSubscriptionAdapter
+from zope.interface import Interface
+
+import httplib
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from opennode.oms.config import get_config
+from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
+from opennode.oms.util import subscription_factory, async_sleep
+
+
+class IMetricsSink(Interface):
+
+    def add(series, metric, timestamp, value):
+        """Queues a data point of `metric` of `series` (e.g. a compute uuid) for forwarding"""
+
+    def flush():
+        """Forwards the queued data points. Returns a deferred"""
+
+
+def flatten_value(value):
+    """Returns a list of (field, float) pairs for a metric value. Tuples and lists are flattened to
+    numbered fields and dicts to one field per key. Non-numeric values are skipped."""
+    if isinstance(value, dict):
+        return [(unicode(k), float(v)) for k, v in sorted(value.items())
+                if isinstance(v, (int, long, float)) and not isinstance(v, bool)]
+    if isinstance(value, (tuple, list)):
+        return [(unicode(i), float(v)) for i, v in enumerate(value)
+                if isinstance(v, (int, long, float)) and not isinstance(v, bool)]
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return [(None, float(value))]
+    return []
+
+
+def _graphite_escape(part):
+    return unicode(part).replace(u' ', u'_').replace(u'/', u'_').replace(u'.', u'_')
+
+
+def format_graphite(prefix, series, metric, timestamp, value):
+    """Returns Graphite plaintext protocol lines; `timestamp` is in ms"""
+    base = u'.'.join(filter(None, [prefix, _graphite_escape(series), _graphite_escape(metric)]))
+    return [u'%s %r %d\n' % (base + (u'.' + _graphite_escape(field) if field is not None else u''),
+                             v, timestamp // 1000)
+            for field, v in flatten_value(value)]
+
+
+def _influx_escape(part):
+    return unicode(part).replace(u',', u'\\,').replace(u' ', u'\\ ').replace(u'=', u'\\=')
+
+
+def format_influxdb(prefix, series, metric, timestamp, value):
+    """Returns an InfluxDB line protocol line with ms precision timestamp"""
+    fields = flatten_value(value)
+    if not fields:
+        return []
+    measurement = _influx_escape(u'%s_%s' % (prefix, metric) if prefix else metric)
+    return [u'%s,series=%s %s %d\n' % (measurement, _influx_escape(series),
+                                       u','.join(u'%s=%r' % (_influx_escape(field or u'value'), v)
+                                                 for field, v in fields),
+                                       timestamp)]
+
+
+class MetricsSpool(object):
+    """Bounded on-disk spool of batches that could not be forwarded.
+
+    Every batch is stored as a separate segment file. When the total size exceeds `max_bytes` the oldest
+    segments are dropped.
+
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def _segments(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith('.spool'))
+
+    def put(self, data):
+        # batches are spilled from the reactor thread and spooled from the flush thread
+        with self._lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self._seq += 1
+            segment = os.path.join(self.path, '%016d-%06d.spool' % (int(time.time() * 1000),
+                                                                   self._seq % 1000000))
+            with open(segment, 'wb') as f:
+                f.write(data)
+            self.trim()
+
+    def trim(self):
+        segments = self._segments()
+        sizes = [os.path.getsize(s) for s in segments]
+        total = sum(sizes)
+        for segment, size in zip(segments, sizes):
+            if total <= self.max_bytes:
+                break
+            log.msg('Metrics spool is full, dropping %s' % segment, system='metrics-sink')
+            try:
+                os.unlink(segment)
+            except OSError:
+                pass
+            total -= size
+
+    def replay(self, send):
+        """Sends the spooled segments oldest-first, removing each one after it has been sent"""
+        for segment in self._segments():
+            try:
+                with open(segment, 'rb') as f:
+                    data = f.read()
+            except (IOError, OSError):
+                # trimmed meanwhile by a put from another thread
+                continue
+            send(data)
+            os.unlink(segment)
+
+
+class MetricsSink(GlobalUtility):
+    """Base class of the metrics sinks: queues data points and forwards them in batches.
+
+    Batches are sent from a worker thread over a connection that is kept open between flushes, at most one
+    flush is scheduled at a time. Batches that cannot be sent are spooled to disk and resent before any newer
+    data. While the sink is down, or when a flush cannot keep up, the queued data points are spilled to the
+    spool instead of growing the queue.
+
+    """
+    implements(IMetricsSink)
+    baseclass()
+
+    sink_type = None
+
+    def __init__(self, host=None, port=None, prefix=None, flush_size=None, spool=None):
+        self._host = host
+        self._port = port
+        self._prefix = prefix
+        self._flush_size = flush_size
+        self._spool = spool
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_pending = False
+        self._down = False
+        self._connection = None
+
+    def _config(self, option, default):
+        return get_config().getstring('metrics-sink', option, default)
+
+    @property
+    def enabled(self):
+        return self._config('type', 'off') == self.sink_type
+
+    @property
+    def host(self):
+        return self._host or self._config('host', 'localhost')
+
+    @property
+    def port(self):
+        return int(self._port or self._config('port', self.default_port))
+
+    @property
+    def prefix(self):
+        return self._prefix if self._prefix is not None else self._config('prefix', 'oms')
+
+    @property
+    def flush_size(self):
+        return self._flush_size or int(self._config('flush_size', 500))
+
+    @property
+    def spool(self):
+        if self._spool is None:
+            self._spool = MetricsSpool(self._config('spool_path',
+                                                    os.path.join(tempfile.gettempdir(), 'oms-metrics-spool')),
+                                       int(self._config('spool_max_bytes', 10 * 1024 * 1024)))
+        return self._spool
+
+    def format(self, series, metric, timestamp, value):
+        raise NotImplementedError()
+
+    @property
+    def max_buffer(self):
+        return self.flush_size * 10
+
+    def add(self, series, metric, timestamp, value):
+        lines = self.format(series, metric, timestamp, value)
+        with self._buffer_lock:
+            self._buffer.extend(lines)
+            full = len(self._buffer) >= self.flush_size
+            spill = full and (self._down or len(self._buffer) >= self.max_buffer)
+            if spill:
+                batch, self._buffer = self._buffer, []
+        if spill:
+            self.spool.put(u''.join(batch).encode('utf-8'))
+        elif full:
+            self.flush()
+
+    def flush(self):
+        """Schedules a flush in a worker thread, unless one is already pending. Returns a deferred"""
+        with self._buffer_lock:
+            if self._flush_pending:
+                return defer.succeed(None)
+            self._flush_pending = True
+
+        def flush_scheduled():
+            try:
+                self.flush_now()
+            finally:
+                with self._buffer_lock:
+                    self._flush_pending = False
+
+        d = threads.deferToThread(flush_scheduled)
+        d.addErrback(log.err, system='metrics-sink')
+        return d
+
+    def flush_now(self):
+        """Blocking flush; only one flush runs at a time, concurrent calls return immediately"""
+        if not self._flush_lock.acquire(False):
+            return
+        try:
+            with self._buffer_lock:
+                batch, self._buffer = self._buffer, []
+
+            data = u''.join(batch).encode('utf-8')
+            try:
+                self.spool.replay(self._send)
+                if data:
+                    self._send(data)
+                self._down = False
+            except (socket.error, httplib.HTTPException, IOError) as e:
+                log.msg('Forwarding metrics to %s:%s failed (%s), spooling %s lines' %
+                        (self.host, self.port, e, len(batch)), system='metrics-sink')
+                self._down = True
+                self.disconnect()
+                if data:
+                    self.spool.put(data)
+        finally:
+            self._flush_lock.release()
+
+    def _send(self, data):
+        raise NotImplementedError()
+
+    def disconnect(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+
+class GraphiteSink(MetricsSink):
+    """Forwards metrics using the Graphite plaintext protocol"""
+    name('graphite')
+
+    sink_type = 'graphite'
+    default_port = 2003
+
+    def format(self, series, metric, timestamp, value):
+        return format_graphite(self.prefix, series, metric, timestamp, value)
+
+    def _send(self, data):
+        if self._connection is None:
+            self._connection = socket.create_connection((self.host, self.port), timeout=10)
+        self._connection.sendall(data)
+
+
+class InfluxDBSink(MetricsSink):
+    """Forwards metrics using the InfluxDB line protocol over the HTTP write API"""
+    name('influxdb')
+
+    sink_type = 'influxdb'
+    default_port = 8086
+
+    def __init__(self, database=None, **kwargs):
+        super(InfluxDBSink, self).__init__(**kwargs)
+        self._database = database
+
+    @property
+    def database(self):
+        return self._database or self._config('database', 'oms')
+
+    def format(self, series, metric, timestamp, value):
+        return format_influxdb(self.prefix, series, metric, timestamp, value)
+
+    def _send(self, data):
+        if self._connection is None:
+            self._connection = httplib.HTTPConnection(self.host, self.port, timeout=10)
+        self._connection.request('POST', '/write?db=%s&precision=ms' % self.database, data,
+                                 {'Content-Type': 'text/plain'})
+        response = self._connection.getresponse()
+        response.read()
+        if response.status not in (200, 204):
+            raise httplib.HTTPException('InfluxDB write failed: %s %s' % (response.status, response.reason))
+
+
+def active_sinks():
+    return [sink for sink in getAllUtilitiesRegisteredFor(IMetricsSink) if sink.enabled]
+
+
+class MetricsSinkDaemonProcess(DaemonProcess):
+    implements(IProcess)
+
+    __name__ = "metrics-sink"
+
+    def __init__(self):
+        super(MetricsSinkDaemonProcess, self).__init__()
+        self.interval = get_config().getint('metrics-sink', 'flush_interval', 10)
+
+    @defer.inlineCallbacks
+    def run(self):
+        while True:
+            try:
+                if not self.paused:
+                    for sink in active_sinks():
+                        yield sink.flush()
+            except Exception:
+                log.err(system='metrics-sink')
+
+            yield async_sleep(self.interval)
+
+
+provideSubscriptionAdapter(subscription_factory(MetricsSinkDaemonProcess), adapts=(Proc,))
@@ -1,16 +1,129 @@
-from grokcore.component import context
+from bisect import bisect_left, bisect_right
+import time
+
+from grokcore.component import context, subscribe
 from twisted.internet import defer
 from twisted.python import log
 from netaddr import IPAddress
 
+from opennode.oms.config import get_config
 from opennode.oms.endpoint.ssh.cmdline import VirtualConsoleArgumentParser
 from opennode.oms.endpoint.ssh.cmd.security import require_admins_only_action
 from opennode.oms.model.model.actions import Action, action
-from opennode.oms.model.model.symlink import follow_symlinks
+from opennode.oms.model.model.events import IModelCreatedEvent
 from opennode.oms.zodb import db
 
-from opennode.knot.model.compute import ICompute
-from opennode.knot.model.network import IPv4Pools, IPv4Pool
+from opennode.knot.model.catalog import compute_ipv4, compute_ipv6
+from opennode.knot.model.compute import IVirtualCompute
+from opennode.knot.model.computes import in_machines
+from opennode.knot.model.network import IPv4Pools, IPPool
+
+
+# catalog index of the compute IPs -> container of the pools of these IPs
+POOL_INDEXES = (('ipv4', 'ippools'), ('ipv6', 'ip6pools'))
+
+
+class IPUsageReconciler(object):
+    """Brings the used IPs of the pools in line with the IPs of the computes.
+
+    The IPs of the computes are read from the compute catalog once and diffed against the used IPs of
+    every pool. IPs of computes missing from a pool are marked as used; used IPs without a compute are freed
+    once they are found stale by two passes in a row, so that IPs allocated by deployments still in progress
+    are kept, and never if they were reserved by hand. The first pass over a pool reserves the used IPs
+    without a compute instead, as they were marked as used by hand before reservations existed. Changes are
+    committed in batches of `batch_size`.
+
+    """
+
+    def __init__(self):
+        # (pools container, pool __name__) -> IPs found stale by the previous pass
+        self.pending = {}
+        self.last_run = None
+
+    def due(self):
+        interval = get_config().getint('ippools', 'reconcile_interval', 3600)
+        return self.last_run is None or time.time() - self.last_run >= interval
+
+    @db.ro_transact
+    def in_use(self):
+        catalog = db.get_root()['oms_root']['computes'].catalog
+        return dict((pools, sorted(int(IPAddress(ip)) for ip in catalog.keys(index)))
+                    for index, pools in POOL_INDEXES)
+
+    @db.ro_transact
+    def diff(self, pools, in_use):
+        """Returns (pool __name__, missing IPs, stale IPs, whether the reservations were seeded) for every
+        pool of the `pools` container"""
+        res = []
+        for pool in db.get_root()['oms_root'][pools].ranges.itervalues():
+            wanted = in_use[bisect_left(in_use, int(pool.minimum)):bisect_right(in_use, int(pool.maximum))]
+            wanted = set(wanted)
+            used = set(pool.addresses)
+            stale = used - wanted - set(pool.reservations)
+            res.append((pool.__name__, sorted(wanted - used), sorted(stale), pool.reservations_seeded))
+        return res
+
+    @db.transact
+    def apply(self, pools, name, changes):
+        """Applies the (IP, 'use', 'free' or 'reserve') `changes` to the pool"""
+        pool = db.get_root()['oms_root'][pools][name]
+        if pool is None:
+            return
+        for ip, change in changes:
+            if change == 'use':
+                pool.addresses.add(ip)
+            elif ip not in pool.addresses:
+                continue
+            elif change == 'reserve':
+                pool.reservations.add(ip)
+            elif ip not in pool.reservations:
+                pool.free(ip)
+
+    @db.transact
+    def seeded(self, pools, name):
+        pool = db.get_root()['oms_root'][pools][name]
+        if pool is not None:
+            pool.reservations_seeded = True
+
+    @defer.inlineCallbacks
+    def run(self):
+        """Returns the drift found, by pool path"""
+        batch_size = get_config().getint('ippools', 'reconcile_batch', 500)
+        free_stale = get_config().getboolean('ippools', 'free_stale', False)
+        self.last_run = time.time()
+
+        report = {}
+        pending = {}
+        in_use = yield self.in_use()
+        for index, pools in POOL_INDEXES:
+            for name, missing, stale, seeded in (yield self.diff(pools, in_use[pools])):
+                key = (pools, name)
+                reserved = stale if not seeded else []
+                confirmed = ([ip for ip in stale if ip in self.pending.get(key, ())]
+                             if free_stale and seeded else [])
+                pending[key] = set(stale) - set(confirmed) - set(reserved)
+
+                changes = ([(ip, 'use') for ip in missing] + [(ip, 'free') for ip in confirmed] +
+                           [(ip, 'reserve') for ip in reserved])
+                for i in xrange(0, len(changes), batch_size):
+                    yield self.apply(pools, name, changes[i:i + batch_size])
+                if not seeded:
+                    yield self.seeded(pools, name)
+
+                if missing or stale:
+                    report['/%s/%s' % (pools, name)] = {'marked_used': len(missing), 'freed': len(confirmed),
+                                                        'reserved': len(reserved),
+                                                        'stale': len(stale) - len(confirmed) - len(reserved)}
+        self.pending = pending
+
+        for path, drift in sorted(report.iteritems()):
+            log.msg('Drift of %s: %s IPs marked as used, %s freed, %s reserved, %s stale' %
+                    (path, drift['marked_used'], drift['freed'], drift['reserved'], drift['stale']),
+                    system='sync-ippool')
+        defer.returnValue(report)
+
+
+reconciler = IPUsageReconciler()
 
 
 class SyncIPUsageAction(Action):
@@ -22,27 +135,32 @@ class SyncIPUsageAction(Action):
 
     @defer.inlineCallbacks
     def execute(self, cmd, args):
-        @db.transact
-        def get_compute_ips():
-            try:
-                computes = map(follow_symlinks,
-                               filter(lambda c: ICompute.providedBy(follow_symlinks(c)),
-                                  db.get_root()['oms_root']['computes'].listcontent()))
-                pools = db.get_root()['oms_root']['ippools']
-                for c in computes:
-                    ip = IPAddress(c.ipv4_address.split('/')[0])
-                    pool = pools.find_pool(ip)
-                    if pool is not None and not pool.get(ip):
-                        log.msg('Marking %s as used...' % ip, system='sync-ippool')
-                        pool.use(ip)
-            except Exception:
-                log.err(system='sync-ippool')
-                raise
-        yield get_compute_ips()
+        try:
+            yield reconciler.run()
+        except Exception:
+            log.err(system='sync-ippool')
+            raise
+
+
+def use_compute_ips(compute):
+    """Marks the IPs of `compute` as used in the pools they belong to"""
+    for getter, pools in ((compute_ipv4, 'ippools'), (compute_ipv6, 'ip6pools')):
+        ip = getter(compute)
+        if ip is None:
+            continue
+        pool = db.get_root()['oms_root'][pools].find_pool(ip)
+        if pool is not None and not pool.get(ip):
+            pool.use(IPAddress(ip))
+
+
+@subscribe(IVirtualCompute, IModelCreatedEvent)
+def use_created_compute_ips(model, event):
+    if in_machines(model):
+        use_compute_ips(model)
 
 
 class ManageIpAction(Action):
-    context(IPv4Pool)
+    context(IPPool)
     action('manage')
 
     @db.ro_transact(proxy=False)
@@ -52,7 +170,8 @@ class ManageIpAction(Action):
     def arguments(self):
         parser = VirtualConsoleArgumentParser()
         parser.add_argument('-f', '--free', action='store_true', help='Mark IP as free')
-        parser.add_argument('-u', '--use', action='store_true', help='Mark IP as used')
+        parser.add_argument('-u', '--use', action='store_true',
+                            help='Mark IP as used, it is kept by the reconciliation with the computes')
         parser.add_argument('ip')
         return parser
 
@@ -65,5 +184,5 @@ class ManageIpAction(Action):
             if args.free:
                 self.context.free(ip)
             elif args.use:
-                self.context.use(ip)
+                self.context.reserve(ip)
         yield manage(cmd, args)
@@ -1,15 +1,21 @@
+import time
+
 from datetime import datetime
+from grokcore.component import subscribe
 from grokcore.component.directive import context
 from twisted.internet import defer
 from twisted.python import log
 from zope.component import provideSubscriptionAdapter
 from zope.interface import implements
 
+from opennode.knot.backend.failuredetector import expect, heartbeat
+from opennode.knot.backend.metrics import encoded_stream
 from opennode.knot.model.compute import ICompute
-from opennode.knot.utils.icmp import ping
+from opennode.knot.utils.icmp import async_ping, async_ping_many
+from opennode.knot.utils.pinghistory import ping_history
 from opennode.oms.config import get_config
-from opennode.oms.endpoint.ssh.detached import DetachedProtocol
 from opennode.oms.model.model.actions import Action, action
+from opennode.oms.model.model.events import IModelDeletedEvent
 from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
 from opennode.oms.model.model.symlink import follow_symlinks
 from opennode.oms.util import subscription_factory, async_sleep
@@ -26,6 +32,7 @@ class PingCheckAction(Action):
         super(PingCheckAction, self).__init__(*args, **kwargs)
         config = get_config()
         self.mem_limit = config.getint('pingcheck', 'mem_limit')
+        self.windows = rtt_windows()
 
     @db.ro_transact(proxy=False)
     def subject(self, args):
@@ -33,23 +40,61 @@ class PingCheckAction(Action):
 
     @defer.inlineCallbacks
     def execute(self, cmd, args):
-        yield self._execute(cmd, args)
+        address = yield db.get(self.context, 'hostname')
+        delays = yield async_ping(address.encode('utf-8'), **ping_options())
+        yield self.record(delays)
+
+    @defer.inlineCallbacks
+    def record(self, delays, streams=None):
+        """Records the round trip times of one check. `streams` optionally maps the ping metrics to the
+        streams of the compute."""
+        key = yield db.get(self.context, '__name__')
+        history = ping_history.record(key, datetime.utcnow(), delays, self.mem_limit, self.windows)
+        last_ping = history.flags()[0]
+        if last_ping:
+            heartbeat(key, 'icmp')
+
+        if streams:
+            timestamp = int(time.time() * 1000)
+            rtt, loss = history.summary()
+            for k, value in (('ping_rtt', rtt), ('ping_loss', loss)):
+                if value is not None and streams.get(k):
+                    streams[k].add((timestamp, value))
+
+        # the history lives in memory, only changes of the last ping result are written; suspicious and
+        # failure are published by the failure detector
+        if (yield db.get(self.context, 'last_ping')) != last_ping:
+            yield self._execute(last_ping)
 
     @db.transact
-    def _execute(self, cmd, args):
-        address = self.context.hostname.encode('utf-8')
-        res = ping(address)
-        self.context.last_ping = (res == 1)
-        self.context.pingcheck.append({'timestamp': datetime.utcnow(),
-                                       'result': res})
-        history_len = len(self.context.pingcheck)
-        if history_len > self.mem_limit:
-            del self.context.pingcheck[:-self.mem_limit]
+    def _execute(self, last_ping):
+        self.context.last_ping = last_ping
+
+        # drop the ping history persisted by older versions
+        if 'pingcheck' in self.context.__dict__:
+            del self.context.__dict__['pingcheck']
+            self.context._p_changed = True
+
+
+def ping_options():
+    config = get_config()
+    return {'count': config.getint('pingcheck', 'count', 2),
+            'timeout': config.getfloat('pingcheck', 'timeout', 2)}
 
-        ping_results = map(lambda i: i['result'] == 1, self.context.pingcheck[:3])
 
-        self.context.suspicious = not all(ping_results)
-        self.context.failure = not any(ping_results)
+def rtt_windows():
+    """Returns the (seconds, number of packets) pairs of the sliding windows of the ping statistics"""
+    config = get_config()
+    interval = config.getint('pingcheck', 'interval')
+    count = ping_options()['count']
+    windows = [int(w) for w in config.getstring('pingcheck', 'rtt_windows', '60, 300, 900').split(',')
+               if w.strip()]
+    return [(w, max(1, w * count // interval)) for w in windows]
+
+
+@subscribe(ICompute, IModelDeletedEvent)
+def forget_ping_history(model, event):
+    ping_history.remove(model.__name__)
 
 
 class PingCheckDaemonProcess(DaemonProcess):
@@ -81,16 +126,29 @@ class PingCheckDaemonProcess(DaemonProcess):
         @db.ro_transact
         def get_computes():
             oms_root = db.get_root()['oms_root']
-            res = [(i, i.hostname)
+            res = [(i, i.__name__, i.hostname, ping_streams(i))
                    for i in map(follow_symlinks, oms_root['computes'].listcontent())
                    if ICompute.providedBy(i)]
 
             return res
 
+        def ping_streams(compute):
+            metrics = compute['metrics']
+            if not metrics:
+                return {}
+            return dict((k, encoded_stream(compute.__name__, metrics[k]))
+                        for k in ('ping_rtt', 'ping_loss') if metrics[k])
+
+        computes = yield get_computes()
+        for i, key, hostname, streams in computes:
+            expect(key, 'icmp')
+        # a single batch for the whole fleet, it takes about one ping timeout
+        hostnames = set(hostname.encode('utf-8') for i, key, hostname, streams in computes)
+        results = yield async_ping_many(hostnames, **ping_options())
+
         ping_actions = []
-        for i, hostname in (yield get_computes()):
-            action = PingCheckAction(i)
-            d = action.execute(DetachedProtocol(), object())
+        for i, key, hostname, streams in computes:
+            d = PingCheckAction(i).record(results[hostname.encode('utf-8')], streams)
             ping_actions.append((hostname, d))
 
         def handle_errors(e, c):
@@ -102,4 +160,6 @@ class PingCheckDaemonProcess(DaemonProcess):
         for c, deferred in ping_actions:
             deferred.addErrback(handle_errors, c)
 
+        yield defer.DeferredList([deferred for c, deferred in ping_actions])
+
 provideSubscriptionAdapter(subscription_factory(PingCheckDaemonProcess), adapts=(Proc,))
@@ -12,6 +12,7 @@ import time
 
 from opennode.knot.backend import operation as op
 from opennode.knot.backend import subprocess
+from opennode.knot.backend.failuredetector import heartbeat
 from opennode.knot.model.compute import ISaltInstalled
 from opennode.oms.config import get_config
 from opennode.oms.zodb import db
@@ -214,6 +215,7 @@ class SaltBase(Adapter):
         interaction = db.context(self.context).get('interaction', None)
         executor = executor_class(hostname, self.action, interaction, timeout=self.timeout)
         res = yield executor.run(*args, **kwargs)
+        heartbeat((yield db.get(self.context, '__name__')), 'salt')
         defer.returnValue(res)
 
 
@@ -9,10 +9,8 @@ import sys
 
 from opennode.knot.model.user import IUserStatisticsProvider
 from opennode.knot.model.user import IUserStatisticsLogger
-from opennode.knot.model.compute import IVirtualCompute, IDeployed
 
 from opennode.oms.config import get_config
-from opennode.oms.model.model.symlink import follow_symlinks
 from opennode.oms.zodb import db
 
 
@@ -25,18 +23,8 @@ class UserComputeStatisticsAggregator(GlobalUtility):
     @db.assert_transact
     def get_computes(self, username):
         computes = db.get_root()['oms_root']['computes']
-        user_computes = []
-        for compute in map(follow_symlinks, computes.listcontent()):
-            if not IVirtualCompute.providedBy(compute):
-                continue
-
-            if not compute.license_activated:
-                continue
-
-            if compute.__owner__ == username and IDeployed.providedBy(compute):
-                user_computes.append(compute)
-
-        return user_computes
+        return [compute for compute in computes.search(owner=username, virtual=True, deployment=u'deployed')
+                if compute.license_activated]
 
     @db.assert_transact
     def get_credit(self, username):
@@ -4,7 +4,7 @@
 import logging
 
 from twisted.internet.defer import Deferred
-from twisted.internet.error import ProcessDone
+from twisted.internet.error import ProcessDone, ProcessTerminated
 from twisted.internet.protocol import ProcessProtocol
 
 log = logging.getLogger(__name__)
@@ -13,6 +13,10 @@ class SubprocessProtocol(ProcessProtocol):
     outBuffer = ""
     errBuffer = ""
 
+    def __init__(self, stderr=False, exit_codes=(0,)):
+        self.stderr = stderr
+        self.exit_codes = exit_codes
+
     def connectionMade(self):
         self.d = Deferred()
 
@@ -23,16 +27,19 @@ class SubprocessProtocol(ProcessProtocol):
         self.errBuffer += data
 
     def processEnded(self, reason):
-        if reason.check(ProcessDone):
-            self.d.callback(self.outBuffer)
+        if reason.check(ProcessDone) or (reason.check(ProcessTerminated) and
+                                         reason.value.exitCode in self.exit_codes):
+            self.d.callback((self.outBuffer, self.errBuffer) if self.stderr else self.outBuffer)
         else:
             self.d.errback(reason)
 
 
-def async_check_output(args, ireactorprocess=None, killhook=None):
+def async_check_output(args, ireactorprocess=None, killhook=None, stderr=False, exit_codes=(0,)):
     """
     :type args: list of str
     :type ireactorprocess: :class: twisted.internet.interfaces.IReactorProcess
+    :param stderr: return a (stdout, stderr) tuple instead of stdout only
+    :param exit_codes: exit codes that are not considered a failure
     :rtype: Deferred
     """
     log.debug('%s (killhook=%s)', ' '.join(map(str, args)), killhook is not None)
@@ -41,7 +48,7 @@ def async_check_output(args, ireactorprocess=None, killhook=None):
         from twisted.internet import reactor
         ireactorprocess = reactor
 
-    pprotocol = SubprocessProtocol()
+    pprotocol = SubprocessProtocol(stderr=stderr, exit_codes=exit_codes)
     ireactorprocess.spawnProcess(pprotocol, args[0], map(str, args), env=None)
     if killhook and type(killhook) is Deferred:
         killhook.addCallback(lambda r: pprotocol.transport.signalProcess('KILL'))
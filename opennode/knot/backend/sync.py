@@ -7,11 +7,12 @@ from twisted.python import log
 
 from zope.authentication.interfaces import IAuthentication
 from zope.component import provideSubscriptionAdapter, getAllUtilitiesRegisteredFor
-from zope.component import getUtility
+from zope.component import getUtility, handle
 from zope.interface import implements
 
+from opennode.knot.backend.failuredetector import expect, heartbeat
 from opennode.knot.backend.syncaction import SyncAction
-from opennode.knot.backend.network import SyncIPUsageAction
+from opennode.knot.backend.network import SyncIPUsageAction, reconciler
 from opennode.knot.backend.operation import OperationRemoteError
 from opennode.knot.backend.operation import IPing
 from opennode.knot.model.backend import IKeyManager
@@ -20,6 +21,7 @@ from opennode.knot.model.user import UserProfile
 from opennode.knot.model.user import IUserStatisticsProvider
 from opennode.oms.config import get_config
 from opennode.oms.endpoint.ssh.detached import DetachedProtocol
+from opennode.oms.model.model.events import ModelDeletedEvent
 from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
 from opennode.oms.model.model.symlink import follow_symlinks
 from opennode.oms.security.principals import User
@@ -46,7 +48,9 @@ def delete_machines(delete_list):
     oms_machines = db.get_root()['oms_root']['machines']
 
     for host, hostname in delete_list:
+        machine = oms_machines[host.__name__]
         del oms_machines[host.__name__]
+        handle(machine, ModelDeletedEvent(oms_machines))
 
 
 @defer.inlineCallbacks
@@ -54,25 +58,6 @@ def get_manageable_machine_hostnames():
     defer.returnValue(map(lambda h: h[0].hostname, (yield get_manageable_machines())))
 
 
-def set_compute_status(uuid, status_name, status):
-    from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
-    compute = db.get_root()['oms_root']['machines'][uuid]
-    setattr(compute, status_name, bool(status))
-
-    def iterate_recursively(container):
-        seen = set()
-        for item in container.listcontent():
-            if ICompute.providedBy(item):
-                setattr(item, status_name, bool(status))
-
-            if (IVirtualizationContainer.providedBy(item) or ICompute.providedBy(item)):
-                if item.__name__ not in seen:
-                    seen.add(item.__name__)
-                    iterate_recursively(item)
-
-    iterate_recursively(compute)
-
-
 class SyncDaemonProcess(DaemonProcess):
     implements(IProcess)
 
@@ -228,30 +213,30 @@ class SyncDaemonProcess(DaemonProcess):
             log.msg('Unlock: %s not in outstanding requests: %s'
                     % (str(compute), self.outstanding_requests.keys()), system='sync-unlock')
 
-    @db.transact
-    def handle_error(self, e, action, c, compute, status_name):
+    # suspicious and failure are published by the failure detector, failed requests simply don't count
+    # as heartbeats
+    @db.ro_transact
+    def handle_error(self, e, action, c, compute, source):
         e.trap(Exception)
         log.msg("Got exception on %s of '%s'" % (action, c), system='sync')
         if get_config().getboolean('debug', 'print_exceptions'):
             log.err(e, system='sync')
         self.delete_outstanding_request(compute)
-        set_compute_status(compute.__name__, status_name, True)
 
-    @db.transact
-    def handle_success(self, r, action, hostname, compute, status_name):
+    @db.ro_transact
+    def handle_success(self, r, action, hostname, compute, source):
         log.msg("%s completed: '%s'" % (action, hostname), system='sync')
         self.delete_outstanding_request(compute)
-        set_compute_status(compute.__name__, status_name, False)
+        heartbeat(compute.__name__, source)
 
-    @db.transact
-    def handle_remote_error(self, ore, c, compute, status_name):
+    @db.ro_transact
+    def handle_remote_error(self, ore, c, compute, source):
         ore.trap(OperationRemoteError)
         if ore.value.remote_tb and get_config().getboolean('debug', 'print_exceptions'):
             log.err(ore, system='sync')
         else:
             log.msg(str(ore.value), system='sync', logLevel=ERROR)
         self.delete_outstanding_request(compute)
-        set_compute_status(compute.__name__, status_name, True)
 
     def execute_sync_action(self, hostname, compute):
         log.msg("Syncing started: '%s' (%s)" % (hostname, str(compute)), system='sync')
@@ -259,9 +244,9 @@ class SyncDaemonProcess(DaemonProcess):
         syncaction = SyncAction(compute)
         deferred = syncaction.execute(DetachedProtocol(), object())
         self.outstanding_requests[str(compute)] = [deferred, curtime, 0, defer.Deferred()]
-        deferred.addCallback(self.handle_success, 'synchronization', hostname, compute, 'suspicious')
-        deferred.addErrback(self.handle_remote_error, hostname, compute, 'suspicious')
-        deferred.addErrback(self.handle_error, 'Synchronization', hostname, compute, 'suspicious')
+        deferred.addCallback(self.handle_success, 'synchronization', hostname, compute, 'sync')
+        deferred.addErrback(self.handle_remote_error, hostname, compute, 'sync')
+        deferred.addErrback(self.handle_error, 'Synchronization', hostname, compute, 'sync')
         return deferred
 
     @defer.inlineCallbacks
@@ -277,13 +262,14 @@ class SyncDaemonProcess(DaemonProcess):
 
             if (targetkey not in self.outstanding_requests or self.outstanding_requests[targetkey][2] > 5):
                 log.msg('Pinging %s (%s)...' % (hostname, compute), system='sync')
+                expect(compute.__name__, 'ping')
                 pingtest = IPing(compute)
                 killhook = defer.Deferred()
                 deferred = pingtest.run(__killhook=killhook)
                 self.outstanding_requests[targetkey] = [deferred, curtime, 0, killhook]
-                deferred.addCallback(self.handle_success, 'ping test', hostname, compute, 'failure')
-                deferred.addErrback(self.handle_remote_error, hostname, compute, 'failure')
-                deferred.addErrback(self.handle_error, 'Ping test', hostname, compute, 'failure')
+                deferred.addCallback(self.handle_success, 'ping test', hostname, compute, 'ping')
+                deferred.addErrback(self.handle_remote_error, hostname, compute, 'ping')
+                deferred.addErrback(self.handle_error, 'Ping test', hostname, compute, 'ping')
 
                 def sync_action(r, hostname, compute):
                     return self.execute_sync_action(hostname, compute)
@@ -294,6 +280,11 @@ class SyncDaemonProcess(DaemonProcess):
 
     @defer.inlineCallbacks
     def gather_ippools(self):
+        """Reconciles the IP pools with the computes every [ippools] reconcile_interval seconds; deployments,
+        undeployments and deletions keep the pools up to date in between"""
+        if not reconciler.due():
+            return
+
         @db.ro_transact
         def get_ippools():
             return db.get_root()['oms_root']['ippools']
@@ -8,6 +8,7 @@ from zope.component import getUtility
 
 from opennode.knot.backend.compute import any_stack_installed
 from opennode.knot.backend.compute import ComputeAction
+from opennode.knot.backend.failuredetector import IFailureDetector
 from opennode.knot.backend.operation import IAgentVersion
 from opennode.knot.backend.operation import IInfoVM
 from opennode.knot.backend.operation import IGetComputeInfo
@@ -28,6 +29,7 @@ from opennode.knot.model.network import NetworkInterface, NetworkRoute
 from opennode.knot.model.template import Template, Templates
 from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
 from opennode.knot.model.virtualizationcontainer import VirtualizationContainer
+from opennode.knot.utils.failuredetector import DOWN, SUSPECT
 
 from opennode.oms.endpoint.ssh.cmdline import VirtualConsoleArgumentParser
 from opennode.oms.endpoint.ssh.detached import DetachedProtocol
@@ -135,28 +137,27 @@ class SyncAction(ComputeAction):
         from opennode.knot.backend.salt import get_master_version
         master_v = (yield get_master_version()).split('.')
 
+        detector = getUtility(IFailureDetector)
+        key = yield db.get(self.context, '__name__')
+
         if master_v[0] != minion_v[0]:
-            @db.transact
-            def set_failure():
-                self.context.failure = True
-            yield set_failure()
+            detector.set_condition(key, 'agent-version', DOWN)
             log.msg('Major agent version mismatch: master %s != minion %s on %s'
                     % (master_v, minion_v, self.context),
                     system='sync-action', logLevel=logging.ERROR)
             raise Exception('Major agent version mismatch')
 
         if master_v[1] != minion_v[1]:
-            @db.transact
-            def set_suspicious():
-                self.context.suspicious = True
-            yield set_suspicious()
+            detector.set_condition(key, 'agent-version', SUSPECT)
             log.msg('Minor agent version mismatch: master %s != minion %s on %s'
                     % (master_v, minion_v, self.context),
                     system='sync-action', logLevel=logging.WARNING)
-        elif master_v != minion_v:
-            log.msg('Release agent version mismatch: master %s != minion %s on %s'
-                    % (master_v, minion_v, self.context),
-                    system='sync-action')
+        else:
+            detector.set_condition(key, 'agent-version', None)
+            if master_v != minion_v:
+                log.msg('Release agent version mismatch: master %s != minion %s on %s'
+                        % (master_v, minion_v, self.context),
+                        system='sync-action')
 
     @db.ro_transact
     def default_console(self):
@@ -186,6 +187,7 @@ class SyncAction(ComputeAction):
 
     @db.assert_transact
     def create_default_console(self, default):
+        self.context.ensure_subcontainers()
         if not default or not self.context.consoles[default]:
             if (IVirtualizationContainer.providedBy(self.context.__parent__)
                     and self.context.__parent__.backend == 'openvz'
@@ -202,6 +204,7 @@ class SyncAction(ComputeAction):
 
     @db.assert_transact
     def _sync_consoles(self):
+        self.context.ensure_subcontainers()
         if self.context['consoles'] and self.context.consoles['ssh']:
             return self.fixup_console_ip(self.context.consoles['ssh'])
 
@@ -268,6 +271,7 @@ class SyncAction(ComputeAction):
 
     @db.assert_transact
     def sync_vm(self, vm):
+        self.context.ensure_subcontainers()
         compute = TmpObj(self.context)
         compute.state = unicode(vm['state'])
 
@@ -279,6 +283,7 @@ class SyncAction(ComputeAction):
 
         if 'ctid' in vm:
             compute.ctid = vm['ctid'] if vm['ctid'] != '-' else -1
+            db.get_root()['oms_root']['computes'].ctids.observe(self.context.__name__, int(compute.ctid))
 
         for idx, console in enumerate(vm['consoles']):
             if console['type'] == 'pty' and not self.context.consoles['tty%s' % idx]:
@@ -324,6 +329,8 @@ class SyncAction(ComputeAction):
         with SuppressEvents(self.context):
             compute.apply()
 
+        db.get_root()['oms_root']['computes'].index(self.context)
+
     @defer.inlineCallbacks
     def sync_hw(self, full):
         if not any_stack_installed(self.context):
@@ -382,6 +389,7 @@ class SyncAction(ComputeAction):
             self.context.template = u'Hardware node'
 
             # XXX TODO: handle removal of routes
+            self.context.ensure_subcontainers()
             for r in routes:
                 destination = netaddr.IPNetwork('%s/%s' % (r['destination'], r['netmask']))
                 route_name = str(destination.cidr).replace('/', '_')
@@ -437,6 +445,8 @@ class SyncAction(ComputeAction):
             self.context.add(vms)
             if not self.context['vms']:
                 self.context.add(Symlink('vms', self.context[vms.__name__]))
+            # the backends of the compute
+            db.get_root()['oms_root']['computes'].index(self.context)
 
         for vms_type in vms_types:
             backend_type = url_to_backend_type.get(vms_type)
@@ -513,6 +523,8 @@ class SyncTemplatesAction(ComputeAction):
             for template in vanished_template_names:
                 template_container.remove(follow_symlinks(template_container['by-name'][template]))
 
+            db.get_root()['oms_root']['templates'].index_container(template_container)
+
         for container in self.context.listcontent():
             if not IVirtualizationContainer.providedBy(container):
                 continue
@@ -20,7 +20,6 @@ from opennode.oms.model.form import alsoProvides
 from opennode.oms.model.form import noLongerProvides
 from opennode.oms.model.model.actions import action
 from opennode.oms.model.model.events import ModelDeletedEvent
-from opennode.oms.model.model.symlink import follow_symlinks
 from opennode.oms.model.model.symlink import Symlink
 from opennode.oms.model.traversal import canonical_path
 from opennode.oms.zodb import db
@@ -75,7 +74,8 @@ class SyncVmsAction(ComputeAction):
         for vm_uuid in remote_uuids.difference(local_uuids):
             remote_vm = [rvm for rvm in remote_vms if rvm['uuid'] == vm_uuid][0]
 
-            existing_machine = follow_symlinks(machines['by-name'][remote_vm['name']])
+            existing_machine = ([m for m in root['computes'].search(hostname=remote_vm['name'], virtual=False)
+                                 if m.__parent__ is machines] or [None])[0]
             if existing_machine:
                 # XXX: this VM is a nested VM, for now let's hack it this way
                 new_compute = Symlink(existing_machine.__name__, existing_machine)
@@ -93,10 +93,12 @@ class SyncVmsAction(ComputeAction):
                 # XXX: not sure if removing a parent interface will remove the child also
                 noLongerProvides(new_compute, IManageable)
                 self.context.add(new_compute)
+                root['computes'].index(new_compute)
 
         for vm_uuid in remote_uuids.intersection(local_uuids):
             noLongerProvides(self.context[vm_uuid], IUndeployed)
             alsoProvides(self.context[vm_uuid], IDeployed)
+            root['computes'].index(self.context[vm_uuid])
 
         for vm_uuid in local_uuids.difference(remote_uuids):
             if IDeploying.providedBy(self.context[vm_uuid]):
@@ -106,6 +108,7 @@ class SyncVmsAction(ComputeAction):
             noLongerProvides(self.context[vm_uuid], IDeployed)
             alsoProvides(self.context[vm_uuid], IUndeployed)
             self.context[vm_uuid].state = u'inactive'
+            root['computes'].index(self.context[vm_uuid])
 
             if get_config().getboolean('sync', 'delete_on_sync'):
                 log.msg("Deleting compute %s" % vm_uuid, system='v12n-sync', logLevel=logging.WARNING)
@@ -201,3 +204,6 @@ class SyncVmsAction(ComputeAction):
         # remove interfaces
         for iface_name in local_names.difference(remote_names):
             del local_interfaces[iface_name]
+
+        # the IP address of a hypervisor is the one of its primary interface
+        db.get_root()['oms_root']['computes'].index(host_compute)
@@ -2,7 +2,6 @@ import transaction
 from grokcore.component import context
 
 from opennode.knot.model.template import GlobalTemplates
-from opennode.knot.model.template import ITemplate
 
 from opennode.oms.endpoint.ssh.cmdline import VirtualConsoleArgumentParser
 from opennode.oms.endpoint.ssh.cmd.security import SetAclMixin
@@ -47,12 +46,7 @@ class SetGlobalTemplatePermissionsAction(Action, SetAclMixin):
             gtemplates = db.get_root()['oms_root']['templates']
             for path in args.paths:
                 proto = cmd.traverse(path)
-                action_list = []
-                for t in filter(ITemplate.providedBy, map(follow_symlinks, gtemplates.listcontent())):
-                    if t.name == proto.name:
-                        action_list.append(t)
-
-                for t in action_list:
+                for t in gtemplates.by_name(proto.name):
                     with cmd.protocol.interaction:
                         self.set_acl(t, args.i, args.m, args.d, args.x)
         except NoSuchPermission as e:
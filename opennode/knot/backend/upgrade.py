@@ -0,0 +1,54 @@
+"""One-off upgrades of the data created by older versions."""
+from twisted.internet import defer
+from twisted.python import log
+from zope.component import provideSubscriptionAdapter
+from zope.interface import implements
+
+from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
+from opennode.oms.util import subscription_factory
+from opennode.oms.zodb import db
+
+
+@db.transact
+def upgrade_computes():
+    return db.get_root()['oms_root']['computes'].upgrade()
+
+
+@db.transact
+def upgrade_compute_catalog():
+    return db.get_root()['oms_root']['computes'].upgrade_catalog()
+
+
+@db.transact
+def upgrade_ippools():
+    upgraded = 0
+    for pool in db.get_root()['oms_root']['ippools'].listcontent():
+        if pool._addresses is None:
+            pool.addresses
+            upgraded += 1
+    return upgraded
+
+
+class UpgradeDaemonProcess(DaemonProcess):
+    """Runs the data upgrades once at startup"""
+    implements(IProcess)
+
+    __name__ = "upgrade"
+
+    @defer.inlineCallbacks
+    def run(self):
+        try:
+            upgraded = yield upgrade_computes()
+            if upgraded:
+                log.msg('Upgraded %s computes' % upgraded, system='upgrade')
+            cataloged = yield upgrade_compute_catalog()
+            if cataloged:
+                log.msg('Cataloged %s computes' % cataloged, system='upgrade')
+            upgraded = yield upgrade_ippools()
+            if upgraded:
+                log.msg('Upgraded %s IP pools' % upgraded, system='upgrade')
+        except Exception:
+            log.err(system='upgrade')
+
+
+provideSubscriptionAdapter(subscription_factory(UpgradeDaemonProcess), adapts=(Proc,))
@@ -6,6 +6,7 @@ from zope.authentication.interfaces import IAuthentication
 from zope.component import getUtility
 
 from opennode.knot.model.compute import Compute, IVirtualCompute
+from opennode.knot.model.computes import Computes
 from opennode.knot.model.hangar import Hangar
 from opennode.knot.model.machines import Machines
 from opennode.knot.model.virtualizationcontainer import VirtualizationContainer
@@ -18,18 +19,44 @@ from opennode.oms.model.model.actions import ActionsContainer
 from opennode.oms.model.model.hooks import PreValidateHookMixin
 from opennode.oms.model.model.stream import Metrics
 from opennode.oms.model.schema import _isdotted
+from opennode.oms.model.traversal import canonical_path
 from opennode.oms.util import JsonSetEncoder
 from opennode.oms.zodb import db
 
 
-class MachinesView(ContainerView):
+class ComputeSummaryMixin(object):
+    """Serves `?summary=1` listings of the computes of a container from the summary records of the compute
+    catalog, so that the computes' sub-containers are not loaded. The records are filtered by the 'view'
+    permission of the requesting principal, see `ComputeCatalog.viewable`."""
+
+    def summary_criteria(self):
+        return {'container': canonical_path(self.context)}
+
+    def render_GET(self, request):
+        if (request.args.get('summary', [''])[0] not in ('1', 'true', 'yes') or
+                not getattr(request, 'interaction', None)):
+            return super(ComputeSummaryMixin, self).render_GET(request)
+
+        catalog = db.get_root()['oms_root']['computes'].catalog
+        records = catalog.viewable(request.interaction, catalog.summarize(**self.summary_criteria()))
+        return {'id': self.context.__name__, 'children': records, 'total': len(records)}
+
+
+class ComputesView(ComputeSummaryMixin, ContainerView):
+    context(Computes)
+
+    def summary_criteria(self):
+        return {}
+
+
+class MachinesView(ComputeSummaryMixin, ContainerView):
     context(Machines)
 
     def blacklisted(self, item):
         return super(MachinesView, self).blacklisted(item) or isinstance(item, Hangar)
 
 
-class VirtualizationContainerView(ContainerView, PreValidateHookMixin):
+class VirtualizationContainerView(ComputeSummaryMixin, ContainerView, PreValidateHookMixin):
     context(VirtualizationContainer)
 
     def blacklisted(self, item):
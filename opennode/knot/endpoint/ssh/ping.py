@@ -1,7 +1,9 @@
 from grokcore.component import implements
+from twisted.internet import defer
 from zope.component import provideSubscriptionAdapter
 
-from opennode.knot.utils.icmp import ping
+from opennode.knot.utils.icmp import async_ping
+from opennode.knot.utils.pinghistory import RttBuffer
 from opennode.knot.model.compute import ICompute
 from opennode.oms.endpoint.ssh.cmd.base import Cmd
 from opennode.oms.endpoint.ssh.cmd.completers import PathCompleter
@@ -17,18 +19,61 @@ class PingCmd(Cmd):
     def arguments(self):
         parser = VirtualConsoleArgumentParser()
         parser.add_argument('host', nargs='+', help="Host or compute object")
+        parser.add_argument('-c', '--count', type=int, default=2, help="Number of echo requests per host")
+        parser.add_argument('-t', '--timeout', type=float, default=2, help="Reply timeout in seconds")
+        parser.add_argument('-s', '--summary', action='store_true',
+                            help="Print only the number of alive and unreachable hosts")
         return parser
 
-    @db.transact
-    def execute(self, args):
+    @db.ro_transact
+    def resolve(self, args):
+        addresses = []
         for arg in args.host:
             obj = self.traverse(arg)
             if ICompute.providedBy(obj):
-                address = obj.hostname.encode('utf-8')
+                addresses.append(obj.hostname.encode('utf-8'))
             else:
-                address = arg
-            res = ping(address)
-            self.write("%s is %s\n" % (address, ["unreachable", "alive"][res]))
+                addresses.append(arg)
+        return addresses
+
+    def format_result(self, address, delays):
+        rtts = RttBuffer(len(delays))
+        for delay in delays:
+            rtts.add(delay)
+        stats = rtts.stats(len(delays))
+        received = len(delays) - delays.count(None)
+
+        if not received:
+            return "%s is unreachable (0/%s received)\n" % (address, len(delays))
+        return ("%s is alive (%s/%s received, rtt min/avg/max/mdev = %.3f/%.3f/%.3f/%.3f ms)\n" %
+                (address, received, len(delays), stats['min'], stats['avg'], stats['max'], stats['mdev']))
+
+    @defer.inlineCallbacks
+    def execute(self, args):
+        if args.count < 1:
+            self.write("Count must be at least 1\n")
+            return
+
+        addresses = yield self.resolve(args)
+        alive = []
+
+        def done(delays, address):
+            if any(delay is not None for delay in delays):
+                alive.append(address)
+            if not args.summary:
+                self.write(self.format_result(address, delays))
+
+        def failed(failure, address):
+            if not args.summary:
+                self.write("%s: %s\n" % (address, failure.getErrorMessage()))
+
+        # all hosts are pinged at once, results are printed as they arrive
+        yield defer.DeferredList([async_ping(address, timeout=args.timeout, count=args.count)
+                                  .addCallbacks(done, failed, callbackArgs=(address,), errbackArgs=(address,))
+                                  for address in addresses])
+
+        self.write("%s hosts, %s alive, %s unreachable\n" % (len(addresses), len(alive),
+                                                             len(addresses) - len(alive)))
 
 
 for cmd in [PingCmd]:
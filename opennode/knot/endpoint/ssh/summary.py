@@ -0,0 +1,45 @@
+from grokcore.component import implements
+from zope.component import provideSubscriptionAdapter
+
+from opennode.knot.model.computes import Computes
+from opennode.oms.endpoint.ssh.cmd.base import Cmd
+from opennode.oms.endpoint.ssh.cmd.completers import PathCompleter
+from opennode.oms.endpoint.ssh.cmd.directives import command
+from opennode.oms.endpoint.ssh.cmdline import ICmdArgumentsSyntax, VirtualConsoleArgumentParser
+from opennode.oms.model.traversal import canonical_path
+from opennode.oms.zodb import db
+
+
+class SummaryCmd(Cmd):
+    """Lists the computes of a container from the compute catalog, without loading the computes"""
+    implements(ICmdArgumentsSyntax)
+    command('summary')
+
+    def arguments(self):
+        parser = VirtualConsoleArgumentParser()
+        parser.add_argument('path', nargs='?', default='.', help="Container of the computes")
+        parser.add_argument('-u', '--owner', help="List only the computes of this user")
+        parser.add_argument('-s', '--state', help="List only the computes in this state")
+        return parser
+
+    @db.ro_transact
+    def execute(self, args):
+        container = self.traverse(args.path)
+        if container is None:
+            self.write("No such object: %s\n" % args.path)
+            return
+
+        catalog = db.get_root()['oms_root']['computes'].catalog
+        criteria = dict((k, v) for k, v in (('owner', args.owner), ('state', args.state)) if v)
+        if not isinstance(container, Computes):
+            criteria['container'] = canonical_path(container)
+
+        records = catalog.summarize(**criteria)
+        if self.protocol.interaction:
+            records = catalog.viewable(self.protocol.interaction, records)
+        for record in records:
+            self.write("%s\t%s\t%s\t%s\t%s\n" % (record['id'], record['hostname'], record['state'],
+                                                 record['ipv4_address'], record['owner']))
+
+
+provideSubscriptionAdapter(PathCompleter, adapts=(SummaryCmd, ))
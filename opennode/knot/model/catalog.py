@@ -0,0 +1,223 @@
+"""Secondary indexes of the computes, for the lookups which would otherwise scan /computes."""
+from __future__ import absolute_import
+
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from grokcore.component import subscribe
+from persistent import Persistent
+from zope.securitypolicy.interfaces import IPrincipalRoleMap
+
+from opennode.knot.model.compute import ICompute, IVirtualCompute
+from opennode.knot.model.compute import IDeployed, IDeploying, IUndeployed
+from opennode.oms.model.model.events import IModelModifiedEvent, IOwnerChangedEvent
+from opennode.oms.model.traversal import canonical_path, traverse1
+
+
+def compute_owner(compute):
+    owner = compute.__owner__
+    return getattr(owner, 'id', owner)
+
+
+def compute_ipv4(compute):
+    return compute.ipv4_address.split('/')[0] if compute.ipv4_address else None
+
+
+def compute_ipv6(compute):
+    ip = (getattr(compute, 'ipv6_address', None) or u'').split('/')[0]
+    return ip if ip not in (u'', u'::') else None
+
+
+def compute_backends(compute):
+    """The backend of the virtualization container of a VM, all the backends of a hypervisor"""
+    if IVirtualCompute.providedBy(compute):
+        return (getattr(compute.__parent__, 'backend', None),)
+
+    # break an import cycle
+    from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
+    return tuple(c.backend for c in compute.listcontent() if IVirtualizationContainer.providedBy(c))
+
+
+def compute_container(compute):
+    return canonical_path(compute.__parent__) if compute.__parent__ is not None else None
+
+
+def compute_has_acl(compute):
+    """Whether the compute has ACL entries of its own (e.g. denying what its container allows), or doesn't
+    inherit the permissions of its container"""
+    if not getattr(compute, 'inherit_permissions', True):
+        return True
+    prinrole = IPrincipalRoleMap(compute, None)
+    return prinrole is not None and bool(prinrole.getPrincipalsAndRoles())
+
+
+def compute_deployment(compute):
+    for marker, value in ((IDeployed, u'deployed'), (IDeploying, u'deploying'), (IUndeployed, u'undeployed')):
+        if marker.providedBy(compute):
+            return value
+
+
+# index name -> function returning the indexed value, or a tuple of values, of a compute
+INDEXES = {'owner': compute_owner,
+           'state': lambda c: c.state,
+           'hostname': lambda c: c.hostname,
+           'ipv4': compute_ipv4,
+           'ipv6': compute_ipv6,
+           'backend': compute_backends,
+           'deployment': compute_deployment,
+           'virtual': lambda c: IVirtualCompute.providedBy(c),
+           'container': compute_container,
+           'acl': compute_has_acl}
+
+
+def compute_summary(compute):
+    """The fields of a compute shown by the list views"""
+    return {'id': compute.__name__,
+            'hostname': compute.hostname,
+            'state': compute.state,
+            'ipv4_address': compute.ipv4_address,
+            'owner': compute_owner(compute),
+            'template': getattr(compute, 'template', None),
+            'virtual': IVirtualCompute.providedBy(compute),
+            'deployment': compute_deployment(compute)}
+
+
+class ComputeCatalog(Persistent):
+    """Indexes the computes of /computes by owner, state, hostname, IPv4 and IPv6 address, backend,
+    deployment marker, kind (VM or hypervisor), the path of their container and whether they have their own
+    ACL.
+
+    A small summary record of every compute is kept along with the indexes, so that the list views don't
+    need to load the computes and their sub-containers.
+
+    Kept current by `Computes.index` and `Computes.unindex` and by the model modification events; the code
+    changing the indexed values with events suppressed (e.g. the syncs and the deployment markers) calls
+    `Computes.index` explicitly.
+
+    """
+
+    def __init__(self):
+        # index name -> value -> set of compute __name__s
+        self.indexes = OOBTree()
+        for name in INDEXES:
+            self.indexes[name] = OOBTree()
+        # compute __name__ -> {index name: values}
+        self.entries = OOBTree()
+        # compute __name__ -> summary record
+        self.summaries = OOBTree()
+
+    def outdated(self):
+        """Returns whether the catalog was built by an older version with different indexes"""
+        return getattr(self, 'summaries', None) is None or set(self.indexes.keys()) != set(INDEXES)
+
+    def values(self, compute):
+        res = {}
+        for name, getter in INDEXES.iteritems():
+            value = getter(compute)
+            res[name] = tuple(v for v in value if v is not None) if isinstance(value, tuple) else (
+                (value,) if value is not None else ())
+        return res
+
+    def index(self, compute):
+        values = self.values(compute)
+        summary = compute_summary(compute)
+        if self.entries.get(compute.__name__) == values:
+            if self.summaries.get(compute.__name__) != summary:
+                self.summaries[compute.__name__] = summary
+            return
+
+        self.unindex(compute.__name__)
+        self.summaries[compute.__name__] = summary
+        for name, keys in values.iteritems():
+            index = self.indexes[name]
+            for key in keys:
+                if key not in index:
+                    index[key] = OOTreeSet()
+                index[key].insert(compute.__name__)
+        self.entries[compute.__name__] = values
+
+    def unindex(self, name):
+        self.summaries.pop(name, None)
+        values = self.entries.pop(name, None)
+        if values is None:
+            return
+
+        for index_name, keys in values.iteritems():
+            index = self.indexes[index_name]
+            for key in keys:
+                names = index.get(key)
+                if names is not None and name in names:
+                    names.remove(name)
+                    if not names:
+                        del index[key]
+
+    def reindex(self, computes):
+        """Rebuilds the indexes from `computes`. Returns the number of indexed computes."""
+        self.__init__()
+        for compute in computes:
+            self.index(compute)
+        return len(self.entries)
+
+    def keys(self, index):
+        """Returns the distinct values of `index`"""
+        return self.indexes[index].keys()
+
+    def query(self, **criteria):
+        """Returns the __name__s of the computes matching all `criteria`, e.g.
+        query(owner='john', virtual=True, deployment=u'deployed')"""
+        res = None
+        for name, value in sorted(criteria.iteritems(), key=lambda (n, v): len(self.indexes[n].get(v, ()))):
+            names = self.indexes[name].get(value)
+            if not names:
+                return set()
+            res = set(names) if res is None else res.intersection(names)
+            if not res:
+                break
+        return res if res is not None else set(self.entries.keys())
+
+    def summarize(self, **criteria):
+        """Returns the summary records of the computes matching all `criteria`, ordered by hostname"""
+        return sorted((self.summaries[name] for name in self.query(**criteria) if name in self.summaries),
+                      key=lambda record: record['hostname'])
+
+    def viewable(self, interaction, records):
+        """Returns the summary `records` of the computes the principal of `interaction` may view.
+
+        The 'view' permission is checked once per container of the computes. The computes are loaded to check
+        their own permissions only if they have their own ACL, or if the principal may not view their
+        container (e.g. to check ownership).
+
+        """
+        containers = {}
+        res = []
+        for record in records:
+            entry = self.entries.get(record['id'], {})
+            path = (entry.get('container') or (None,))[0]
+            if path not in containers:
+                container = self._traverse(path) if path is not None else None
+                containers[path] = container is not None and interaction.checkPermission('view', container)
+            if not containers[path] or entry.get('acl') != (False,):
+                compute = self._compute(record['id'])
+                if compute is None or not interaction.checkPermission('view', compute):
+                    continue
+            res.append(record)
+        return res
+
+    def _traverse(self, path):
+        return traverse1(path)
+
+    def _compute(self, name):
+        from opennode.oms.zodb import db
+        link = db.get_root()['oms_root']['computes']._items.get(name)
+        return link.target if link is not None else None
+
+
+@subscribe(ICompute, IModelModifiedEvent)
+def catalog_modified_compute(model, event):
+    from opennode.oms.zodb import db
+    from opennode.knot.model.computes import in_machines
+    if in_machines(model):
+        db.get_root()['oms_root']['computes'].catalog_index(model)
+
+
+@subscribe(ICompute, IOwnerChangedEvent)
+def catalog_owner_changed(model, event):
+    catalog_modified_compute(model, event)
@@ -1,26 +1,32 @@
 from __future__ import absolute_import
 import logging
+import threading
+import time
 
-from grokcore.component import context
+from grokcore.component import context, subscribe
 from grokcore.component import Adapter, implements
 from zope import schema
 from zope.component import provideSubscriptionAdapter, provideAdapter
 from zope.interface import Interface
 
 import netaddr
+from persistent import Persistent
 
 from opennode.knot.model.common import IInVirtualizationContainer
 from opennode.knot.model.console import Consoles
 from opennode.knot.model.network import NetworkInterfaces, NetworkRoutes
 from opennode.knot.model.template import Templates
 from opennode.knot.model.zabbix import IZabbixConfiguration
+from opennode.knot.utils.cidr import compile_tags
+from opennode.knot.utils.pinghistory import ping_history
 from opennode.oms.config import get_config
 from opennode.oms.model.location import ILocation
 from opennode.oms.model.form import alsoProvides
 from opennode.oms.model.model.actions import ActionsContainerExtension
-from opennode.oms.model.model.base import Container
+from opennode.oms.model.model.base import Container, ReadonlyContainer
 from opennode.oms.model.model.base import IMarkable, IDisplayName
 from opennode.oms.model.model.base import require_admins
+from opennode.oms.model.model.events import IModelDeletedEvent
 from opennode.oms.model.model.search import ModelTags
 from opennode.oms.model.model.stream import MetricsContainerExtension, IMetrics
 from opennode.oms.model.schema import Path, RestrictedHostname
@@ -139,6 +145,20 @@ class ICompute(Interface):
     failure = schema.Bool(title=u'Availability failure', required=False,
                           readonly=True, default=False)
 
+    health = schema.Choice(title=u'Health', values=(u'unknown', u'up', u'suspect', u'down'),
+                           description=u'Health state published by the failure detector',
+                           required=False, readonly=True, default=u'unknown')
+
+    ping_rtt = schema.Tuple(
+        title=u"Ping RTT", description=u"Ping round trip time min, avg, max and mdev in ms (shortest window)",
+        value_type=schema.Float(), required=False, readonly=True)
+    ping_loss = schema.Float(
+        title=u"Ping loss", description=u"Ping packet loss in % (shortest window)",
+        required=False, readonly=True)
+    ping_stats = schema.Dict(
+        title=u"Ping statistics", description=u"Ping round trip time and loss per window in seconds",
+        required=False, readonly=True)
+
     agent_version = schema.TextLine(title=u'Agent version', required=False,
                                     readonly=True, default=u'')
 
@@ -180,6 +200,80 @@ class IDeploying(Interface):
     """Marker interface implemented when the compute has a deploy operation in progress."""
 
 
+class DetachedSubcontainer(ReadonlyContainer):
+    """Empty stand-in for a sub-container missing from a compute created by an older version.
+
+    Reading it never writes. Adding an item to it adds the missing sub-containers to the compute first (see
+    `Compute.ensure_subcontainers`) and the item to the actual sub-container, so that writes are not lost.
+
+    """
+
+    def __init__(self, name, parent, factory):
+        self.__name__ = name
+        self.__parent__ = parent
+        self.__contains__ = factory.__contains__
+
+    @property
+    def _items(self):
+        return {}
+
+    def _attached(self):
+        self.__parent__.ensure_subcontainers()
+        return self.__parent__._items[self.__name__]
+
+    def add(self, item):
+        return self._attached().add(item)
+
+    def _add(self, item):
+        return self._attached()._add(item)
+
+    def __setitem__(self, key, item):
+        self._attached()[key] = item
+
+
+class ComputeState(Persistent):
+    """The state of a compute observed by the daemons (sync, ping checks, failure detection), kept in a
+    record of its own so that updating it doesn't conflict with the user-edited configuration of the compute.
+
+    Concurrent updates of different fields are merged; when both transactions changed the same field, the
+    value of the transaction resolving the conflict, i.e. the one committing last, wins.
+
+    """
+
+    def _p_resolveConflict(self, old, committed, new):
+        res = dict(committed)
+        for name, value in new.iteritems():
+            if name not in old or old[name] != value:
+                res[name] = value
+        return res
+
+
+_missing = object()
+
+
+class state_field(object):
+    """A `Compute` attribute stored in its `ComputeState` record. Assigning an unchanged value doesn't
+    write; the first assignment on a compute created by an older version moves the legacy values of all the
+    state fields from the compute to the new record."""
+
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self.default
+        state = getattr(obj, '_state', None)
+        if state is None:
+            return obj.__dict__.get(self.name, self.default)
+        return getattr(state, self.name, self.default)
+
+    def __set__(self, obj, value):
+        state = obj.ensure_state()[1]
+        if getattr(state, self.name, _missing) != value:
+            setattr(state, self.name, value)
+
+
 class Compute(Container):
     """A compute node."""
 
@@ -233,32 +327,32 @@ class Compute(Container):
 
     os_release = u"build 35"
     kernel = u"unknown"
-    last_ping = False
-    pingcheck = []
-    suspicious = False
-    failure = False
+    last_ping = state_field('last_ping', False)
+    suspicious = state_field('suspicious', False)
+    failure = state_field('failure', False)
+    health = state_field('health', u'unknown')
 
     num_cores = 1
     memory = 2048,
     network = 12.5 * M  # bytes
-    diskspace = {
+    diskspace = state_field('diskspace', {
         u'total': 2000.0,
         u'/': 500.0,
         u'/boot': 100.0,
         u'/storage': 1000.0,
-    }
+    })
     swap_size = 4192
 
     # empty values for metrics
-    uptime = None
-    cpu_usage = (0.0, 0.0, 0.0)
-    memory_usage = 0.0
-    network_usage = (0.0, 0.0)
-    diskspace_usage = {
+    uptime = state_field('uptime', None)
+    cpu_usage = state_field('cpu_usage', (0.0, 0.0, 0.0))
+    memory_usage = state_field('memory_usage', 0.0)
+    network_usage = state_field('network_usage', (0.0, 0.0))
+    diskspace_usage = state_field('diskspace_usage', {
         u'root': 0.0,
         u'boot': 0.0,
         u'storage': 0.0,
-    }
+    })
 
     cpu_limit = 1.0
 
@@ -279,6 +373,9 @@ class Compute(Container):
 
     notify_admin = False
 
+    # see `ComputeState`, None on computes created by older versions until upgraded
+    _state = None
+
     def __init__(self, hostname, state=None, memory=None, template=None, ipv4_address=None, mgt_stack=None):
         super(Compute, self).__init__()
 
@@ -296,6 +393,9 @@ class Compute(Container):
         elif self._mgt_stack:
             alsoProvides(self, self._mgt_stack)
 
+        self.ensure_subcontainers()
+        self.ensure_state()
+
         assert self.hostname
 
     def display_name(self):
@@ -329,13 +429,73 @@ class Compute(Container):
 
     ctid = property(get_ctid, set_ctid)
 
+    @property
+    def pingcheck(self):
+        """Ping history is kept in memory only, see `opennode.knot.utils.pinghistory`"""
+        history = ping_history.get(self.__name__)
+        return history.to_list() if history is not None else []
+
+    @property
+    def ping_stats(self):
+        history = ping_history.get(self.__name__)
+        return history.window_stats() if history is not None else {}
+
+    @property
+    def ping_rtt(self):
+        history = ping_history.get(self.__name__)
+        return history.summary()[0] if history is not None else None
+
+    @property
+    def ping_loss(self):
+        history = ping_history.get(self.__name__)
+        return history.summary()[1] if history is not None else None
+
     def __str__(self):
         return 'compute%s' % self.__name__
 
+    # name and factory of the sub-containers created with the compute
+    _subcontainers = (('consoles', Consoles),
+                      ('interfaces', NetworkInterfaces),
+                      ('routes', NetworkRoutes),
+                      ('templates', Templates))
+
+    def ensure_subcontainers(self):
+        """Adds the missing sub-containers, e.g. of computes created by older versions. Returns whether any
+        was added."""
+        added = False
+        for name, factory in self._subcontainers:
+            if name not in self._items:
+                container = factory()
+                container.__name__ = name
+                self._add(container)
+                added = True
+        return added
+
+    def ensure_state(self):
+        """Creates the `ComputeState` record, moving into it the legacy values stored on computes created
+        by older versions. Returns whether it was created, and the record."""
+        state = getattr(self, '_state', None)
+        if state is not None:
+            return False, state
+
+        state = ComputeState()
+        for name in self._state_fields:
+            if name in self.__dict__:
+                setattr(state, name, self.__dict__.pop(name))
+        self._p_changed = True
+        self._state = state
+        return True, state
+
+    def _subcontainer(self, name):
+        """Returns the sub-container `name`. Reading never writes: until `ensure_subcontainers` upgrades an
+        old compute, a `DetachedSubcontainer` stands in for a missing sub-container."""
+        container = self._items.get(name)
+        if container is None:
+            container = DetachedSubcontainer(name, self, dict(self._subcontainers)[name])
+        return container
+
     def get_consoles(self):
-        if 'consoles' not in self._items:
-            self._add(Consoles())
-        return self._items['consoles']
+        return self._subcontainer('consoles')
 
     def set_consoles(self, value):
         if 'consoles' in self._items:
@@ -346,21 +506,10 @@ class Compute(Container):
 
     @property
     def templates(self):
-        from opennode.oms.zodb import db
-
-        @db.assert_transact
-        def do_it():
-            if not self['templates']:
-                templates = Templates()
-                templates.__name__ = 'templates'
-                self._add(templates)
-            return self['templates']
-        return do_it()
+        return self._subcontainer('templates')
 
     def get_interfaces(self):
-        if 'interfaces' not in self._items:
-            self._add(NetworkInterfaces())
-        return self._items['interfaces']
+        return self._subcontainer('interfaces')
 
     def set_interfaces(self, value):
         if 'interfaces' in self._items:
@@ -370,9 +519,7 @@ class Compute(Container):
     interfaces = property(get_interfaces, set_interfaces)
 
     def get_routes(self):
-        if 'routes' not in self._items:
-            self._add(NetworkRoutes())
-        return self._items['routes']
+        return self._subcontainer('routes')
 
     def set_routes(self, value):
         if 'routes' in self._items:
@@ -412,36 +559,94 @@ class Compute(Container):
         log.info('%s changed owner to: %s', self.__name__, principal)
 
 
+Compute._state_fields = tuple(name for name, field in vars(Compute).items() if isinstance(field, state_field))
+
+
+class NetenvTags(object):
+    """The `[netenv-tags]` config section compiled into a `CidrTrie`.
+
+    The section is re-read at most every `refresh` seconds and compiled again only when it changed, which
+    bumps `generation`.
+
+    """
+
+    def __init__(self, refresh=60):
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._checked = None
+        self._items = None
+        self.trie = compile_tags(())
+        self.generation = 0
+
+    def get(self):
+        """Returns the current trie and its generation"""
+        now = time.time()
+        with self._lock:
+            if self._checked is None or now - self._checked >= self.refresh:
+                self._checked = now
+                config = get_config()
+                items = tuple(config.items('netenv-tags')) if config.has_section('netenv-tags') else ()
+                if items != self._items:
+                    self._items = items
+                    self.trie = compile_tags(items)
+                    self.generation += 1
+            return self.trie, self.generation
+
+
+netenv_tags = NetenvTags()
+
+# compute __name__ -> (inputs, auto tags)
+_auto_tags_cache = {}
+
+
 class ComputeTags(ModelTags):
     context(Compute)
 
     def auto_tags(self):
-        res = [u'state:' + self.context.state] if self.context.state else []
-        if self.context.architecture:
-            for i in self.context.architecture:
+        trie, generation = netenv_tags.get()
+        p = sudo(self.context)
+        parent = p.__parent__
+        inputs = (generation, p.ipv4_address, p.state, p.architecture, IVirtualCompute.providedBy(p),
+                  getattr(parent, '_p_oid', None) or id(parent))
+
+        cached = _auto_tags_cache.get(p.__name__)
+        if cached is not None and cached[0] == inputs:
+            return list(cached[1])
+
+        res = [u'state:' + p.state] if p.state else []
+        if p.architecture:
+            for i in p.architecture:
                 res.append(u'arch:' + i)
 
         from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
-        p = sudo(self.context)
         if (IVirtualCompute.providedBy(p) and
-                IVirtualizationContainer.providedBy(p.__parent__)):
-            res.append(u'virt_type:' + p.__parent__.backend)
+                IVirtualizationContainer.providedBy(parent)):
+            res.append(u'virt_type:' + parent.backend)
             res.append(u'virt:yes')
         else:
             res.append(u'virt:no')
 
-        config = get_config()
-        if config.has_section('netenv-tags'):
-            for tag, nets in config.items('netenv-tags'):
-                try:
-                    if (self.context.ipv4_address is not None and
-                        len(netaddr.all_matching_cidrs(self.context.ipv4_address.split('/')[0],
-                                                       nets.split(','))) > 0):
-                        res.append(u'env:' + tag)
-                except ValueError:
-                    # graceful ignoring of incorrect ips
-                    pass
-        return res
+        if p.ipv4_address is not None:
+            try:
+                res.extend(sorted(u'env:' + tag for tag in trie.match(p.ipv4_address.split('/')[0])))
+            except (ValueError, netaddr.AddrFormatError):
+                # graceful ignoring of incorrect ips
+                pass
+
+        _auto_tags_cache[p.__name__] = (inputs, res)
+        return list(res)
+
+
+@subscribe(ICompute, IModelDeletedEvent)
+def forget_auto_tags(model, event):
+    _auto_tags_cache.pop(model.__name__, None)
+
+
+@subscribe(ICompute, IModelDeletedEvent)
+def unindex_deleted_compute_templates(model, event):
+    # the templates of a deleted hypervisor don't get their own deletion events
+    from opennode.oms.zodb import db
+    db.get_root()['oms_root']['templates'].unindex_host(model.__name__)
 
 
 class VirtualComputeLocation(Adapter):
@@ -452,7 +657,8 @@ class VirtualComputeLocation(Adapter):
         return '/computes/%s/' % (self.context.__name__)
 
 
-provideAdapter(adapter_value(['cpu_usage', 'memory_usage', 'network_usage', 'diskspace_usage']),
+provideAdapter(adapter_value(['cpu_usage', 'memory_usage', 'network_usage', 'diskspace_usage',
+                              'ping_rtt', 'ping_loss']),
                adapts=(Compute, ), provides=IMetrics)
 
 
@@ -1,17 +1,21 @@
 from __future__ import absolute_import
 
-from grokcore.component import context
-import logging
+import threading
+
+from BTrees.OOBTree import OOBTree
+from grokcore.component import context, subscribe
 from types import GeneratorType
-from twisted.python import log
 from zope.component import provideSubscriptionAdapter
 
 from opennode.knot.model.compute import Compute, ICompute, IVirtualCompute
+from opennode.knot.model.catalog import ComputeCatalog
+from opennode.knot.model.ctid import CtidAllocator
 from opennode.knot.model.hangar import IHangar
 
 from opennode.oms.model.model.base import AddingContainer, ReadonlyContainer
 from opennode.oms.model.model.base import ContainerInjector
 from opennode.oms.model.model.byname import ByNameContainerExtension
+from opennode.oms.model.model.events import IModelCreatedEvent, IModelDeletedEvent, IModelMovedEvent
 from opennode.oms.model.model.proc import ITask
 from opennode.oms.model.model.root import OmsRoot
 from opennode.oms.model.model.symlink import Symlink
@@ -19,16 +23,74 @@ from opennode.oms.zodb import db
 
 
 class Computes(AddingContainer):
+    """All the computes under /machines, at any depth.
+
+    The computes are served from a persistent BTree of name -> `Symlink`, maintained by the model events
+    (see `index_compute` below) and rebuilt with the `reindex` command. Until the index is first built, the
+    machines tree is walked on every access.
+
+    """
     __contains__ = IVirtualCompute
     __name__ = 'computes'
 
+    _index = None
+    # secondary indexes, see `opennode.knot.model.catalog`
+    _catalog = None
+    # OpenVZ CTID allocator, see `opennode.knot.model.ctid`
+    _ctids = None
+
     def __str__(self):
         return 'Compute list'
 
+    @property
+    def catalog(self):
+        """Returns the secondary indexes of the computes. Until the startup upgrade has built them (see
+        `upgrade_catalog`), a transient catalog is built from the machines tree on every access."""
+        if self._catalog is None or self._catalog.outdated():
+            catalog = ComputeCatalog()
+            catalog.reindex(self._collect().itervalues())
+            return catalog
+        return self._catalog
+
+    @db.assert_transact
+    def build_catalog(self):
+        """Rebuilds the catalog from the machines tree. Returns the number of cataloged computes."""
+        self._catalog = ComputeCatalog()
+        return self._catalog.reindex(self._collect().itervalues())
+
+    @db.assert_transact
+    def upgrade_catalog(self):
+        """Builds the catalog if it is missing or was built by an older version with different indexes.
+        Returns the number of cataloged computes, 0 if the catalog was current."""
+        if self._catalog is None or self._catalog.outdated():
+            return self.build_catalog()
+        return 0
+
+    def search(self, **criteria):
+        """Returns the computes matching all `criteria`, see `ComputeCatalog.query`"""
+        res = []
+        for name in self.catalog.query(**criteria):
+            link = self._items.get(name)
+            if link is not None:
+                res.append(link.target)
+        return res
+
+    @property
+    def ctids(self):
+        """Returns the OpenVZ CTID allocator, seeding it from the machines tree when first used"""
+        if self._ctids is None:
+            self._ctids = CtidAllocator()
+            self._ctids.reseed(self._collect().itervalues())
+        return self._ctids
+
     @property
     def _items(self):
-        machines = db.get_root()['oms_root']['machines']
+        if self._index is not None:
+            return self._index
+        return dict((name, Symlink(name, compute)) for name, compute in self._collect().iteritems())
 
+    def _collect(self, container=None):
+        """Returns all the computes under `container` (/machines by default) by name"""
         computes = {}
 
         def allowed_classes_gen(item):
@@ -44,16 +106,66 @@ class Computes(AddingContainer):
             seen = set()
             for item in container.listcontent():
                 if ICompute.providedBy(item):
-                    computes[item.__name__] = Symlink(item.__name__, item)
+                    computes[item.__name__] = item
 
                 if any(allowed_classes_gen(item)):
                     if item.__name__ not in seen:
                         seen.add(item.__name__)
                         collect(item)
 
-        collect(machines)
+        collect(container if container is not None else db.get_root()['oms_root']['machines'])
         return computes
 
+    def _symlink(self, compute):
+        link = Symlink(compute.__name__, compute)
+        link.__parent__ = self
+        return link
+
+    @db.assert_transact
+    def reindex(self):
+        """Rebuilds the index from the machines tree. Returns the number of indexed computes."""
+        index = OOBTree()
+        for name, compute in self._collect().iteritems():
+            index[name] = self._symlink(compute)
+        self._index = index
+        return len(index)
+
+    @db.assert_transact
+    def index(self, compute):
+        if self._index is None:
+            self.reindex()
+        if ICompute.providedBy(compute) and in_machines(compute):
+            link = self._index.get(compute.__name__)
+            if link is None or link.target is not compute:
+                self._index[compute.__name__] = self._symlink(compute)
+            self.catalog_index(compute)
+
+    def catalog_index(self, compute):
+        """Updates the catalog entry of `compute`; a catalog not built yet is left to the startup upgrade"""
+        if self._catalog is not None and not self._catalog.outdated():
+            self._catalog.index(compute)
+
+    @db.assert_transact
+    def unindex(self, compute):
+        """Removes `compute` and the computes nested in it (e.g. the VMs of a hypervisor) from the index"""
+        if self._index is None:
+            return
+        names = [compute.__name__] + self._collect(compute).keys()
+        for name in names:
+            link = self._index.get(name)
+            # a compute with the same name may have been moved elsewhere
+            if link is not None and (name != compute.__name__ or link.target is compute):
+                del self._index[name]
+                if self._catalog is not None:
+                    self._catalog.unindex(name)
+
+    @db.assert_transact
+    def upgrade(self):
+        """Adds the sub-containers and the state record missing from the computes created by older versions.
+        Returns the number of upgraded computes."""
+        return len([c for c in self._collect().itervalues()
+                    if c.ensure_subcontainers() | c.ensure_state()[0]])
+
     def _add(self, item):
         machines = db.get_root()['oms_root']['machines']
         # TODO: fix adding computes to vms instead of hangar
@@ -65,6 +177,31 @@ class Computes(AddingContainer):
         item = self._items[key]
         if isinstance(item, Symlink):
             del item.target.__parent__[item.target.__name__]
+            self.unindex(item.target)
+
+
+def in_machines(model):
+    machines = db.get_root()['oms_root']['machines']
+    while model is not None:
+        if model is machines:
+            return True
+        model = model.__parent__
+    return False
+
+
+@subscribe(ICompute, IModelCreatedEvent)
+def index_created_compute(model, event):
+    db.get_root()['oms_root']['computes'].index(model)
+
+
+@subscribe(ICompute, IModelMovedEvent)
+def index_moved_compute(model, event):
+    db.get_root()['oms_root']['computes'].index(model)
+
+
+@subscribe(ICompute, IModelDeletedEvent)
+def unindex_deleted_compute(model, event):
+    db.get_root()['oms_root']['computes'].unindex(model)
 
 
 class ComputesRootInjector(ContainerInjector):
@@ -72,6 +209,65 @@ class ComputesRootInjector(ContainerInjector):
     __class__ = Computes
 
 
+class TaskSubjectIndex(object):
+    """In-memory index of the running tasks by the __name__ of their subjects.
+
+    Maintained by the creation and deletion events of the tasks (see `index_created_task` below), only the
+    subjects of the task being registered or unregistered are looked at.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # task name -> subject names
+        self._tasks = {}
+        # subject name -> {task name: task}
+        self._by_subject = {}
+
+    def add(self, task):
+        # Cmd.subject() implemented incorrectly (must not return a generator)
+        # XXX: for some reason, when I let subject stick to a generator instance,
+        # I get an empty generator here, while it magically works when I save
+        # it as a tuple under item.subject
+        assert not isinstance(task.subject, GeneratorType)
+
+        subjects = set(s.__name__ for s in task.subject) if isinstance(task.subject, tuple) else set()
+        with self._lock:
+            self._remove(task.__name__)
+            self._tasks[task.__name__] = subjects
+            for subject in subjects:
+                self._by_subject.setdefault(subject, {})[task.__name__] = task
+
+    def remove(self, task):
+        with self._lock:
+            self._remove(task.__name__)
+
+    def _remove(self, name):
+        for subject in self._tasks.pop(name, ()):
+            subject_tasks = self._by_subject.get(subject, {})
+            subject_tasks.pop(name, None)
+            if not subject_tasks:
+                self._by_subject.pop(subject, None)
+
+    def tasks_of(self, subject):
+        """Returns the running tasks of the object named `subject` by task name"""
+        with self._lock:
+            return dict(self._by_subject.get(subject, {}))
+
+
+task_index = TaskSubjectIndex()
+
+
+@subscribe(ITask, IModelCreatedEvent)
+def index_created_task(model, event):
+    task_index.add(model)
+
+
+@subscribe(ITask, IModelDeletedEvent)
+def unindex_deleted_task(model, event):
+    task_index.remove(model)
+
+
 class ComputeTasks(ReadonlyContainer):
     context(Compute)
     __contains__ = ITask
@@ -79,44 +275,8 @@ class ComputeTasks(ReadonlyContainer):
 
     @property
     def _items(self):
-        from opennode.oms.zodb import db
-        processes = db.get_root()['oms_root']['proc']
-        tasks = {}
-
-        def collect(container):
-            seen = set()
-            for item in container.listcontent():
-                name = item.__name__
-                if not ITask.providedBy(item):
-                    continue
-
-                # Cmd.subject() implemented incorrectly (must not return a generator)
-                # XXX: for some reason, when I let subject stick to a generator instance,
-                # I get an empty generator here, while it magically works when I save
-                # it as a tuple under item.subject
-                assert not isinstance(item.subject, GeneratorType)
-
-                iterable = isinstance(item.subject, tuple)
-
-                if iterable:
-                    log.msg('\t CMD: %s %s' % (item.__name__, item.cmdline),
-                            system='proc',
-                            logLevel=logging.DEBUG)
-                    for s in item.subject:
-                        log.msg('\t\tSUBJ: %s, %s' % (s.__name__ == self.__parent__.__name__,
-                                                      self.__parent__),
-                                system='proc',
-                                logLevel=logging.DEBUG)
-
-                if iterable and self.__parent__.__name__ in map(lambda s: s.__name__, item.subject):
-                    tasks[name] = Symlink(name, item)
-
-                if name not in seen:
-                    seen.add(name)
-                    collect(item)
-
-        collect(processes)
-        return tasks
+        return dict((name, Symlink(name, task))
+                    for name, task in task_index.tasks_of(self.__parent__.__name__).iteritems())
 
 
 class ComputeTasksInjector(ContainerInjector):
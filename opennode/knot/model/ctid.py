@@ -0,0 +1,145 @@
+"""Cluster-wide allocation of OpenVZ container IDs."""
+from __future__ import absolute_import
+
+import threading
+
+import transaction
+from BTrees.IOBTree import IOBTree
+from BTrees.IIBTree import IITreeSet
+from BTrees.OIBTree import OIBTree
+from grokcore.component import subscribe
+from persistent import Persistent
+
+from opennode.knot.model.compute import IVirtualCompute
+from opennode.oms.model.model.events import IModelDeletedEvent
+
+
+# CTIDs up to 100 are reserved by OpenVZ
+MIN_CTID = 101
+
+_lock = threading.Lock()
+# CTIDs handed out by this process which other transactions may not see yet
+_claimed = set()
+# highest CTID handed out by this process
+_high = [0]
+
+
+class CtidCounter(Persistent):
+    """Highest CTID allocated so far.
+
+    The allocator lock already guarantees that concurrent transactions hand out different CTIDs, so
+    conflicting updates are merged by keeping the highest value instead of retrying the transaction.
+
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def _p_resolveConflict(self, old, committed, new):
+        res = dict(new)
+        res['value'] = max(committed['value'], new['value'])
+        return res
+
+
+class CtidAllocator(Persistent):
+    """Hands out unique OpenVZ CTIDs in O(1): released CTIDs are reused first, then the counter is bumped.
+
+    `reserved` maps the CTIDs in use to the __name__ of the VM owning them, `owners` is its reverse.
+
+    """
+
+    def __init__(self, minimum=MIN_CTID):
+        self.minimum = minimum
+        self.counter = CtidCounter(minimum - 1)
+        self.free = IITreeSet()
+        self.reserved = IOBTree()
+        self.owners = OIBTree()
+
+    def get(self, owner):
+        return self.owners.get(owner)
+
+    def reserve(self, owner):
+        """Returns the CTID of the VM named `owner`, reserving a new one if it has none"""
+        with _lock:
+            ctid = self.owners.get(owner)
+            if ctid is not None:
+                return ctid
+
+            for candidate in self.free:
+                if candidate not in _claimed:
+                    ctid = candidate
+                    self.free.remove(ctid)
+                    break
+            else:
+                ctid = max(self.counter.value, _high[0]) + 1
+                while ctid in self.reserved:
+                    ctid += 1
+                self.counter.value = _high[0] = ctid
+
+            self._claim(ctid, owner)
+            return ctid
+
+    def release(self, owner):
+        """Returns the CTID of the VM named `owner` to the free-list. Returns the released CTID, if any."""
+        with _lock:
+            ctid = self.owners.get(owner)
+            if ctid is None:
+                return None
+            del self.owners[owner]
+            if self.reserved.get(ctid) == owner:
+                del self.reserved[ctid]
+                self.free.insert(ctid)
+            _claimed.discard(ctid)
+            return ctid
+
+    def observe(self, owner, ctid):
+        """Records the CTID a hypervisor reports for the VM named `owner`"""
+        if ctid is None or ctid < self.minimum:
+            return
+
+        with _lock:
+            current = self.owners.get(owner)
+            if current == ctid:
+                return
+            if current is not None and self.reserved.get(current) == owner:
+                # the hypervisor did not take our hint, the reserved CTID can be reused
+                del self.reserved[current]
+                self.free.insert(current)
+                _claimed.discard(current)
+
+            if ctid in self.free:
+                self.free.remove(ctid)
+            if ctid not in self.reserved:
+                self.reserved[ctid] = owner
+            self.owners[owner] = ctid
+            if ctid > self.counter.value:
+                self.counter.value = ctid
+
+    def reseed(self, computes):
+        """Rebuilds the reservations from the CTIDs of `computes`. Returns the number of reserved CTIDs."""
+        self.free = IITreeSet()
+        self.reserved = IOBTree()
+        self.owners = OIBTree()
+        for compute in computes:
+            self.observe(compute.__name__, compute.ctid)
+        return len(self.reserved)
+
+    def _claim(self, ctid, owner):
+        self.reserved[ctid] = owner
+        self.owners[owner] = ctid
+        _claimed.add(ctid)
+
+        def forget_aborted(success):
+            if not success:
+                with _lock:
+                    _claimed.discard(ctid)
+
+        transaction.get().addAfterCommitHook(forget_aborted)
+
+
+@subscribe(IVirtualCompute, IModelDeletedEvent)
+def release_deleted_ctid(model, event):
+    from opennode.oms.zodb import db
+    computes = db.get_root()['oms_root']['computes']
+    if computes._ctids is not None:
+        computes._ctids.release(model.__name__)
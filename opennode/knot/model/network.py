@@ -1,9 +1,16 @@
 from __future__ import absolute_import
 
+import random
+import threading
 import time
 import netaddr
+import transaction
 
-from grokcore.component import context
+from BTrees.LOBTree import LOBTree
+from BTrees.OOBTree import OOBTree
+from BTrees.Length import Length
+from grokcore.component import context, subscribe
+from persistent import Persistent
 from zope import schema
 from zope.annotation.interfaces import IAttributeAnnotatable
 from zope.component import provideSubscriptionAdapter
@@ -15,10 +22,37 @@ from twisted.python import log
 from opennode.oms.model.model.actions import ActionsContainerExtension
 from opennode.oms.model.model.base import ReadonlyContainer, Container, Model
 from opennode.oms.model.model.base import ContainerInjector
+from opennode.oms.model.model.events import IModelDeletedEvent, IModelModifiedEvent
 from opennode.oms.model.model.root import OmsRoot
 from opennode.oms.model.model.symlink import Symlink
 
 
+_lock = threading.Lock()
+# (IP version, IP) handed out by this process which other transactions may not see yet
+_claimed = set()
+
+
+class AbortHook(object):
+    """Transaction data manager with nothing to commit, calling `hook` if the transaction is aborted"""
+
+    def __init__(self, hook):
+        self.hook = hook
+
+    def abort(self, txn):
+        self.hook()
+
+    def tpc_abort(self, txn):
+        self.hook()
+
+    def tpc_begin(self, txn):
+        pass
+
+    commit = tpc_vote = tpc_finish = tpc_begin
+
+    def sortKey(self):
+        return 'opennode.knot.model.network.AbortHook:%s' % id(self)
+
+
 class INetworkInterface(Interface):
     name = schema.TextLine(title=u"Interface name", min_length=3)
     hw_address = schema.TextLine(title=u"MAC", min_length=17)
@@ -228,14 +262,265 @@ class IIPv4Pool(Interface):
     name = schema.TextLine(title=u'Pool name')
     minimum = IPAddressField(title=u'Minimum IP')
     maximum = IPAddressField(title=u'Maximum IP')
+    allocated = schema.Int(title=u'Allocated IPs', readonly=True, required=False)
+    capacity = schema.Int(title=u'Pool size', readonly=True, required=False)
+
+
+class IIPv6Pool(Interface):
+    name = schema.TextLine(title=u'Pool name')
+    minimum = IPAddressField(title=u'Minimum IP')
+    maximum = IPAddressField(title=u'Maximum IP')
+    mode = schema.Choice(title=u'Allocation mode', values=(u'sequential', u'eui64', u'random'),
+                         default=u'sequential',
+                         description=u'eui64 derives the interface ID from the MAC address of the VM, '
+                                     u'random picks random interface IDs')
+    allocated = schema.Int(title=u'Allocated IPs', readonly=True, required=False)
+
+
+class AddressRuns(Persistent):
+    """Set of integer addresses stored as runs of consecutive addresses: `runs` maps the first address of
+    every run to its last one. Membership, adding, removing and finding the first free address are single
+    BTree lookups, however many addresses are used.
+
+    Adding an address merges it with the adjacent runs. Concurrent additions next to each other, merged by
+    the BTree conflict resolution, may leave adjacent runs unmerged, which only costs an extra lookup.
+
+    """
+
+    _tree_factory = LOBTree
+
+    def __init__(self, addresses=()):
+        self.runs = self._tree_factory()
+        self.count = Length()
+        for address in addresses:
+            self.add(address)
+
+    def find(self, address):
+        """Returns the (first, last) run containing `address`, or None"""
+        try:
+            first = self.runs.maxKey(address)
+        except ValueError:
+            return None
+        last = self.runs[first]
+        return (first, last) if last >= address else None
+
+    def __contains__(self, address):
+        return self.find(address) is not None
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        for first, last in self.runs.items():
+            address = first
+            while address <= last:
+                yield address
+                address += 1
+
+    def add(self, address):
+        """Returns False if `address` was already in the set"""
+        if address in self:
+            return False
+        previous = self.find(address - 1)
+        first = previous[0] if previous else address
+        last = self.runs.pop(address + 1, address)
+        self.runs[first] = last
+        self.count.change(1)
+        return True
+
+    def remove(self, address):
+        """Returns False if `address` was not in the set"""
+        run = self.find(address)
+        if run is None:
+            return False
+        first, last = run
+        if first == address:
+            del self.runs[first]
+        else:
+            self.runs[first] = address - 1
+        if last > address:
+            self.runs[address + 1] = last
+        self.count.change(-1)
+        return True
+
+    def first_free(self, minimum, maximum):
+        """Returns the lowest address of [minimum .. maximum] which is not in the set, or None"""
+        address = minimum
+        run = self.find(address)
+        while run is not None:
+            address = run[1] + 1
+            run = self.find(address)
+        return address if address <= maximum else None
+
+
+class AddressRuns6(AddressRuns):
+    """`AddressRuns` of IPv6 addresses, which do not fit the 64 bit keys of a LOBTree"""
+    _tree_factory = OOBTree
+
+
+class PoolAddresses(object):
+    """Read-only mapping view of the used addresses of a pool, keyed by the integer address. Values are
+    `IPAddressStorable` objects created on access."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def _address(self, key):
+        try:
+            return int(netaddr.IPAddress(key))
+        except (ValueError, TypeError, netaddr.AddrFormatError):
+            return None
+
+    def __contains__(self, key):
+        address = self._address(key)
+        return address is not None and address in self.pool.addresses
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        address = self._address(key)
+        if address is None or address not in self.pool.addresses:
+            return default
+        return IPAddressStorable(self.pool, address)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __len__(self):
+        return len(self.pool.addresses)
+
+    def __iter__(self):
+        return iter(self.pool.addresses)
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self)
+
+    def itervalues(self):
+        for address in self.pool.addresses:
+            yield IPAddressStorable(self.pool, address)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for value in self.itervalues():
+            yield int(value), value
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class IPPool(Container):
+    """Range of IP addresses of which the used ones are tracked"""
+    __contains__ = netaddr.IPAddress
+
+    _runs_factory = AddressRuns
+
+    # used addresses, see `addresses`
+    _addresses = None
+    # addresses marked as used by hand, see `reservations`
+    _reservations = None
+    # whether the first reconciliation with the computes has reserved the used IPs without a compute, which
+    # older versions had no other way to keep
+    reservations_seeded = False
+
+    @property
+    def addresses(self):
+        """`AddressRuns` of the used IPs. Pools created by older versions stored an `IPAddressStorable`
+        per used IP in `_items`, those are converted on first access."""
+        if self._addresses is None:
+            self._addresses = self._runs_factory(int(ip) for ip in self.__dict__.pop('_items', {}))
+        return self._addresses
+
+    @property
+    def reservations(self):
+        """`AddressRuns` of the IPs marked as used by hand, which the reconciliation of the pools with the
+        computes never frees"""
+        if self._reservations is None:
+            self._reservations = self._runs_factory()
+        return self._reservations
+
+    def _get_items(self):
+        return PoolAddresses(self)
+
+    def _set_items(self, items):
+        self._addresses = self._runs_factory(int(ip) for ip in items)
+
+    _items = property(_get_items, _set_items)
+
+    @property
+    def allocated(self):
+        return len(self.addresses)
+
+    @property
+    def capacity(self):
+        return int(self.maximum) - int(self.minimum) + 1
+
+    def _available(self, ip):
+        return ip not in self.addresses and (self.minimum.version, ip) not in _claimed
+
+    def _first_free(self, minimum, maximum):
+        """Lowest free IP of [minimum .. maximum] not handed out by a concurrent transaction"""
+        ip = self.addresses.first_free(minimum, maximum)
+        while ip is not None and (self.minimum.version, ip) in _claimed:
+            ip = self.addresses.first_free(ip + 1, maximum)
+        return ip
+
+    def _use_allocated(self, ip):
+        """Marks an IP picked under the lock as used and claims it until the transaction ends, so that
+        concurrent deployments get distinct IPs instead of conflicting on the same one and retrying. Once
+        committed, the IP is used in the pool as seen by the later transactions."""
+        key = (self.minimum.version, ip)
+        _claimed.add(key)
+
+        def forget(*args):
+            with _lock:
+                _claimed.discard(key)
+
+        txn = transaction.get()
+        txn.addAfterCommitHook(forget)
+        # after-commit hooks don't run when the transaction is aborted instead
+        txn.join(AbortHook(forget))
+
+        ip = netaddr.IPAddress(ip, self.minimum.version)
+        log.msg('Allocating IP %s from the pool %s' % (ip, self), system='ippool')
+        self.use(ip)
+        return ip
+
+    def get(self, ip):
+        return self._items.get(int(ip))
+
+    def use(self, ip):
+        self.addresses.add(int(ip))
+
+    def reserve(self, ip):
+        self.use(ip)
+        self.reservations.add(int(ip))
+
+    def free(self, ip):
+        log.msg('Deallocating IP %s from the pool %s' % (ip, self), system='ippool')
+        with _lock:
+            _claimed.discard((self.minimum.version, int(ip)))
+        if self._reservations is not None:
+            self._reservations.remove(int(ip))
+        if not self.addresses.remove(int(ip)):
+            raise KeyError(ip)
+
+    def validate(self):
+        assert int(self.minimum) <= int(self.maximum),\
+                'Minimum IP value must be smaller or equal to max IP value'
 
 
 # NOTE: [minimum .. maximum] specifies a contiguous range of IP addresses.
 # It is up to the user to exclude any special IP addresses from the range
 # (gateway and broadcast addresses, for example).
-class IPv4Pool(Container):
+class IPv4Pool(IPPool):
     implements(IIPv4Pool)
-    __contains__ = netaddr.IPAddress
 
     def __init__(self, name='ippool', min_ip=0, max_ip=0xffffffff):
         super(IPv4Pool, self).__init__()
@@ -246,69 +531,193 @@ class IPv4Pool(Container):
         self.maximum = netaddr.IPAddress(max_ip)
 
     def allocate(self):
-        """ Search through the range to find first unallocated IP and mark it as used and return it"""
-        for ip in xrange(int(self.minimum), int(self.maximum)):
-            ip = netaddr.IPAddress(ip)
-            if int(ip) not in self._items:
-                log.msg('Allocating IP %s from the pool %s' % (ip, self), system='ippool')
-                self.use(ip)
-                return ip
+        """ Find the first unallocated IP of the range, mark it as used and return it"""
+        with _lock:
+            ip = self._first_free(int(self.minimum), int(self.maximum) - 1)
+            if ip is not None:
+                return self._use_allocated(ip)
 
-    def get(self, ip):
-        return self._items.get(int(ip))
+provideSubscriptionAdapter(ActionsContainerExtension, adapts=(IPv4Pool, ))
 
-    def use(self, ip):
-        self._items[int(ip)] = IPAddressStorable(self, int(ip))
 
-    def free(self, ip):
-        log.msg('Deallocating IP %s from the pool %s' % (ip, self), system='ippool')
-        del self._items[int(ip)]
+class IPv6Pool(IPPool):
+    """IPv6 range, typically one or more /64s. Used addresses are kept as runs, so allocation does not depend
+    on the size of the range."""
+    implements(IIPv6Pool)
 
-    def validate(self):
-        assert int(self.minimum) <= int(self.maximum),\
-                'Minimum IP value must be smaller or equal to max IP value'
+    _runs_factory = AddressRuns6
 
-provideSubscriptionAdapter(ActionsContainerExtension, adapts=(IPv4Pool, ))
+    # random interface IDs tried before falling back to the lowest free address
+    random_attempts = 16
 
-class IPv4Pools(Container):
-    __contains__ = IPv4Pool
-    __name__ = 'ippools'
+    # the all-zeros interface ID of every /64 is the Subnet-Router anycast address (RFC 4291), never
+    # handed out
+    interface_id_mask = (1 << 64) - 1
 
-    def __init__(self):
-        super(IPv4Pools, self).__init__()
+    def __init__(self, name='ip6pool', min_ip=0, max_ip=(1 << 128) - 1, mode=u'sequential'):
+        super(IPv6Pool, self).__init__()
+        assert min_ip <= max_ip, 'Minimum IP value must be smaller or equal to max IP value'
+        self.name = name
+        self.__name__ = name
+        self.minimum = netaddr.IPAddress(min_ip, 6)
+        self.maximum = netaddr.IPAddress(max_ip, 6)
+        self.mode = mode
+
+    @property
+    def prefixlen(self):
+        """Length of the smallest prefix containing the whole range"""
+        return 128 - (int(self.minimum) ^ int(self.maximum)).bit_length()
+
+    def _eui64(self, hw_address):
+        try:
+            prefix = int(self.minimum) >> 64 << 64
+            return int(netaddr.EUI(hw_address).ipv6(prefix))
+        except (ValueError, TypeError, netaddr.AddrFormatError):
+            return None
+
+    def _assignable(self, ip):
+        return ip & self.interface_id_mask != 0
+
+    def _first_assignable(self, minimum, maximum):
+        ip = self._first_free(minimum, maximum)
+        while ip is not None and not self._assignable(ip):
+            ip = self._first_free(ip + 1, maximum)
+        return ip
+
+    def _candidate(self, hw_address):
+        if self.mode == u'eui64' and hw_address:
+            return self._eui64(hw_address)
+        if self.mode == u'random':
+            for i in xrange(self.random_attempts):
+                ip = random.randint(int(self.minimum), int(self.maximum))
+                if self._available(ip) and self._assignable(ip):
+                    return ip
+
+    def allocate(self, hw_address=None):
+        """Mark an unallocated IP as used and return it. Falls back to the lowest free IP if the address
+        picked by the allocation mode is taken or out of the range. Subnet-Router anycast addresses are
+        skipped."""
+        with _lock:
+            ip = self._candidate(hw_address)
+            if (ip is None or not self._available(ip) or not self._assignable(ip) or
+                    not int(self.minimum) <= ip <= int(self.maximum)):
+                ip = self._first_assignable(int(self.minimum), int(self.maximum))
+            if ip is not None:
+                return self._use_allocated(ip)
+
+provideSubscriptionAdapter(ActionsContainerExtension, adapts=(IPv6Pool, ))
+
+
+class IPPools(Container):
+    """Non-intersecting IP pools of one IP version"""
+    version = None
+    _ranges_factory = LOBTree
+
+    # minimum IP of every pool -> pool, see `ranges`
+    _ranges = None
+
+    @property
+    def ranges(self):
+        """Pools by their minimum IP. As pools do not intersect, the pool containing an IP can only be the one
+        with the highest minimum not above it, so lookups are a single BTree search."""
+        if self._ranges is None:
+            self.reindex()
+        return self._ranges
+
+    def reindex(self):
+        ranges = self._ranges_factory()
+        for pool in self._items.itervalues():
+            ranges[int(pool.minimum)] = pool
+        self._ranges = ranges
+
+    def unindex(self, pool):
+        if self._ranges is not None and self._ranges.get(int(pool.minimum)) is pool:
+            del self._ranges[int(pool.minimum)]
+
+    def _preceding(self, ip, exclude=None):
+        """Returns the pool with the highest minimum not above `ip`, other than `exclude`"""
+        while True:
+            try:
+                minimum = self.ranges.maxKey(ip)
+            except ValueError:
+                return None
+            pool = self.ranges[minimum]
+            if self._items.get(pool.__name__) is not pool:
+                # removed without a deletion event
+                self.reindex()
+                continue
+            if pool is not exclude:
+                return pool
+            ip = minimum - 1
 
     def find_pool(self, ip):
         ip = netaddr.IPAddress(ip)
-        for n, pool in self._items.iteritems():
-            if int(pool.minimum) <= int(ip) and int(pool.maximum) >= int(ip):
-                return pool
+        if ip.version != self.version:
+            return None
+        ip = int(ip)
+        pool = self._preceding(ip)
+        if pool is not None and int(pool.maximum) >= ip:
+            return pool
 
     def find_intersections(self, pool):
-        for n, epool in self._items.iteritems():
-            if int(pool.minimum) <= int(epool.maximum) and int(pool.maximum) >= int(epool.minimum):
-                return True
-        return False
+        epool = self._preceding(int(pool.maximum), exclude=pool)
+        return epool is not None and int(epool.maximum) >= int(pool.minimum)
 
     def add(self, pool):
         if self.find_intersections(pool):
             raise ValueError('IP ranges must not intersect')
         pool.validate()
-        return super(IPv4Pools, self).add(pool)
+        res = super(IPPools, self).add(pool)
+        self._ranges[int(pool.minimum)] = pool
+        return res
 
-    def allocate(self):
-        for n, p in self._items.iteritems():
-            ip = p.allocate()
+    def allocate(self, *args):
+        for pool in self.ranges.itervalues():
+            ip = pool.allocate(*args)
             if ip is not None:
                 return ip
 
     def free(self, ip):
-        for n, pool in self._items.iteritems():
-            if pool.get(ip):
-                pool.free(ip)
-                return True
+        pool = self.find_pool(ip)
+        if pool is not None and pool.get(ip):
+            pool.free(ip)
+            return True
         return False
 
 
+class IPv4Pools(IPPools):
+    __contains__ = IPv4Pool
+    __name__ = 'ippools'
+    version = 4
+
+
+class IPv6Pools(IPPools):
+    __contains__ = IPv6Pool
+    __name__ = 'ip6pools'
+    version = 6
+    _ranges_factory = OOBTree
+
+    def allocate(self, hw_address=None):
+        return super(IPv6Pools, self).allocate(hw_address)
+
+
+@subscribe(IPPool, IModelModifiedEvent)
+def reindex_modified_pool(model, event):
+    if isinstance(model.__parent__, IPPools):
+        model.__parent__.reindex()
+
+
+@subscribe(IPPool, IModelDeletedEvent)
+def unindex_deleted_pool(model, event):
+    if isinstance(model.__parent__, IPPools):
+        model.__parent__.unindex(model)
+
+
 class IPv4PoolsRootInjector(ContainerInjector):
     context(OmsRoot)
     __class__ = IPv4Pools
+
+
+class IPv6PoolsRootInjector(ContainerInjector):
+    context(OmsRoot)
+    __class__ = IPv6Pools
@@ -0,0 +1,205 @@
+from __future__ import absolute_import
+
+import threading
+
+from grokcore.component import context
+from zope import schema
+from zope.interface import Interface, implements
+
+from opennode.knot.utils.timeseries import RunningAggregate
+from opennode.oms.model.model.base import ContainerInjector, Model, ReadonlyContainer
+from opennode.oms.model.model.root import OmsRoot
+
+
+class IRollup(Interface):
+    metric = schema.TextLine(title=u"Metric", readonly=True)
+    sum = schema.Float(title=u"Sum", description=u"Sum of the latest values of all members",
+                       required=False, readonly=True)
+    count = schema.Int(title=u"Count", description=u"Number of members reporting the metric",
+                       required=False, readonly=True)
+    max = schema.Float(title=u"Maximum", description=u"Maximum of the latest values of all members",
+                       required=False, readonly=True)
+    avg = schema.Float(title=u"Average", description=u"Average of the latest values of all members",
+                       required=False, readonly=True)
+
+
+class Rollup(Model):
+    """Running aggregate of a metric over a group of computes. Data points are published to its stream."""
+    implements(IRollup)
+
+    __transient__ = True
+
+    def __init__(self, metric, parent):
+        self.__name__ = metric
+        self.__parent__ = parent
+        self.metric = unicode(metric)
+        self.aggregate = RunningAggregate()
+
+    @property
+    def sum(self):
+        return self.aggregate.sum
+
+    @property
+    def count(self):
+        return self.aggregate.count
+
+    @property
+    def max(self):
+        return self.aggregate.max
+
+    @property
+    def avg(self):
+        return self.aggregate.avg
+
+    def data_point(self):
+        return {'sum': self.sum, 'count': self.count, 'max': self.max, 'avg': self.avg}
+
+
+class RollupGroup(ReadonlyContainer):
+    """Rollups of all metrics of a single group (e.g. a single owner)."""
+    __contains__ = IRollup
+    __transient__ = True
+
+    def __init__(self, name, parent):
+        self.__name__ = name
+        self.__parent__ = parent
+        self.rollups = {}
+
+    @property
+    def _items(self):
+        return dict(self.rollups)
+
+
+class RollupKind(ReadonlyContainer):
+    """All groups of one kind: per virtualization container, per owner or per env tag."""
+    __contains__ = RollupGroup
+    __transient__ = True
+
+    def __init__(self, name):
+        self.__name__ = name
+        self.__parent__ = None
+        self.groups = {}
+
+    @property
+    def _items(self):
+        return dict(self.groups)
+
+
+class FleetRollups(object):
+    """In-memory registry of the fleet-level metric rollups.
+
+    Members (VM uuids) report their latest metric values together with the groups they belong to, so that
+    the aggregates of every group are updated in O(1) per sample. Members which stop reporting, e.g. stopped
+    VMs or the VMs of a failed host, are dropped by `expire`.
+
+    """
+
+    kinds = ('by-container', 'by-owner', 'by-env')
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.roots = dict((kind, RollupKind(kind)) for kind in self.kinds)
+        # member -> {rollup the member reports to: timestamp of its last sample}
+        self._memberships = {}
+
+    @property
+    def attached(self):
+        return all(kind.__parent__ is not None for kind in self.roots.itervalues())
+
+    def attach(self, parent):
+        for kind in self.roots.itervalues():
+            kind.__parent__ = parent
+
+    def get(self, kind, group, metric, create=False):
+        with self._lock:
+            groups = self.roots[kind].groups
+            if group not in groups:
+                if not create:
+                    return
+                groups[group] = RollupGroup(group, self.roots[kind])
+            rollups = groups[group].rollups
+            if metric not in rollups:
+                if not create:
+                    return
+                rollups[metric] = Rollup(metric, groups[group])
+            return rollups[metric]
+
+    def _leave(self, member, rollup):
+        """Removes `member` from `rollup`, and the rollup and its group once they have no members"""
+        rollup.aggregate.remove(member)
+        if rollup.aggregate.count:
+            return
+        group = rollup.__parent__
+        if group.rollups.get(rollup.__name__) is rollup:
+            del group.rollups[rollup.__name__]
+        kind = group.__parent__
+        if not group.rollups and kind.groups.get(group.__name__) is group:
+            del kind.groups[group.__name__]
+
+    def update(self, member, groups, metric, value, timestamp):
+        """Records the latest `value` of `metric` for `member`, which belongs to `groups`, a list of (kind,
+        group) pairs. Returns the list of updated rollups."""
+        updated = []
+        with self._lock:
+            for kind, group in groups:
+                rollup = self.get(kind, group, metric, create=True)
+                rollup.aggregate.update(member, value)
+                self._memberships.setdefault(member, {})[rollup] = timestamp
+                updated.append(rollup)
+        return updated
+
+    def regroup(self, member, groups):
+        """Removes `member` from the rollups of the groups it no longer belongs to. The rollups of its
+        current `groups` are left alone, they get its values on the next update."""
+        groups = set(groups)
+        with self._lock:
+            rollups = self._memberships.get(member, {})
+            for rollup in rollups.keys():
+                group = rollup.__parent__
+                if (group.__parent__.__name__, group.__name__) not in groups:
+                    del rollups[rollup]
+                    self._leave(member, rollup)
+
+    def remove_member(self, member):
+        """Removes `member` from all its rollups. Returns the list of the rollups it was removed from."""
+        with self._lock:
+            rollups = self._memberships.pop(member, {}).keys()
+            for rollup in rollups:
+                self._leave(member, rollup)
+        return rollups
+
+    def expire(self, before):
+        """Removes the members from the rollups they sent no sample to since `before`. Returns the list of
+        the rollups members were removed from."""
+        expired = set()
+        with self._lock:
+            for member, rollups in self._memberships.items():
+                for rollup, timestamp in rollups.items():
+                    if timestamp < before:
+                        del rollups[rollup]
+                        self._leave(member, rollup)
+                        expired.add(rollup)
+                if not rollups:
+                    del self._memberships[member]
+        return list(expired)
+
+
+fleet_rollups = FleetRollups()
+
+
+class Rollups(ReadonlyContainer):
+    __contains__ = RollupKind
+    __name__ = 'rollups'
+
+    def __str__(self):
+        return 'Fleet metric rollups'
+
+    @property
+    def _items(self):
+        fleet_rollups.attach(self)
+        return dict(fleet_rollups.roots)
+
+
+class RollupsRootInjector(ContainerInjector):
+    context(OmsRoot)
+    __class__ = Rollups
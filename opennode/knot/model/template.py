@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
-from grokcore.component import context, implements
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from grokcore.component import context, implements, subscribe
 from zope import schema
 from zope.component import provideSubscriptionAdapter
 from zope.interface import Interface
@@ -12,6 +13,7 @@ from opennode.oms.model.model.base import IDisplayName
 from opennode.oms.model.model.base import Model
 from opennode.oms.model.model.base import ReadonlyContainer
 from opennode.oms.model.model.byname import ByNameContainerExtension
+from opennode.oms.model.model.events import IModelCreatedEvent, IModelDeletedEvent
 from opennode.oms.model.model.root import OmsRoot
 from opennode.oms.model.model.search import ModelTags
 from opennode.oms.model.model.symlink import Symlink
@@ -84,14 +86,35 @@ class Templates(Container):
 
 
 class GlobalTemplates(ReadonlyContainer):
+    """All the templates of all the hypervisors.
+
+    Served from a persistent catalog indexed by template name and by (backend, hypervisor name), which is
+    maintained by `SyncTemplatesAction` and the model events and rebuilt with the `reindex` command. Until
+    the catalog is first built, the machines tree is walked on every access.
+
+    """
     __contains__ = Template
     __name__ = 'templates'
 
+    # template __name__ -> Symlink
+    _index = None
+    # template __name__ -> (name, backend, hypervisor name)
+    _entries = None
+    # template name -> set of template __name__s
+    _by_name = None
+    # (backend, hypervisor name) -> set of template __name__s
+    _by_host = None
+
     def __str__(self):
         return 'Global template list'
 
     @property
     def _items(self):
+        if self._index is not None:
+            return self._index
+        return dict((name, Symlink(name, item)) for name, item in self._collect().iteritems())
+
+    def _collect(self):
         # break an import cycle
         from opennode.oms.zodb import db
         machines = db.get_root()['oms_root']['machines']
@@ -112,7 +135,7 @@ class GlobalTemplates(ReadonlyContainer):
             seen = set()
             for item in container.listcontent():
                 if ITemplate.providedBy(item) and item.__name__ not in templates:
-                    templates[item.__name__] = Symlink(item.__name__, item)
+                    templates[item.__name__] = item
 
                 if any(allowed_classes_gen(item)):
                     if item.__name__ not in seen:
@@ -122,6 +145,112 @@ class GlobalTemplates(ReadonlyContainer):
         collect(machines)
         return templates
 
+    def reindex(self):
+        """Rebuilds the catalog from the machines tree. Returns the number of indexed templates."""
+        self._index = OOBTree()
+        self._entries = OOBTree()
+        self._by_name = OOBTree()
+        self._by_host = OOBTree()
+        for template in self._collect().itervalues():
+            self.index(template)
+        return len(self._index)
+
+    def index(self, template):
+        if self._index is None:
+            self.reindex()
+
+        self.unindex(template)
+        location = template_location(template)
+        if location is None:
+            return
+
+        link = Symlink(template.__name__, template)
+        link.__parent__ = self
+        self._index[template.__name__] = link
+        self._entries[template.__name__] = (template.name,) + location
+        for index, key in ((self._by_name, template.name), (self._by_host, location)):
+            if key not in index:
+                index[key] = OOTreeSet()
+            index[key].insert(template.__name__)
+
+    def unindex(self, template):
+        if self._index is None or template.__name__ not in self._entries:
+            return
+
+        entry = self._entries.pop(template.__name__)
+        del self._index[template.__name__]
+
+        for index, key in ((self._by_name, entry[0]), (self._by_host, entry[1:])):
+            uids = index.get(key)
+            if uids is not None and template.__name__ in uids:
+                uids.remove(template.__name__)
+                if not uids:
+                    del index[key]
+
+    def index_container(self, container):
+        """Reindexes a hypervisor templates container, e.g. after a templates sync"""
+        if self._index is None:
+            self.reindex()
+            return
+
+        location = template_location_of_container(container)
+        current = set(self._by_host.get(location, ()))
+        present = set(t.__name__ for t in container.listcontent() if ITemplate.providedBy(t))
+        for uid in current.difference(present):
+            self.unindex(self._index[uid].target)
+        for template in container.listcontent():
+            if ITemplate.providedBy(template):
+                self.index(template)
+
+    def unindex_host(self, name):
+        """Unindexes the templates of all virtualization containers of the hypervisor named `name`"""
+        if self._index is None:
+            return
+
+        for location in [location for location in self._by_host.keys() if location[1] == name]:
+            for uid in list(self._by_host[location]):
+                self.unindex(self._index[uid].target)
+
+    def by_name(self, name):
+        """Returns the templates named `name` of all hypervisors"""
+        if self._index is None:
+            return [t for t in self._collect().itervalues() if t.name == name]
+        return [self._index[uid].target for uid in self._by_name.get(name, ())]
+
+    def names_on(self, compute, backend):
+        """Returns the names of the templates available on the `backend` virtualization container of the
+        hypervisor `compute`"""
+        if self._index is None:
+            templates = compute['vms-%s' % backend]['templates']
+            return set(t.name for t in (templates.listcontent() if templates else [])
+                       if ITemplate.providedBy(t))
+        return set(self._entries[uid][0] for uid in self._by_host.get((backend, compute.__name__), ()))
+
+
+def template_location_of_container(container):
+    """Returns the (backend, hypervisor name) of a hypervisor templates container, or None"""
+    v12n_container = container.__parent__
+    compute = v12n_container.__parent__ if v12n_container is not None else None
+    if compute is None or getattr(v12n_container, 'backend', None) is None:
+        return None
+    return (v12n_container.backend, compute.__name__)
+
+
+def template_location(template):
+    return template_location_of_container(template.__parent__) if template.__parent__ is not None else None
+
+
+@subscribe(ITemplate, IModelCreatedEvent)
+def index_created_template(model, event):
+    from opennode.oms.zodb import db
+    db.get_root()['oms_root']['templates'].index(model)
+
+
+@subscribe(ITemplate, IModelDeletedEvent)
+def unindex_deleted_template(model, event):
+    from opennode.oms.zodb import db
+    db.get_root()['oms_root']['templates'].unindex(model)
+
 
 class TemplatesRootInjector(ContainerInjector):
     context(OmsRoot)
@@ -58,10 +58,18 @@ class OpenVZContainer(ReadonlyContainer):
     def _items(self):
         # break an import cycle
         from opennode.oms.zodb import db
-        machines = db.get_root()['oms_root']['machines']
+        oms_root = db.get_root()['oms_root']
 
         computes = {}
 
+        ctids = oms_root['computes']._ctids
+        if ctids is not None:
+            for ctid, name in ctids.reserved.iteritems():
+                compute = oms_root['computes']._items.get(name)
+                if compute is not None and compute.target.ctid == ctid:
+                    computes[str(ctid)] = Symlink(str(ctid), compute.target)
+            return computes
+
         def collect(container):
             from opennode.knot.model.machines import Machines
 
@@ -76,7 +84,7 @@ class OpenVZContainer(ReadonlyContainer):
                         seen.add(item.__name__)
                         collect(item)
 
-        collect(machines)
+        collect(oms_root['machines'])
         return computes
 
 
@@ -0,0 +1,106 @@
+import unittest
+
+from zope.component import provideAdapter
+from zope.interface import alsoProvides
+from zope.securitypolicy.interfaces import IPrincipalRoleMap
+
+from opennode.knot.model.catalog import ComputeCatalog
+from opennode.knot.model.compute import IVirtualCompute, IDeployed
+
+
+class FakeContainer(object):
+    __name__ = 'vms-openvz'
+    __parent__ = None
+    backend = u'openvz'
+
+
+class FakeCompute(object):
+
+    def __init__(self, name, hostname, owner, state=u'active', ipv4_address=None):
+        self.__name__ = name
+        self.__parent__ = FakeContainer()
+        self.__owner__ = owner
+        self.hostname = hostname
+        self.state = state
+        self.ipv4_address = ipv4_address
+        self.roles = []
+        alsoProvides(self, IVirtualCompute)
+
+
+class FakeRoleMap(object):
+
+    def __init__(self, compute):
+        self.compute = compute
+
+    def getPrincipalsAndRoles(self):
+        return self.compute.roles
+
+
+provideAdapter(FakeRoleMap, adapts=(FakeCompute, ), provides=IPrincipalRoleMap)
+
+
+class FakeInteraction(object):
+
+    def __init__(self, denied):
+        self.denied = denied
+        self.checked = []
+
+    def checkPermission(self, permission, obj):
+        self.checked.append(obj)
+        return obj not in self.denied
+
+
+class ComputeCatalogTest(unittest.TestCase):
+
+    def test_query(self):
+        vm1 = FakeCompute('vm1', u'vm1.example.com', 'john', ipv4_address=u'10.0.0.1/24')
+        vm2 = FakeCompute('vm2', u'vm2.example.com', 'john', state=u'inactive')
+        vm3 = FakeCompute('vm3', u'vm3.example.com', 'jane')
+        alsoProvides(vm1, IDeployed)
+
+        catalog = ComputeCatalog()
+        assert catalog.reindex([vm1, vm2, vm3]) == 3
+
+        assert catalog.query(owner='john') == set(['vm1', 'vm2'])
+        assert catalog.query(owner='john', state=u'active') == set(['vm1'])
+        assert catalog.query(owner='john', deployment=u'deployed') == set(['vm1'])
+        assert catalog.query(backend=u'openvz', virtual=True) == set(['vm1', 'vm2', 'vm3'])
+        assert catalog.query(hostname=u'vm3.example.com') == set(['vm3'])
+        assert catalog.query(owner='nobody') == set()
+        assert list(catalog.keys('ipv4')) == [u'10.0.0.1']
+
+        assert [r['hostname'] for r in catalog.summarize(owner='john')] == [u'vm1.example.com',
+                                                                            u'vm2.example.com']
+        assert catalog.summarize(hostname=u'vm1.example.com')[0]['deployment'] == u'deployed'
+
+        vm2.__owner__ = 'jane'
+        catalog.index(vm2)
+        assert catalog.query(owner='jane') == set(['vm2', 'vm3'])
+        assert catalog.summaries['vm2']['owner'] == 'jane'
+
+        catalog.unindex('vm3')
+        assert catalog.query(owner='jane') == set(['vm2'])
+        assert catalog.query(hostname=u'vm3.example.com') == set()
+
+    def test_viewable(self):
+        vm1 = FakeCompute('vm1', u'vm1.example.com', 'john')
+        vm2 = FakeCompute('vm2', u'vm2.example.com', 'john')
+        vm2.roles = [('oms.nothing', 'jane', 'Deny')]
+
+        catalog = ComputeCatalog()
+        catalog.reindex([vm1, vm2])
+        assert catalog.query(acl=True) == set(['vm2'])
+
+        container = vm1.__parent__
+        catalog._traverse = lambda path: container
+        catalog._compute = {'vm1': vm1, 'vm2': vm2}.get
+        records = catalog.summarize()
+
+        # the container is checked once, and only the compute with its own ACL is loaded
+        interaction = FakeInteraction(denied=[vm2])
+        assert [r['id'] for r in catalog.viewable(interaction, records)] == ['vm1']
+        assert interaction.checked == [container, vm2]
+
+        # computes of containers that may not be viewed are checked one by one
+        interaction = FakeInteraction(denied=[container, vm1])
+        assert [r['id'] for r in catalog.viewable(interaction, records)] == ['vm2']
@@ -0,0 +1,147 @@
+import unittest
+
+import transaction
+import ZODB
+from ZODB.DemoStorage import DemoStorage
+
+from opennode.knot.model.compute import Compute, ComputeState
+from opennode.knot.model.computes import Computes, TaskSubjectIndex
+from opennode.knot.model.network import NetworkInterface
+
+
+def old_compute(name):
+    """Returns a compute as created by the versions without the sub-containers"""
+    compute = Compute(u'%s.example.com' % name, u'active')
+    compute.__name__ = name
+    for subcontainer, factory in Compute._subcontainers:
+        del compute._items[subcontainer]
+    return compute
+
+
+class SubcontainersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = ZODB.DB(None)
+        self.connection = self.db.open()
+
+    def tearDown(self):
+        transaction.abort()
+        self.connection.close()
+        self.db.close()
+
+    def test_reading_doesnt_write(self):
+        self.connection.root()['compute'] = old_compute('c1')
+        transaction.commit()
+
+        compute = self.connection.root()['compute']
+        compute._p_deactivate()
+        consoles = compute.consoles
+        assert consoles.__parent__ is compute
+        assert len(list(compute.templates.listcontent())) == 0
+        assert 'consoles' not in compute._items
+        assert not compute._p_changed
+        assert not compute._items._p_changed
+
+    def test_writes_attach_the_subcontainers(self):
+        self.connection.root()['compute'] = old_compute('c1')
+        transaction.commit()
+
+        compute = self.connection.root()['compute']
+        interfaces = compute.interfaces
+        interfaces.add(NetworkInterface('eth0', None, u'52:54:00:00:00:01', 'active'))
+        transaction.commit()
+
+        compute._p_deactivate()
+        assert [i.__name__ for i in compute.interfaces.listcontent()] == ['eth0']
+        for subcontainer, factory in Compute._subcontainers:
+            assert subcontainer in compute._items
+
+    def test_upgrade(self):
+        computes = Computes()
+        compute, current = old_compute('c1'), old_compute('c2')
+        current.ensure_subcontainers()
+        computes._collect = lambda container=None: {'c1': compute, 'c2': current}
+
+        assert computes.upgrade() == 1
+        for subcontainer, factory in Compute._subcontainers:
+            assert compute._items[subcontainer].__parent__ is compute
+        assert computes.upgrade() == 0
+
+
+class ComputeStateTest(unittest.TestCase):
+
+    def test_resolve_conflict(self):
+        state = ComputeState()
+        old = {'uptime': 10, 'failure': False}
+
+        # disjoint changes are merged
+        assert state._p_resolveConflict(old, {'uptime': 20, 'failure': False},
+                                        {'uptime': 10, 'failure': True}) == {'uptime': 20, 'failure': True}
+        # fields added by either transaction are kept
+        assert state._p_resolveConflict(old, dict(old, health=u'up'),
+                                        dict(old, cpu_usage=(1.0, 1.0, 1.0))) == dict(
+                                            old, health=u'up', cpu_usage=(1.0, 1.0, 1.0))
+        # on overlapping changes the resolving transaction wins
+        assert state._p_resolveConflict(old, {'uptime': 20, 'failure': True},
+                                        {'uptime': 30, 'failure': False}) == {'uptime': 30, 'failure': True}
+
+    def test_concurrent_commits(self):
+        # unlike the default MappingStorage, DemoStorage resolves conflicts
+        db = ZODB.DB(DemoStorage())
+        try:
+            tm1, tm2 = transaction.TransactionManager(), transaction.TransactionManager()
+            connection1, connection2 = db.open(transaction_manager=tm1), db.open(transaction_manager=tm2)
+            connection1.root()['compute'] = Compute(u'c1.example.com', u'active')
+            tm1.commit()
+            tm2.begin()
+
+            compute1, compute2 = connection1.root()['compute'], connection2.root()['compute']
+            compute1.uptime = 20
+            compute1.failure = True
+            compute2.memory_usage = 512.0
+            compute2.failure = False
+            tm1.commit()
+            tm2.commit()
+
+            tm1.begin()
+            assert (compute1.uptime, compute1.memory_usage, compute1.failure) == (20, 512.0, False)
+        finally:
+            db.close()
+
+    def test_legacy_values_are_moved(self):
+        compute = Compute(u'c1.example.com', u'active')
+        del compute._state
+        compute.__dict__.update({'failure': True, 'uptime': 100})
+        assert compute.failure is True
+        assert compute.uptime == 100
+
+        compute.memory_usage = 512.0
+        assert compute._state is not None
+        assert 'failure' not in compute.__dict__ and 'uptime' not in compute.__dict__
+        assert (compute.failure, compute.uptime, compute.memory_usage) == (True, 100, 512.0)
+        assert not compute.ensure_state()[0]
+
+
+class FakeTask(object):
+
+    def __init__(self, name, *subjects):
+        self.__name__ = name
+        self.subject = tuple(subjects)
+
+
+class TaskSubjectIndexTest(unittest.TestCase):
+
+    def test_add_and_remove(self):
+        c1, c2 = old_compute('c1'), old_compute('c2')
+        index = TaskSubjectIndex()
+        t1, t2 = FakeTask('1', c1), FakeTask('2', c1, c2)
+        index.add(t1)
+        index.add(t2)
+        index.add(FakeTask('3'))
+        assert index.tasks_of('c1') == {'1': t1, '2': t2}
+        assert index.tasks_of('c2') == {'2': t2}
+
+        index.remove(t2)
+        assert index.tasks_of('c1') == {'1': t1}
+        assert index.tasks_of('c2') == {}
+        assert index._by_subject.keys() == ['c1']
@@ -0,0 +1,48 @@
+import transaction
+import unittest
+
+from opennode.knot.model import ctid
+from opennode.knot.model.ctid import CtidAllocator, CtidCounter
+
+
+class CtidAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        ctid._claimed.clear()
+        ctid._high[0] = 0
+
+    def tearDown(self):
+        transaction.abort()
+
+    def test_reserve_and_release(self):
+        ctids = CtidAllocator(minimum=101)
+        assert ctids.reserve('vm1') == 101
+        assert ctids.reserve('vm2') == 102
+        assert ctids.reserve('vm1') == 101
+
+        assert ctids.release('vm1') == 101
+        assert ctids.release('vm1') is None
+        transaction.commit()
+
+        assert ctids.reserve('vm3') == 101
+        assert ctids.reserve('vm4') == ctids.counter.value
+
+    def test_observe(self):
+        ctids = CtidAllocator(minimum=101)
+        assert ctids.reseed([]) == 0
+
+        ctids.observe('vm1', 500)
+        ctids.observe('vm2', -1)
+        assert ctids.get('vm1') == 500
+        assert ctids.get('vm2') is None
+        assert ctids.reserve('vm3') > 500
+
+        # the hypervisor picked another CTID than the reserved one
+        reserved = ctids.get('vm3')
+        ctids.observe('vm3', 600)
+        assert reserved in ctids.free
+        assert ctids.reserved[600] == 'vm3'
+
+    def test_counter_conflict_resolution(self):
+        counter = CtidCounter(100)
+        assert counter._p_resolveConflict({'value': 100}, {'value': 103}, {'value': 102}) == {'value': 103}
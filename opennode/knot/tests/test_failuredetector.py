@@ -0,0 +1,93 @@
+import unittest
+
+from opennode.knot.backend.failuredetector import FailureDetector
+from opennode.knot.utils.failuredetector import PhiAccrualDetector, UNKNOWN, UP, SUSPECT, DOWN, best, worst
+
+
+class FailureDetectorTest(unittest.TestCase):
+
+    def test_phi_grows_with_silence(self):
+        detector = PhiAccrualDetector(min_std=0.5)
+        assert detector.phi(0) is None
+        assert detector.health(0, 3, 8) == UNKNOWN
+
+        for t in xrange(0, 100, 10):
+            detector.heartbeat(t)
+
+        assert detector.mean == 10
+        phis = [detector.phi(90 + elapsed) for elapsed in (1, 10, 11, 12, 15)]
+        assert phis == sorted(phis)
+        assert phis[0] < 0.1
+        assert detector.health(91, 3, 8) == UP
+        assert detector.health(112, 3, 8) == DOWN
+
+    def test_irregular_heartbeats_are_tolerated(self):
+        detector = PhiAccrualDetector(min_std=0.5)
+        t = 0
+        for interval in [5, 15, 5, 15, 5, 15, 5, 15]:
+            t += interval
+            detector.heartbeat(t)
+
+        # a 15s silence is normal for this host
+        assert detector.health(t + 15, 3, 8) == UP
+        assert detector.health(t + 40, 3, 8) == DOWN
+
+    def test_first_interval(self):
+        detector = PhiAccrualDetector(first_interval=10)
+        detector.heartbeat(100)
+        assert detector.health(105, 3, 8) == UP
+        assert detector.health(200, 3, 8) == DOWN
+
+    def test_bootstrap_timeout(self):
+        detector = PhiAccrualDetector(first_interval=10)
+        assert detector.health(1000, 3, 8, bootstrap_timeout=30) == UNKNOWN
+
+        detector.expect(100)
+        detector.expect(110)
+        assert detector.health(120, 3, 8, bootstrap_timeout=30) == UNKNOWN
+        assert detector.health(130, 3, 8, bootstrap_timeout=30) == DOWN
+
+        detector.heartbeat(131)
+        assert detector.health(132, 3, 8, bootstrap_timeout=30) == UP
+
+    def test_worst(self):
+        assert worst(UP, UNKNOWN) == UP
+        assert worst(UP, SUSPECT, UNKNOWN) == SUSPECT
+        assert worst(DOWN, SUSPECT) == DOWN
+
+    def test_best(self):
+        assert best(UNKNOWN) == UNKNOWN
+        assert best(DOWN, UNKNOWN) == DOWN
+        assert best(DOWN, SUSPECT, UP) == UP
+
+
+class FailureDetectorUtilityTest(unittest.TestCase):
+
+    def test_sources_are_tracked_separately(self):
+        detector = FailureDetector()
+        for t in xrange(0, 61):
+            detector.heartbeat('c1', 'salt', now=t)
+        for t in xrange(0, 101, 10):
+            detector.heartbeat('c1', 'ping', now=t)
+
+        # salt calls stopped 40s ago, but the agent pings arrive on time
+        assert detector.phi('c1', now=100)['salt'] > 8
+        assert detector.health('c1', now=100) == UP
+        assert detector.health('c1', now=130) == DOWN
+
+    def test_bootstrap_timeout_of_expected_sources(self):
+        detector = FailureDetector()
+        detector.expect('c1', 'ping', now=0)
+        assert detector.health('c1', now=1) == UNKNOWN
+        assert detector.health('c1', now=1000) == DOWN
+
+        detector.heartbeat('c1', 'salt', now=1000)
+        assert detector.health('c1', now=1001) == UP
+
+    def test_conditions(self):
+        detector = FailureDetector()
+        detector.heartbeat('c1', 'ping', now=0)
+        detector.set_condition('c1', 'agent-version', SUSPECT)
+        assert detector.health('c1', now=1) == SUSPECT
+        detector.set_condition('c1', 'agent-version', None)
+        assert detector.health('c1', now=1) == UP
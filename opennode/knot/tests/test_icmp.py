@@ -0,0 +1,63 @@
+import struct
+import unittest
+
+from twisted.internet import defer
+
+from opennode.knot.utils.icmp import AsyncPinger, ICMP_ECHO_REPLY, checksum, echo_request, parse_fping
+
+
+class FakeDelayedCall(object):
+    cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class IcmpTest(unittest.TestCase):
+
+    def reply(self, ident, seq):
+        ip_header = '\x45' + '\0' * 19
+        return ip_header + struct.pack('!BBHHH', ICMP_ECHO_REPLY, 0, 0, ident, seq) + 'payload'
+
+    def test_echo_request(self):
+        packet = echo_request(1234, 7, 64)
+        assert len(packet) == 64
+        assert checksum(packet) == 0
+        assert struct.unpack('!BBHHH', packet[:8])[3:] == (1234, 7)
+
+    def test_reply_matching(self):
+        pinger = AsyncPinger()
+        pinger._raw = True
+        results = []
+        timeouts = {}
+        for seq, address in [(1, '10.0.0.1'), (2, '10.0.0.2')]:
+            d = defer.Deferred()
+            d.addCallback(lambda rtt, seq=seq: results.append((seq, rtt)))
+            timeouts[seq] = FakeDelayedCall()
+            pinger._pending[seq] = (address, 0, d, timeouts[seq])
+
+        # foreign identifier, wrong source address
+        pinger._received(self.reply(pinger._ident + 1 & 0xffff, 1), '10.0.0.1')
+        pinger._received(self.reply(pinger._ident, 1), '10.0.0.2')
+        assert results == []
+
+        pinger._received(self.reply(pinger._ident, 2), '10.0.0.2')
+        assert [seq for seq, rtt in results] == [2]
+        assert results[0][1] > 0
+        assert timeouts[2].cancelled and not timeouts[1].cancelled
+        assert 2 not in pinger._pending
+
+        pinger._timeout(1)
+        assert results[1] == (1, None)
+        assert pinger._pending == {}
+
+    def test_parse_fping(self):
+        output = ('10.0.0.1 : 0.10 0.12\n'
+                  '10.0.0.2 : - -\n'
+                  'host3: Name or service not known\n'
+                  '10.0.0.4 : - 1.5\n'
+                  '10.0.0.9 : 1.0 1.0\n')
+        assert parse_fping(output, ['10.0.0.1', '10.0.0.2', 'host3', '10.0.0.4']) == {
+            '10.0.0.1': [0.10, 0.12],
+            '10.0.0.2': [None, None],
+            '10.0.0.4': [None, 1.5]}
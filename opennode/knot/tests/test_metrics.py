@@ -0,0 +1,166 @@
+import time
+import unittest
+
+from zope.component import provideAdapter
+
+from opennode.knot.backend import metrics
+from opennode.knot.model.rollup import FleetRollups, Rollup
+from opennode.oms.config import get_config
+from opennode.oms.model.model.stream import IStream
+
+
+class FakeParent(object):
+
+    def __init__(self, name, parent=None):
+        self.__name__ = name
+        self.__parent__ = parent
+
+
+class FakeMetric(FakeParent):
+
+    def __init__(self, name, parent):
+        super(FakeMetric, self).__init__(name, parent)
+        self.stored = []
+
+
+class FakeStream(object):
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def add(self, item):
+        self.metric.stored.append(item)
+
+    def events(self, after, limit=None):
+        return [e for e in self.metric.stored if e[0] > after][:limit]
+
+
+provideAdapter(FakeStream, adapts=(FakeMetric, ), provides=IStream)
+
+
+class ChangeOnlyStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        config = get_config()
+        if not config.has_section('metrics-encoding'):
+            config.add_section('metrics-encoding')
+        config.set('metrics-encoding', 'memory_usage', '0.5, 300')
+        metrics.encoders.clear()
+
+        self.metric = FakeMetric('memory_usage', FakeParent('metrics', FakeParent('vm1')))
+        self.interval = config.getint('metrics', 'interval') * 1000
+
+    def tearDown(self):
+        get_config().remove_option('metrics-encoding', 'memory_usage')
+        metrics.encoders.clear()
+
+    def test_readers_get_the_change_points(self):
+        start = int(time.time() * 1000)
+        writer = metrics.encoded_stream('vm1', self.metric)
+        for i, value in enumerate([100.0, 100.2, 100.1, 200.0]):
+            writer.add((start + i * self.interval, value))
+
+        assert self.metric.stored == [(start, 100.0), (start + 3 * self.interval, 200.0)]
+
+        events = metrics.encoded_stream('vm1', self.metric).events(start + self.interval)
+        assert events == [(start, 100.0), (start + 3 * self.interval, 200.0)]
+        # the series is not expanded to the sampling interval, whatever the range
+        assert metrics.encoded_stream('vm1', self.metric).events(0) == self.metric.stored
+
+    def test_encoder_resumes_from_the_stored_stream(self):
+        start = int(time.time() * 1000)
+        metrics.encoded_stream('vm1', self.metric).add((start, 100.0))
+
+        # e.g. after the stream cache was invalidated
+        metrics.encoders.clear()
+        metrics.encoded_stream('vm1', self.metric).add((start + self.interval, 100.1))
+        assert self.metric.stored == [(start, 100.0)]
+
+    def test_other_metrics_are_not_wrapped(self):
+        metric = FakeMetric('cpu_usage', self.metric.__parent__)
+        assert isinstance(metrics.encoded_stream('vm1', metric), FakeStream)
+        assert isinstance(metrics.encoded_stream('vm1', self.metric), metrics.ChangeOnlyStream)
+        # the IStream adapters are left alone
+        assert isinstance(IStream(self.metric), FakeStream)
+
+
+class RecordingStream(object):
+
+    def __init__(self, rollup):
+        self.rollup = rollup
+
+    def add(self, item):
+        published.append((self.rollup.__parent__.__name__, self.rollup.metric, item))
+
+
+published = []
+provideAdapter(RecordingStream, adapts=(Rollup, ), provides=IStream)
+
+
+class UpdateRollupsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fleet_rollups = metrics.fleet_rollups
+        metrics.fleet_rollups = FleetRollups()
+        metrics.stream_cache.clear()
+        del published[:]
+
+    def tearDown(self):
+        metrics.fleet_rollups = self.fleet_rollups
+        metrics.stream_cache.clear()
+
+    def test_update_rollups(self):
+        metrics.stream_cache.set_groups({'vm1': [('by-owner', 'john')],
+                                         'vm2': [('by-owner', 'john'), ('by-env', 'prod')]})
+        gatherer = metrics.VirtualComputeMetricGatherer(None)
+        gatherer.update_rollups({'vm1': {'cpu_usage': 1.0, 'state': u'active'},
+                                 'vm2': {'cpu_usage': 2},
+                                 'vm3': {'cpu_usage': 5.0}}, 1000)
+
+        john = metrics.fleet_rollups.get('by-owner', 'john', 'cpu_usage')
+        assert (john.sum, john.count, john.max) == (3.0, 2, 2.0)
+        assert metrics.fleet_rollups.get('by-owner', 'john', 'state') is None
+        assert sorted((group, metric) for group, metric, item in published) == [('john', u'cpu_usage'),
+                                                                                  ('prod', u'cpu_usage')]
+        assert dict((g, item) for g, m, item in published)['john'] == (1000, {'sum': 3.0, 'count': 2,
+                                                                             'max': 2.0, 'avg': 1.5})
+
+    def test_membership_follows_groups(self):
+        metrics.stream_cache.set_groups({'vm1': [('by-owner', 'john')]})
+        gatherer = metrics.VirtualComputeMetricGatherer(None)
+        gatherer.update_rollups({'vm1': {'cpu_usage': 1.0}}, 1000)
+
+        # modifications not affecting the groups keep the VM in its rollups
+        metrics.stream_cache.invalidate_groups('vm1')
+        assert metrics.fleet_rollups.get('by-owner', 'john', 'cpu_usage').count == 1
+
+        # the groups looked up again on the next gather after an owner change
+        metrics.stream_cache.set_groups({'vm1': [('by-owner', 'jane')]})
+        gatherer.update_rollups({'vm1': {'cpu_usage': 1.0}}, 2000)
+        assert metrics.fleet_rollups.get('by-owner', 'john', 'cpu_usage') is None
+        assert metrics.fleet_rollups.get('by-owner', 'jane', 'cpu_usage').count == 1
+
+    def test_stopped_vms_leave_the_rollups(self):
+        metrics.stream_cache.set_groups({'vm1': [('by-owner', 'john')], 'vm2': [('by-owner', 'john')]})
+        gatherer = metrics.VirtualComputeMetricGatherer(None)
+        gatherer.update_rollups({'vm1': {'cpu_usage': 1.0, 'state': u'active'},
+                                 'vm2': {'cpu_usage': 2.0, 'state': u'active'}}, 1000)
+
+        del published[:]
+        gatherer.update_rollups({'vm1': {'cpu_usage': 0.0, 'state': u'inactive'},
+                                 'vm2': {'cpu_usage': 2.0, 'state': u'active'}}, 2000)
+        john = metrics.fleet_rollups.get('by-owner', 'john', 'cpu_usage')
+        assert (john.sum, john.count) == (2.0, 1)
+        assert [item for g, m, item in published] == [(2000, {'sum': 2.0, 'count': 1, 'max': 2.0,
+                                                              'avg': 2.0})]
+
+    def test_vms_not_reporting_expire(self):
+        metrics.stream_cache.set_groups({'vm1': [('by-owner', 'john')], 'vm2': [('by-owner', 'john')]})
+        gatherer = metrics.VirtualComputeMetricGatherer(None)
+        now = int(time.time() * 1000)
+        gatherer.update_rollups({'vm1': {'cpu_usage': 1.0}, 'vm2': {'cpu_usage': 2.0}}, now - 60000)
+        gatherer.update_rollups({'vm2': {'cpu_usage': 2.0}}, now)
+
+        metrics.MetricsDaemonProcess().expire_rollups()
+        john = metrics.fleet_rollups.get('by-owner', 'john', 'cpu_usage')
+        assert (john.sum, john.count) == (2.0, 1)
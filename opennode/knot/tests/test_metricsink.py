@@ -0,0 +1,171 @@
+import BaseHTTPServer
+import SocketServer
+import shutil
+import tempfile
+import threading
+import unittest
+
+from twisted.internet import defer, threads
+
+from opennode.knot.backend.metricsink import GraphiteSink, InfluxDBSink, MetricsSpool
+from opennode.knot.backend.metricsink import format_graphite, format_influxdb
+
+
+class StandInGraphiteServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        self.received = []
+        self.connections = 0
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(handler):
+                self.connections += 1
+                for line in handler.rfile:
+                    self.received.append(line)
+
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.serve_forever).start()
+
+
+class StandInInfluxDBServer(BaseHTTPServer.HTTPServer):
+
+    def __init__(self):
+        self.requests = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(handler):
+                body = handler.rfile.read(int(handler.headers['Content-Length']))
+                self.requests.append((handler.path, body))
+                handler.send_response(204)
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+
+            def log_message(handler, *args):
+                pass
+
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.serve_forever).start()
+
+
+def wait_for(condition, timeout=5.0):
+    event = threading.Event()
+    for i in xrange(int(timeout * 100)):
+        if condition():
+            return True
+        event.wait(0.01)
+    return condition()
+
+
+class MetricsSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def test_format(self):
+        assert format_graphite('oms', 'vm1', 'cpu_usage', 1500, (0.5, 1.0)) == [u'oms.vm1.cpu_usage.0 0.5 1\n',
+                                                                              u'oms.vm1.cpu_usage.1 1.0 1\n']
+        assert format_influxdb('', 'vm 1', 'memory_usage', 1500, 128) == [u'memory_usage,series=vm\\ 1 '
+                                                                         u'value=128.0 1500\n']
+        assert format_influxdb('oms', 'vm1', 'diskspace_usage', 1500, {'root': 1.5, 'boot': 2}) == \
+            [u'oms_diskspace_usage,series=vm1 boot=2.0,root=1.5 1500\n']
+
+    def test_graphite_batches_over_one_connection(self):
+        server = StandInGraphiteServer()
+        try:
+            sink = GraphiteSink(host='127.0.0.1', port=server.server_address[1], prefix='oms',
+                                flush_size=1000, spool=MetricsSpool(self.spool_dir, 1024 * 1024))
+            for i in xrange(10):
+                sink.add('vm1', 'memory_usage', i * 1000, i)
+            sink.flush_now()
+            sink.add('vm2', 'memory_usage', 10000, 10)
+            sink.flush_now()
+
+            assert wait_for(lambda: len(server.received) == 11)
+            assert server.received[0] == 'oms.vm1.memory_usage 0.0 0\n'
+            assert server.connections == 1
+            sink.disconnect()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_spool_on_outage(self):
+        server = StandInGraphiteServer()
+        port = server.server_address[1]
+        server.shutdown()
+        server.server_close()
+
+        sink = GraphiteSink(host='127.0.0.1', port=port, prefix='oms', flush_size=1000,
+                            spool=MetricsSpool(self.spool_dir, 1024 * 1024))
+        sink.add('vm1', 'memory_usage', 1000, 1)
+        sink.flush_now()
+        assert len(sink.spool._segments()) == 1
+
+        server = StandInGraphiteServer()
+        sink._port = server.server_address[1]
+        try:
+            sink.add('vm1', 'memory_usage', 2000, 2)
+            sink.flush_now()
+            assert wait_for(lambda: len(server.received) == 2)
+            assert server.received == ['oms.vm1.memory_usage 1.0 1\n', 'oms.vm1.memory_usage 2.0 2\n']
+            assert sink.spool._segments() == []
+            sink.disconnect()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_one_flush_pending_at_a_time(self):
+        server = StandInGraphiteServer()
+        port = server.server_address[1]
+        server.shutdown()
+        server.server_close()
+
+        scheduled = []
+        deferToThread = threads.deferToThread
+        threads.deferToThread = lambda f: scheduled.append(f) or defer.Deferred()
+        try:
+            sink = GraphiteSink(host='127.0.0.1', port=port, prefix='oms', flush_size=2,
+                                spool=MetricsSpool(self.spool_dir, 1024 * 1024))
+            for i in xrange(10):
+                sink.add('vm1', 'memory_usage', i * 1000, i)
+            assert len(scheduled) == 1
+
+            scheduled[0]()
+            assert len(sink.spool._segments()) == 1
+
+            # while the sink is down full batches are spilled to the spool, without scheduling flushes
+            for i in xrange(10, 14):
+                sink.add('vm1', 'memory_usage', i * 1000, i)
+            assert len(scheduled) == 1
+            assert len(sink.spool._segments()) == 3
+            assert sink._buffer == []
+        finally:
+            threads.deferToThread = deferToThread
+
+    def test_spool_is_bounded(self):
+        spool = MetricsSpool(self.spool_dir, 100)
+        for i in xrange(10):
+            spool.put('x' * 30)
+        assert len(spool._segments()) == 3
+
+    def test_influxdb(self):
+        server = StandInInfluxDBServer()
+        try:
+            sink = InfluxDBSink(host='127.0.0.1', port=server.server_address[1], prefix='', database='metrics',
+                                flush_size=1000, spool=MetricsSpool(self.spool_dir, 1024 * 1024))
+            sink.add('vm1', 'memory_usage', 1000, 1)
+            sink.flush_now()
+            sink.add('vm1', 'memory_usage', 2000, 2)
+            sink.flush_now()
+            assert server.requests == [('/write?db=metrics&precision=ms', 'memory_usage,series=vm1 value=1.0 1000\n'),
+                                       ('/write?db=metrics&precision=ms', 'memory_usage,series=vm1 value=2.0 2000\n')]
+            sink.disconnect()
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,257 @@
+import threading
+import unittest
+
+import netaddr
+import transaction
+import ZODB
+from ZODB.DemoStorage import DemoStorage
+
+from opennode.knot.model import network
+from opennode.knot.model.network import AddressRuns, IPv4Pool, IPv4Pools, IPv6Pool, IPv6Pools
+
+
+class AddressRunsTest(unittest.TestCase):
+
+    def test_runs(self):
+        runs = AddressRuns([1, 2, 3, 7])
+        assert dict(runs.runs.items()) == {1: 3, 7: 7}
+        assert len(runs) == 4
+
+        assert runs.add(5)
+        assert not runs.add(5)
+        assert runs.add(4)
+        assert runs.add(6)
+        assert dict(runs.runs.items()) == {1: 7}
+
+        assert runs.remove(4)
+        assert not runs.remove(4)
+        assert dict(runs.runs.items()) == {1: 3, 5: 7}
+        assert list(runs) == [1, 2, 3, 5, 6, 7]
+        assert len(runs) == 6
+
+        assert runs.first_free(0, 10) == 0
+        assert runs.first_free(1, 10) == 4
+        assert runs.first_free(5, 10) == 8
+        assert runs.first_free(5, 7) is None
+
+    def test_unmerged_runs(self):
+        runs = AddressRuns([1, 2, 3])
+        # as left by concurrent additions of 4 and 5
+        runs.runs[1] = 4
+        runs.runs[5] = 5
+        assert runs.first_free(1, 10) == 6
+        assert 5 in runs
+
+
+class IPv4PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        network._claimed.clear()
+
+    def test_allocate(self):
+        pool = IPv4Pool('pool', int(netaddr.IPAddress('10.0.0.1')), int(netaddr.IPAddress('10.0.0.4')))
+        assert pool.capacity == 4
+
+        assert pool.allocate() == netaddr.IPAddress('10.0.0.1')
+        pool.use(netaddr.IPAddress('10.0.0.2'))
+        assert pool.allocate() == netaddr.IPAddress('10.0.0.3')
+        # the maximum is never handed out
+        assert pool.allocate() is None
+        assert pool.allocated == 3
+
+        assert pool.get(netaddr.IPAddress('10.0.0.2')) == netaddr.IPAddress('10.0.0.2')
+        assert pool.get(netaddr.IPAddress('10.0.0.4')) is None
+        assert '10.0.0.3' in pool._items
+        assert [str(ip) for ip in pool._items.values()] == ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+
+        pool.free(netaddr.IPAddress('10.0.0.2'))
+        self.assertRaises(KeyError, pool.free, netaddr.IPAddress('10.0.0.2'))
+        assert pool.allocate() == netaddr.IPAddress('10.0.0.2')
+
+    def test_concurrent_allocate(self):
+        # the same pool as seen by two concurrent transactions
+        views = [IPv4Pool('pool', 1, 100) for i in xrange(2)]
+        assert views[0].allocate() == netaddr.IPAddress(1)
+        assert views[1].allocate() == netaddr.IPAddress(2)
+        views[0].free(netaddr.IPAddress(1))
+        assert views[1].allocate() == netaddr.IPAddress(1)
+
+    def test_reserve(self):
+        pool = IPv4Pool('pool', 1, 100)
+        pool.use(5)
+        pool.reserve(6)
+        assert list(pool.addresses) == [5, 6]
+        assert list(pool.reservations) == [6]
+        pool.free(6)
+        assert list(pool.reservations) == []
+
+    def test_legacy_items(self):
+        pool = IPv4Pool('pool', 1, 100)
+        del pool._addresses
+        pool.__dict__['_items'] = {5: None, 6: None}
+        assert pool.allocated == 2
+        assert '_items' not in pool.__dict__
+        assert pool.allocate() == netaddr.IPAddress(1)
+        assert dict(pool.addresses.runs.items()) == {1: 1, 5: 6}
+
+
+class ConcurrentAllocateTest(unittest.TestCase):
+    """Allocations of concurrent transactions, each in a thread of its own with its own connection"""
+
+    def setUp(self):
+        network._claimed.clear()
+        # unlike the default MappingStorage, DemoStorage resolves conflicts
+        self.db = ZODB.DB(DemoStorage())
+        connection = self.db.open()
+        connection.root()['pool'] = IPv4Pool('pool', 1, 100)
+        # created on first access, which would otherwise conflict
+        connection.root()['pool'].addresses
+        transaction.commit()
+        connection.close()
+
+    def tearDown(self):
+        self.db.close()
+
+    def allocate(self, results, allocated, commit):
+        connection = self.db.open()
+        try:
+            results.append(connection.root()['pool'].allocate())
+            allocated.set()
+            commit.wait()
+            transaction.commit()
+        finally:
+            transaction.abort()
+            connection.close()
+
+    def start(self, results, commit):
+        allocated = threading.Event()
+        thread = threading.Thread(target=self.allocate, args=(results, allocated, commit))
+        thread.start()
+        allocated.wait()
+        return thread
+
+    def used(self):
+        connection = self.db.open()
+        try:
+            return list(connection.root()['pool'].addresses)
+        finally:
+            connection.close()
+
+    def test_concurrent_commits(self):
+        results, commit = [], threading.Event()
+        first = self.start(results, commit)
+        second = self.start(results, commit)
+        assert network._claimed == set([(4, 1), (4, 2)])
+
+        commit.set()
+        first.join()
+        second.join()
+        assert results == [netaddr.IPAddress(1), netaddr.IPAddress(2)]
+        assert self.used() == [1, 2]
+        # the claims are dropped once committed
+        assert network._claimed == set()
+
+    def test_abort(self):
+        connection = self.db.open()
+        try:
+            assert connection.root()['pool'].allocate() == netaddr.IPAddress(1)
+            assert network._claimed == set([(4, 1)])
+            transaction.abort()
+            assert network._claimed == set()
+            assert connection.root()['pool'].allocate() == netaddr.IPAddress(1)
+        finally:
+            transaction.abort()
+            connection.close()
+        assert network._claimed == set()
+        assert self.used() == []
+
+    def test_allocate_after_commit(self):
+        committed, results, commit = threading.Event(), [], threading.Event()
+        committed.set()
+        self.start(results, committed).join()
+        assert network._claimed == set()
+
+        # a transaction started after the commit sees the IP as used
+        self.start(results, committed).join()
+        assert results == [netaddr.IPAddress(1), netaddr.IPAddress(2)]
+        assert self.used() == [1, 2]
+
+
+class IPv4PoolsTest(unittest.TestCase):
+
+    def setUp(self):
+        network._claimed.clear()
+
+    def test_find_pool(self):
+        pools = IPv4Pools()
+        for name, minimum, maximum in (('a', '10.0.0.1', '10.0.0.254'), ('b', '10.0.2.1', '10.0.2.254'),
+                                       ('c', '10.0.1.1', '10.0.1.254')):
+            pools.add(IPv4Pool(name, int(netaddr.IPAddress(minimum)), int(netaddr.IPAddress(maximum))))
+
+        assert pools.find_pool('10.0.1.10').name == 'c'
+        assert pools.find_pool('10.0.2.254').name == 'b'
+        assert pools.find_pool('10.0.0.255') is None
+        assert pools.find_pool('9.255.255.255') is None
+        assert pools.find_pool('10.0.3.1') is None
+
+        self.assertRaises(ValueError, pools.add, IPv4Pool('d', int(netaddr.IPAddress('10.0.1.200')),
+                                                          int(netaddr.IPAddress('10.0.2.10'))))
+        pools.add(IPv4Pool('d', int(netaddr.IPAddress('10.0.1.255')), int(netaddr.IPAddress('10.0.2.0'))))
+        assert pools.find_pool('10.0.2.0').name == 'd'
+
+        assert pools.allocate() == netaddr.IPAddress('10.0.0.1')
+        assert pools.free(netaddr.IPAddress('10.0.0.1'))
+        assert not pools.free(netaddr.IPAddress('10.0.0.1'))
+        assert not pools.free(netaddr.IPAddress('10.0.3.1'))
+
+
+class IPv6PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        network._claimed.clear()
+
+    def pool(self, mode):
+        network = netaddr.IPNetwork('2001:db8::/48')
+        return IPv6Pool('pool', int(network.network), int(network.broadcast), mode=mode)
+
+    def test_sequential(self):
+        pool = self.pool(u'sequential')
+        assert pool.prefixlen == 48
+        # 2001:db8:: is the Subnet-Router anycast address
+        assert pool.allocate() == netaddr.IPAddress('2001:db8::1')
+        assert pool.allocate() == netaddr.IPAddress('2001:db8::2')
+        pool.free(netaddr.IPAddress('2001:db8::1'))
+        assert pool.allocate() == netaddr.IPAddress('2001:db8::1')
+        assert pool.allocated == 2
+
+    def test_anycast_addresses_are_skipped(self):
+        pool = IPv6Pool('pool', int(netaddr.IPAddress('2001:db8::ffff:ffff:ffff:fffe')),
+                        int(netaddr.IPAddress('2001:db8:0:1::1')))
+        assert pool.allocate() == netaddr.IPAddress('2001:db8::ffff:ffff:ffff:fffe')
+        assert pool.allocate() == netaddr.IPAddress('2001:db8::ffff:ffff:ffff:ffff')
+        assert pool.allocate() == netaddr.IPAddress('2001:db8:0:1::1')
+        assert pool.allocate() is None
+
+    def test_eui64(self):
+        pool = self.pool(u'eui64')
+        assert pool.allocate('52:54:00:12:34:56') == netaddr.IPAddress('2001:db8::5054:ff:fe12:3456')
+        # taken, or no MAC address
+        assert pool.allocate('52:54:00:12:34:56') == netaddr.IPAddress('2001:db8::1')
+        assert pool.allocate() == netaddr.IPAddress('2001:db8::2')
+
+    def test_random(self):
+        pool = self.pool(u'random')
+        ips = set(pool.allocate() for i in xrange(10))
+        assert len(ips) == 10
+        assert all(ip in netaddr.IPNetwork('2001:db8::/48') for ip in ips)
+        assert pool.allocated == 10
+
+    def test_pools(self):
+        pools = IPv6Pools()
+        pools.add(self.pool(u'sequential'))
+        assert pools.find_pool('2001:db8:0:ffff::1').name == 'pool'
+        assert pools.find_pool('2001:db8:1::1') is None
+        assert pools.find_pool('10.0.0.1') is None
+        assert pools.allocate() == netaddr.IPAddress('2001:db8::1')
+        assert pools.free(netaddr.IPAddress('2001:db8::1'))
+        assert IPv4Pools().find_pool('2001:db8::1') is None
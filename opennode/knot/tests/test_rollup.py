@@ -0,0 +1,67 @@
+import unittest
+
+from opennode.knot.model.rollup import FleetRollups
+
+
+class FleetRollupsTest(unittest.TestCase):
+
+    def test_update(self):
+        rollups = FleetRollups()
+        groups = [('by-owner', 'john'), ('by-env', 'prod')]
+        rollups.update('vm1', groups, 'cpu_usage', 1.0, 1000)
+        rollups.update('vm2', [('by-owner', 'john')], 'cpu_usage', 3.0, 1000)
+        rollups.update('vm1', groups, 'cpu_usage', 2.0, 1000)
+
+        john = rollups.get('by-owner', 'john', 'cpu_usage')
+        assert (john.sum, john.count, john.max) == (5.0, 2, 3.0)
+        assert rollups.get('by-env', 'prod', 'cpu_usage').sum == 2.0
+        assert rollups.get('by-owner', 'jane', 'cpu_usage') is None
+
+    def test_regroup(self):
+        rollups = FleetRollups()
+        rollups.update('vm1', [('by-owner', 'john'), ('by-env', 'prod')], 'cpu_usage', 1.0, 1000)
+        rollups.update('vm2', [('by-owner', 'john')], 'cpu_usage', 3.0, 1000)
+
+        # unchanged groups keep the member
+        rollups.regroup('vm1', [('by-owner', 'john'), ('by-env', 'prod')])
+        assert rollups.get('by-owner', 'john', 'cpu_usage').count == 2
+
+        # e.g. an owner change
+        rollups.regroup('vm1', [('by-owner', 'jane'), ('by-env', 'prod')])
+        assert rollups.get('by-owner', 'john', 'cpu_usage').count == 1
+        assert rollups.get('by-env', 'prod', 'cpu_usage').count == 1
+
+    def test_empty_groups_are_removed(self):
+        rollups = FleetRollups()
+        rollups.update('vm1', [('by-owner', 'john'), ('by-env', 'prod')], 'cpu_usage', 1.0, 1000)
+        rollups.update('vm1', [('by-owner', 'john'), ('by-env', 'prod')], 'memory_usage', 1.0, 1000)
+        rollups.update('vm2', [('by-owner', 'john')], 'cpu_usage', 3.0, 1000)
+
+        rollups.regroup('vm1', [('by-owner', 'john')])
+        assert 'prod' not in rollups.roots['by-env'].groups
+
+        rollups.remove_member('vm1')
+        assert rollups.get('by-owner', 'john', 'memory_usage') is None
+        assert rollups.get('by-owner', 'john', 'cpu_usage').count == 1
+
+        rollups.remove_member('vm2')
+        assert rollups.roots['by-owner'].groups == {}
+
+    def test_expire(self):
+        rollups = FleetRollups()
+        rollups.update('vm1', [('by-owner', 'john')], 'cpu_usage', 1.0, 1000)
+        rollups.update('vm2', [('by-owner', 'john')], 'cpu_usage', 3.0, 1000)
+        rollups.update('vm2', [('by-owner', 'john')], 'memory_usage', 3.0, 1000)
+
+        # vm1 stops reporting, vm2 stops reporting its memory usage
+        rollups.update('vm2', [('by-owner', 'john')], 'cpu_usage', 2.0, 2000)
+        rollups.update('vm2', [('by-owner', 'john')], 'cpu_usage', 2.0, 3000)
+
+        assert rollups.expire(1000) == []
+        expired = rollups.expire(2500)
+        assert sorted(rollup.metric for rollup in expired) == [u'cpu_usage', u'memory_usage']
+
+        john = rollups.get('by-owner', 'john', 'cpu_usage')
+        assert (john.sum, john.count, john.max) == (2.0, 1, 2.0)
+        assert rollups.get('by-owner', 'john', 'memory_usage') is None
+        assert 'vm1' not in rollups._memberships
@@ -0,0 +1,40 @@
+import unittest
+
+from opennode.knot.model.template import GlobalTemplates
+
+
+class FakeNode(object):
+
+    def __init__(self, uid, parent=None, **kwargs):
+        self.__name__ = uid
+        self.__parent__ = parent
+        self.__dict__.update(kwargs)
+
+
+def fake_template(uid, name, host, backend=u'openvz'):
+    v12n_container = FakeNode('vms-%s' % backend, host, backend=backend)
+    return FakeNode(uid, FakeNode('templates', v12n_container), name=name)
+
+
+class GlobalTemplatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.templates = GlobalTemplates()
+        self.templates._collect = lambda: {}
+        self.templates.reindex()
+
+    def test_unindex_host(self):
+        host1, host2 = FakeNode('host1'), FakeNode('host2')
+        for template in (fake_template('t1', u'centos', host1), fake_template('t2', u'debian', host1),
+                         fake_template('t3', u'centos', host1, backend=u'kvm'),
+                         fake_template('t4', u'centos', host2)):
+            self.templates.index(template)
+
+        assert self.templates.names_on(host1, 'openvz') == set([u'centos', u'debian'])
+
+        self.templates.unindex_host('host1')
+        assert list(self.templates._index.keys()) == ['t4']
+        assert self.templates.names_on(host1, 'openvz') == set()
+        assert self.templates.names_on(host1, 'kvm') == set()
+        assert [t.__name__ for t in self.templates.by_name(u'centos')] == ['t4']
+        assert self.templates.names_on(host2, 'openvz') == set([u'centos'])
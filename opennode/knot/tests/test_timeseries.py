@@ -0,0 +1,46 @@
+import unittest
+
+from opennode.knot.utils.timeseries import DeltaEncoder, RunningAggregate, change_points, value_delta
+
+
+class TimeseriesTest(unittest.TestCase):
+
+    def test_value_delta(self):
+        assert value_delta(1.0, 1.5) == 0.5
+        assert value_delta((0.1, 0.5), (0.1, 0.25)) == 0.25
+        assert value_delta({u'root': 1.0}, {u'root': 3.0}) == 2.0
+        assert value_delta({u'root': 1.0}, {u'boot': 1.0}) is None
+        assert value_delta(u'a', u'a') == 0.0
+
+    def test_delta_encoder_skips_unchanged_values(self):
+        encoder = DeltaEncoder(epsilon=0.1, max_gap=10000)
+        stored = [t for t, v in [(1000, 5.0), (2000, 5.05), (3000, 5.0), (4000, 6.0), (5000, 6.0)]
+                  if encoder.accept(t, v)]
+        assert stored == [1000, 4000]
+        assert encoder.last_seen == 5000
+
+    def test_delta_encoder_heartbeat(self):
+        encoder = DeltaEncoder(epsilon=0.0, max_gap=3000)
+        stored = [t for t in xrange(0, 7000, 1000) if encoder.accept(t, 1.0)]
+        assert stored == [0, 3000, 6000]
+
+    def test_change_points(self):
+        events = [(1000, 5.0), (4000, 6.0), (9000, 7.0)]
+        assert change_points(events, after=1500) == events
+        assert change_points(events, after=4000) == [(4000, 6.0), (9000, 7.0)]
+        assert change_points(events, after=0, limit=2) == [(1000, 5.0), (4000, 6.0)]
+        assert change_points(events, after=10000) == [(9000, 7.0)]
+
+    def test_running_aggregate(self):
+        agg = RunningAggregate()
+        agg.update('a', 1.0)
+        agg.update('b', 3.0)
+        agg.update('c', 2.0)
+        assert (agg.sum, agg.count, agg.max) == (6.0, 3, 3.0)
+        agg.update('b', 0.5)
+        assert (agg.sum, agg.count, agg.max) == (3.5, 3, 2.0)
+        agg.remove('c')
+        assert (agg.sum, agg.count, agg.max, agg.avg) == (1.5, 2, 1.0, 0.75)
+        agg.remove('a')
+        agg.remove('b')
+        assert (agg.sum, agg.count, agg.max, agg.avg) == (0.0, 0, None, None)
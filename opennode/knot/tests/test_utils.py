@@ -1,5 +1,7 @@
 import unittest
 from opennode.knot.utils import mac_addr_kvm_generator
+from opennode.knot.utils.cidr import compile_tags
+from opennode.knot.utils.pinghistory import PingHistoryRegistry, RttBuffer
 
 
 class UtilsTest(unittest.TestCase):
@@ -9,3 +11,54 @@ class UtilsTest(unittest.TestCase):
         assert len(mac) == 17
         assert ':' in mac
         assert mac.startswith('52:54:00')
+
+    def test_ping_history(self):
+        registry = PingHistoryRegistry()
+        for i, delays in enumerate([[1.0, 2.0], [None, None], [None, 3.0], [None, None], [None, None]]):
+            history = registry.record('c1', i, delays, 3)
+
+        assert history.results() == [True, False, False]
+        assert history.flags() == (False, True, False)
+        assert history.to_list()[0] == {'timestamp': 2, 'result': True, 'rtt': [3.0], 'loss': 50.0}
+
+        registry.record('c1', 5, [None, None], 3)
+        assert history.flags() == (False, True, True)
+
+        registry.remove('c1')
+        assert registry.get('c1') is None
+
+    def test_rtt_buffer(self):
+        rtts = RttBuffer(4)
+        assert rtts.stats(4) is None
+
+        for rtt in [100.0, 1.0, None, 3.0, 2.0]:
+            rtts.add(rtt)
+        assert rtts.last(4)[2:] == [3.0, 2.0]
+
+        stats = rtts.stats(4)
+        assert stats['loss'] == 25.0
+        assert (stats['min'], stats['avg'], stats['max']) == (1.0, 2.0, 3.0)
+        assert abs(stats['mdev'] - (2.0 / 3) ** 0.5) < 1e-9
+        assert rtts.stats(2) == {'loss': 0.0, 'min': 2.0, 'avg': 2.5, 'max': 3.0, 'mdev': 0.5}
+
+        rtts.resize(2)
+        assert rtts.last(4) == [3.0, 2.0]
+        rtts.add(None)
+        assert rtts.stats(2)['loss'] == 50.0
+
+    def test_ping_history_windows(self):
+        registry = PingHistoryRegistry()
+        for delays in [[1.0, 3.0], [None, None], [2.0, 2.0]]:
+            history = registry.record('c1', 0, delays, 5, [(60, 2), (300, 6)])
+
+        assert history.summary() == ((2.0, 2.0, 2.0, 0.0), 0.0)
+        assert history.window_stats()[300]['loss'] == 100.0 / 3
+
+    def test_cidr_trie(self):
+        trie = compile_tags([('lan', '10.0.0.0/8, 192.168.1.0/24'), ('dmz', '10.1.0.0/16'),
+                             ('host', '10.1.2.3'), ('broken', 'not-a-network,'), ('v6', '2001:db8::/32')])
+        assert trie.match('10.1.2.3') == set(['lan', 'dmz', 'host'])
+        assert trie.match('10.2.0.1') == set(['lan'])
+        assert trie.match('192.168.1.200') == set(['lan'])
+        assert trie.match('192.168.2.1') == set()
+        assert trie.match('2001:db8::1') == set(['v6'])
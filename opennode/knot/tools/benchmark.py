@@ -0,0 +1,149 @@
+"""Times the hot model paths against a synthetic fleet.
+
+Usage: python -m opennode.knot.tools.benchmark [-H hypervisors] [-V vms] [-r repeat] [-o results.json]
+
+The fleet is generated into an in-memory database, or into the database configured for OMS with
+--persistent. The results are printed as JSON: the fleet size and, for every benchmark, the minimum, median
+and maximum wall time in milliseconds over the repetitions. Failed benchmarks are reported on stderr and
+make the exit status non-zero.
+
+"""
+import argparse
+import json
+import sys
+import time
+import traceback
+
+import netaddr
+import transaction
+from twisted.internet import defer, reactor
+from twisted.web.test.requesthelper import DummyRequest
+
+from opennode.oms.zodb import db
+
+
+def timed(fn, repeat):
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        fn()
+        times.append((time.time() - start) * 1000)
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2], 'max': times[-1], 'repeat': repeat}
+
+
+class AllowAll(object):
+    """Interaction of a principal allowed everything, so that permission checks stay in the measurement"""
+
+    def checkPermission(self, permission, obj):
+        return True
+
+
+def rest_listing(path, summary):
+    from opennode.oms.endpoint.httprest.base import IHttpRestView
+    from opennode.oms.model.traversal import traverse1
+
+    def render():
+        request = DummyRequest(path.strip('/').split('/'))
+        request.interaction = AllowAll()
+        if summary:
+            request.args['summary'] = ['1']
+        IHttpRestView(traverse1(path)).render_GET(request)
+    return render
+
+
+def benchmarks(oms_root):
+    """Returns the (name, function) pairs of the benchmarks, to be run in a transaction"""
+    from opennode.knot.backend.stats import UserComputeStatisticsAggregator
+
+    computes = oms_root['computes']
+    pools = list(oms_root['ippools'].listcontent())
+    usernames = list(oms_root['home'].listnames())[:20]
+    aggregator = UserComputeStatisticsAggregator()
+
+    def allocate():
+        pools[-1].allocate()
+        transaction.abort()
+
+    return [('Computes._items', lambda: len(computes._items)),
+            ('Computes._collect', lambda: len(computes._collect())),
+            ('GlobalTemplates._items', lambda: len(oms_root['templates']._items)),
+            ('OpenVZContainer._items', lambda: len(computes['openvz']._items)),
+            ('ComputeCatalog.query', lambda: computes.catalog.query(virtual=True, state=u'active')),
+            ('IPv4Pool.allocate', allocate),
+            ('UserComputeStatisticsAggregator.get_computes',
+             lambda: [aggregator.get_computes(username) for username in usernames]),
+            ('REST /computes', rest_listing('/computes', False)),
+            ('REST /computes?summary=1', rest_listing('/computes', True))]
+
+
+@defer.inlineCallbacks
+def run(args):
+    from opennode.knot.tools.fleet import populate
+
+    start = time.time()
+    counts = yield db.transact(lambda: populate(db.get_root()['oms_root'], args.hypervisors, args.vms,
+                                                network=args.network, seed=args.seed))()
+    results = {'fleet': counts, 'populate_seconds': time.time() - start, 'benchmarks': {}}
+
+    @db.ro_transact(proxy=False)
+    def run_benchmarks():
+        for name, fn in benchmarks(db.get_root()['oms_root']):
+            try:
+                results['benchmarks'][name] = timed(fn, args.repeat)
+            except Exception as e:
+                results['benchmarks'][name] = {'error': '%s: %s' % (type(e).__name__, e)}
+                traceback.print_exc()
+
+    yield run_benchmarks()
+    defer.returnValue(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-H', '--hypervisors', type=int, default=50)
+    parser.add_argument('-V', '--vms', type=int, default=100, help="VMs per hypervisor")
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-n', '--network', default='10.0.0.0/8', type=netaddr.IPNetwork)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help="Write the results to this file instead of stdout")
+    parser.add_argument('--persistent', action='store_true',
+                        help="Use the database configured for OMS instead of an in-memory one")
+    args = parser.parse_args(argv)
+
+    from opennode.oms.core import setup_environ
+    from opennode.oms.zodb.db import init
+    init(test=not args.persistent)
+    setup_environ(test=not args.persistent)
+
+    outcome = {}
+
+    def done(results):
+        outcome['results'] = results
+        reactor.stop()
+
+    def failed(failure):
+        outcome['failure'] = failure
+        reactor.stop()
+
+    reactor.callWhenRunning(lambda: run(args).addCallbacks(done, failed))
+    reactor.run()
+
+    if 'failure' in outcome:
+        outcome['failure'].printTraceback()
+        return 1
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(outcome['results'], output, indent=2, sort_keys=True)
+    output.write('\n')
+
+    results = outcome['results']['benchmarks']
+    failed = sorted(name for name, result in results.iteritems() if 'error' in result)
+    if failed:
+        sys.stderr.write('Failed benchmarks: %s\n' % ', '.join(failed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
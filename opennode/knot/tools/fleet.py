@@ -0,0 +1,105 @@
+"""Synthetic fleets of hypervisors and VMs, for reproducing production-size trees offline."""
+import random
+import uuid
+
+import netaddr
+
+from opennode.knot.model.compute import Compute, IDeployed, IUndeployed, IVirtualCompute
+from opennode.knot.model.network import IPv4Pool, NetworkInterface
+from opennode.knot.model.template import Template, Templates
+from opennode.knot.model.user import UserProfile
+from opennode.knot.model.virtualizationcontainer import VirtualizationContainer
+from opennode.oms.model.form import alsoProvides, noLongerProvides
+from opennode.oms.zodb import db
+
+
+STATES = (u'active', u'active', u'active', u'inactive', u'suspended')
+
+
+def mac_address(rnd):
+    return u'52:54:00:%02x:%02x:%02x' % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+
+
+def add_interface(compute, ip, prefixlen, rnd):
+    iface = NetworkInterface('eth0', None, mac_address(rnd), 'active')
+    iface.ipv4_address = u'%s/%s' % (ip, prefixlen)
+    iface.primary = True
+    compute.interfaces.add(iface)
+
+
+@db.assert_transact
+def populate(oms_root, hypervisors, vms, backends=(u'openvz', u'kvm'), templates=10, users=50,
+             network='10.0.0.0/8', pool_size=1024, seed=0):
+    """Adds `hypervisors` hypervisors with `vms` VMs each, spread over the `backends`, along with their
+    templates, the IP pools of `network` and the profiles of `users` VM owners. The same `seed` produces the
+    same fleet. Returns the number of created objects by kind."""
+    rnd = random.Random(seed)
+    network = netaddr.IPNetwork(network)
+    addresses = network.iter_hosts()
+    counts = dict.fromkeys(['hypervisors', 'vms', 'templates', 'ippools', 'users'], 0)
+
+    usernames = [u'user%04d' % i for i in xrange(users)]
+    for username in usernames:
+        if not oms_root['home'][username]:
+            oms_root['home'].add(UserProfile(username, [u'users'], credit=rnd.randint(0, 1000)))
+            counts['users'] += 1
+
+    used = []
+    for h in xrange(hypervisors):
+        ip = next(addresses)
+        used.append(ip)
+        hn = Compute(u'hn%05d.example.com' % h, u'active')
+        hn.__name__ = str(uuid.UUID(int=rnd.getrandbits(128)))
+        hn.num_cores = rnd.choice([8, 16, 32, 64])
+        hn.memory = hn.num_cores * 4096
+        hn.diskspace = {u'total': 4000.0, u'/': 100.0, u'/storage': 3900.0}
+        hn.diskspace_usage = {u'total': 1000.0, u'/': 20.0, u'/storage': 980.0}
+        oms_root['machines'].add(hn)
+        add_interface(hn, ip, network.prefixlen, rnd)
+        counts['hypervisors'] += 1
+
+        for backend in backends:
+            container = VirtualizationContainer(backend)
+            hn.add(container)
+            template_container = Templates()
+            template_container.__name__ = 'templates'
+            container.add(template_container)
+            for t in xrange(templates):
+                template_container.add(Template(u'%s-template-%02d' % (backend, t), backend))
+                counts['templates'] += 1
+
+        for v in xrange(vms):
+            backend = backends[v % len(backends)]
+            ip = next(addresses)
+            used.append(ip)
+            vm = Compute(u'vm%05d-%04d.example.com' % (h, v), rnd.choice(STATES),
+                         template=u'%s-template-%02d' % (backend, rnd.randrange(templates or 1)))
+            vm.__name__ = str(uuid.UUID(int=rnd.getrandbits(128)))
+            vm.num_cores = rnd.choice([1, 1, 2, 4])
+            vm.memory = vm.num_cores * 1024
+            vm.diskspace = {u'total': 20.0, u'/': 20.0}
+            if backend == u'openvz':
+                vm.ctid = 101 + h * vms + v
+            noLongerProvides(vm, IUndeployed)
+            alsoProvides(vm, IDeployed)
+            vm.__owner__ = rnd.choice(usernames) if usernames else None
+            hn['vms-%s' % backend].add(vm)
+            add_interface(vm, ip, network.prefixlen, rnd)
+            counts['vms'] += 1
+
+    first = int(network.network) + 1
+    for start in xrange(first, first + len(used), pool_size):
+        end = min(start + pool_size - 1, int(network.broadcast) - 1)
+        pool = IPv4Pool(u'pool-%s' % netaddr.IPAddress(start), start, end)
+        oms_root['ippools'].add(pool)
+        counts['ippools'] += 1
+    for ip in used:
+        oms_root['ippools'].find_pool(ip).use(ip)
+
+    computes = oms_root['computes']
+    computes.reindex()
+    all_computes = computes._collect().values()
+    computes.build_catalog()
+    computes.ctids.reseed([c for c in all_computes if IVirtualCompute.providedBy(c)])
+    oms_root['templates'].reindex()
+    return counts
@@ -0,0 +1,52 @@
+"""Longest-prefix style lookups of IP addresses in sets of tagged networks."""
+import netaddr
+
+
+# address width in bits by IP version
+WIDTHS = {4: 32, 6: 128}
+
+
+class CidrTrie(object):
+    """Binary trie of networks, one per IP version. `match` walks the bits of an address once and returns
+    the tags of all the networks containing it, instead of testing every network in turn."""
+
+    def __init__(self):
+        # IP version -> root node, a node is a [zero child, one child, tags] list
+        self.roots = {}
+
+    def add(self, cidr, tag):
+        network = netaddr.IPNetwork(cidr)
+        node = self.roots.setdefault(network.version, [None, None, set()])
+        value, width = int(network.network), WIDTHS[network.version]
+        for shift in xrange(width - 1, width - 1 - network.prefixlen, -1):
+            bit = (value >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, set()]
+            node = node[bit]
+        node[2].add(tag)
+
+    def match(self, ip):
+        ip = netaddr.IPAddress(ip)
+        node = self.roots.get(ip.version)
+        value, shift = int(ip), WIDTHS[ip.version]
+        res = set()
+        while node is not None:
+            res.update(node[2])
+            shift -= 1
+            if shift < 0:
+                break
+            node = node[(value >> shift) & 1]
+        return res
+
+
+def compile_tags(items):
+    """Builds a `CidrTrie` from (tag, comma separated networks) pairs, e.g. a config section. Incorrect
+    networks are ignored."""
+    trie = CidrTrie()
+    for tag, nets in items:
+        for net in nets.split(','):
+            try:
+                trie.add(net.strip(), tag)
+            except (ValueError, netaddr.AddrFormatError):
+                pass
+    return trie
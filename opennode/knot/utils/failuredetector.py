@@ -0,0 +1,98 @@
+"""Phi accrual failure detection (Hayashibara et al., "The phi accrual failure detector")."""
+import collections
+import math
+
+
+UNKNOWN = 'unknown'
+UP = 'up'
+SUSPECT = 'suspect'
+DOWN = 'down'
+
+# health states ordered from best to worst
+HEALTH_ORDER = (UNKNOWN, UP, SUSPECT, DOWN)
+
+
+def worst(*states):
+    return max(states, key=HEALTH_ORDER.index)
+
+
+def best(*states):
+    """Returns the best of the known states, or UNKNOWN if none is known"""
+    return min([state for state in states if state != UNKNOWN] or [UNKNOWN], key=HEALTH_ORDER.index)
+
+
+class PhiAccrualDetector(object):
+    """Suspicion level of a single monitored host, computed from the arrival times of its heartbeats.
+
+    The inter-arrival times of the latest `window_size` heartbeats are assumed to be normally distributed;
+    `phi` is -log10 of the probability that a heartbeat arrives later than now, so phi = 1 means a 10%
+    chance of a false suspicion, phi = 2 a 1% chance and so on. `min_std` avoids too sharp distributions
+    for very regular heartbeats and `acceptable_pause` tolerates an additional delay (both in seconds).
+    A host that was expected to send a first heartbeat (see `expect`) and never did is down once
+    `bootstrap_timeout` seconds have passed.
+
+    """
+
+    def __init__(self, window_size=100, min_std=0.5, acceptable_pause=0.0, first_interval=None):
+        self.intervals = collections.deque(maxlen=window_size)
+        self.min_std = min_std
+        self.acceptable_pause = acceptable_pause
+        self.first_interval = first_interval
+        self.last = None
+        self.expected_since = None
+
+    def expect(self, now):
+        """Records that a heartbeat was solicited at `now`, e.g. by dispatching a ping"""
+        if self.expected_since is None:
+            self.expected_since = now
+
+    def heartbeat(self, now):
+        if self.last is not None:
+            if now <= self.last:
+                return
+            self.intervals.append(now - self.last)
+        elif self.first_interval is not None:
+            # bootstrap the distribution, otherwise a host never heard of again can't be suspected
+            self.intervals.append(self.first_interval)
+        self.last = now
+
+    @property
+    def mean(self):
+        return sum(self.intervals) / len(self.intervals) if self.intervals else None
+
+    @property
+    def std(self):
+        if not self.intervals:
+            return None
+        mean = self.mean
+        variance = sum((i - mean) ** 2 for i in self.intervals) / len(self.intervals)
+        return max(math.sqrt(variance), self.min_std)
+
+    def phi(self, now):
+        """Returns the suspicion level at `now`, or None if not enough heartbeats were received"""
+        if self.last is None or not self.intervals:
+            return None
+
+        elapsed = now - self.last
+        y = (elapsed - self.mean - self.acceptable_pause) / self.std
+        y = min(max(y, -10.0), 10.0)
+        # logistic approximation of the cumulative normal distribution
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if elapsed > self.mean + self.acceptable_pause:
+            p_later = e / (1.0 + e)
+        else:
+            p_later = 1.0 - 1.0 / (1.0 + e)
+        return -math.log10(max(p_later, 1e-300))
+
+    def health(self, now, suspect_threshold, down_threshold, bootstrap_timeout=None):
+        phi = self.phi(now)
+        if phi is None:
+            if (self.last is None and self.expected_since is not None and bootstrap_timeout is not None
+                    and now - self.expected_since >= bootstrap_timeout):
+                return DOWN
+            return UNKNOWN
+        if phi >= down_threshold:
+            return DOWN
+        if phi >= suspect_threshold:
+            return SUSPECT
+        return UP
@@ -1,8 +1,22 @@
+import errno
+import itertools
+import os
 import socket
+import struct
 import subprocess
+import time
 
 from ping import do_one
+from twisted.internet import defer, reactor
+from twisted.internet.interfaces import IReadDescriptor
 from twisted.python import log
+from zope.interface import implements
+
+from opennode.knot.backend.subprocess import async_check_output
+
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
 
 
 def ping(dest_addr, timeout=2, count=2, psize=64):
@@ -33,3 +47,207 @@ def ping(dest_addr, timeout=2, count=2, psize=64):
             return not subprocess.call('fping -q %s' % dest_addr, shell=True)
         except:
             return True
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += '\0'
+    s = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+    return ~s & 0xffff
+
+
+def echo_request(ident, seq, psize):
+    payload = struct.pack('!d', time.time()).ljust(max(psize - 8, 8), 'Q')
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum(header + payload), ident, seq) + payload
+
+
+class AsyncPinger(object):
+    """Sends ICMP echo requests to any number of hosts over a single socket read by the reactor.
+
+    A raw ICMP socket is used when permitted, otherwise an unprivileged ICMP datagram socket (see the
+    `net.ipv4.ping_group_range` sysctl on Linux). Replies are matched to requests by the identifier and
+    sequence number; with datagram sockets the kernel rewrites the identifier, so the source address is
+    checked instead.
+
+    """
+    implements(IReadDescriptor)
+
+    def __init__(self):
+        self._socket = None
+        self._raw = None
+        self._ident = os.getpid() & 0xffff
+        self._seq = itertools.count()
+        # seq -> (address, sent time, deferred, timeout call)
+        self._pending = {}
+
+    def open(self):
+        if self._socket is not None:
+            return
+
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self._raw = True
+        except socket.error:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self._raw = False
+
+        sock.setblocking(0)
+        self._socket = sock
+        reactor.addReader(self)
+
+    def fileno(self):
+        return self._socket.fileno() if self._socket is not None else -1
+
+    def logPrefix(self):
+        return 'ping'
+
+    def doRead(self):
+        while True:
+            try:
+                data, (address, port) = self._socket.recvfrom(2048)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    log.msg('Error receiving ICMP reply: %s' % e, system='ping')
+                return
+            self._received(data, address)
+
+    def connectionLost(self, reason):
+        self.close()
+
+    def close(self):
+        if self._socket is not None:
+            reactor.removeReader(self)
+            self._socket.close()
+            self._socket = None
+
+        pending, self._pending = self._pending, {}
+        for address, sent, d, timeout in pending.itervalues():
+            timeout.cancel()
+            d.callback(None)
+
+    def _received(self, data, address):
+        if self._raw:
+            data = data[(ord(data[0]) & 0x0f) * 4:]
+        if len(data) < 8:
+            return
+
+        icmp_type, code, csum, ident, seq = struct.unpack('!BBHHH', data[:8])
+        if icmp_type != ICMP_ECHO_REPLY or (self._raw and ident != self._ident):
+            return
+
+        pending = self._pending.get(seq)
+        if pending is None or pending[0] != address:
+            return
+
+        del self._pending[seq]
+        address, sent, d, timeout = pending
+        timeout.cancel()
+        d.callback((time.time() - sent) * 1000)
+
+    def _timeout(self, seq):
+        address, sent, d, timeout = self._pending.pop(seq)
+        d.callback(None)
+
+    def _next_seq(self):
+        for i in xrange(0x10000):
+            seq = self._seq.next() & 0xffff
+            if seq not in self._pending:
+                return seq
+        raise RuntimeError('Too many pending ICMP echo requests')
+
+    def echo(self, address, timeout=2, psize=64):
+        """Sends one echo request to an IP `address`. Returns a deferred firing with the round trip time in
+        ms, or with None if no reply arrived within `timeout` seconds."""
+        self.open()
+
+        seq = self._next_seq()
+        try:
+            self._socket.sendto(echo_request(self._ident, seq, psize), (address, 0))
+        except socket.error as e:
+            log.msg("ping %s failed. (socket error: '%s')" % (address, e), system='ping')
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self._pending[seq] = (address, time.time(), d, reactor.callLater(timeout, self._timeout, seq))
+        return d
+
+    @defer.inlineCallbacks
+    def ping(self, host, timeout=2, count=2, psize=64):
+        """Sends `count` echo requests to `host` at once. Returns a deferred firing with the list of round
+        trip times in ms, with None for the lost packets."""
+        try:
+            address = yield reactor.resolve(host)
+        except Exception as e:
+            log.msg("ping %s failed. (resolve error: '%s')" % (host, e), system='ping')
+            defer.returnValue([None] * count)
+
+        results = yield defer.gatherResults([self.echo(address, timeout, psize) for i in xrange(count)])
+        defer.returnValue(results)
+
+
+pinger = AsyncPinger()
+
+
+def parse_fping(output, hosts):
+    """Parses the per-target summary printed by `fping -C`, e.g. `host : 0.10 - 0.12`. Returns a dict of
+    host -> list of round trip times in ms, with None for the lost packets. Hosts missing from the output
+    (e.g. unresolvable ones) are omitted."""
+    res = {}
+    hosts = set(hosts)
+    for line in output.splitlines():
+        host, sep, samples = line.partition(' : ')
+        host = host.strip()
+        if not sep or host not in hosts:
+            continue
+        try:
+            res[host] = [None if sample == '-' else float(sample) for sample in samples.split()]
+        except ValueError:
+            continue
+    return res
+
+
+@defer.inlineCallbacks
+def fping(hosts, timeout=2, count=2, chunk_size=256):
+    """Pings all `hosts` with batched `fping` invocations, which doesn't require root privileges. Returns
+    a deferred firing with a dict of host -> list of `count` round trip times in ms, with None for the lost
+    packets."""
+    hosts = list(hosts)
+    chunks = [hosts[i:i + chunk_size] for i in xrange(0, len(hosts), chunk_size)]
+    # fping exits with 1 if some hosts are unreachable and with 2 if some addresses are not found
+    outputs = yield defer.gatherResults([async_check_output(['fping', '-q', '-C', count, '-t', int(timeout * 1000)]
+                                                            + chunk, stderr=True, exit_codes=(0, 1, 2))
+                                         for chunk in chunks])
+
+    res = dict((host, [None] * count) for host in hosts)
+    for chunk, (out, err) in zip(chunks, outputs):
+        res.update(parse_fping(err, chunk))
+    defer.returnValue(res)
+
+
+@defer.inlineCallbacks
+def async_ping_many(hosts, timeout=2, count=2, psize=64):
+    """Pings all `hosts` concurrently. Returns a deferred firing with a dict of host -> list of `count` round
+    trip times in ms, with None for the lost packets.
+
+    When no ICMP socket can be opened, the whole batch is pinged with `fping`.
+
+    """
+    try:
+        pinger.open()
+    except socket.error as e:
+        log.msg("Cannot open ICMP socket (%s), falling back to fping" % e, system='ping')
+        res = yield fping(hosts, timeout, count)
+        defer.returnValue(res)
+
+    hosts = list(hosts)
+    results = yield defer.gatherResults([pinger.ping(host, timeout, count, psize) for host in hosts])
+    defer.returnValue(dict(zip(hosts, results)))
+
+
+def async_ping(host, timeout=2, count=2, psize=64):
+    """Pings `host` without blocking the reactor. Returns a deferred firing with the list of `count` round
+    trip times in ms, with None for the lost packets."""
+    return async_ping_many([host], timeout, count, psize).addCallback(lambda res: res[host])
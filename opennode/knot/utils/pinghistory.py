@@ -0,0 +1,146 @@
+"""In-memory ping history of the computes."""
+import collections
+import math
+import threading
+
+from array import array
+
+
+NAN = float('nan')
+
+
+class RttBuffer(object):
+    """Fixed-size ring buffer of round trip times in ms. Lost packets are stored as NaN."""
+
+    def __init__(self, size):
+        self.values = array('d', [NAN] * size)
+        self.pos = 0
+        self.filled = 0
+
+    @property
+    def size(self):
+        return len(self.values)
+
+    def resize(self, size):
+        if size != self.size:
+            last = self.last(size)
+            self.values = array('d', last + [NAN] * (size - len(last)))
+            self.pos = len(last) % size
+            self.filled = len(last)
+
+    def add(self, rtt):
+        self.values[self.pos] = NAN if rtt is None else rtt
+        self.pos = (self.pos + 1) % self.size
+        self.filled = min(self.filled + 1, self.size)
+
+    def last(self, n):
+        """Returns the latest `n` stored values, oldest first"""
+        n = min(n, self.filled)
+        if n <= self.pos:
+            return self.values[self.pos - n:self.pos].tolist()
+        return self.values[self.size - (n - self.pos):].tolist() + self.values[:self.pos].tolist()
+
+    def stats(self, n):
+        """Returns min, avg, max and mdev round trip time and loss percentage over the latest `n` packets"""
+        values = self.last(n)
+        if not values:
+            return None
+
+        received = [v for v in values if v == v]
+        res = {'loss': 100.0 * (len(values) - len(received)) / len(values),
+               'min': None, 'avg': None, 'max': None, 'mdev': None}
+        if received:
+            avg = sum(received) / len(received)
+            res.update({'min': min(received), 'avg': avg, 'max': max(received),
+                        'mdev': math.sqrt(max(sum(v * v for v in received) / len(received) - avg * avg, 0.0))})
+        return res
+
+
+class PingHistory(object):
+    """Ring buffer of the latest ping samples of a single compute.
+
+    A sample is a (timestamp, delays) pair where `delays` lists the round trip times in ms of the echo
+    requests sent in one check, with None for the lost ones. The round trip times of the individual packets
+    are also kept in a larger `RttBuffer`, for the statistics over the sliding `windows`, a list of
+    (name, number of packets) pairs.
+
+    """
+
+    def __init__(self, size, windows=()):
+        self.samples = collections.deque(maxlen=size)
+        self.windows = list(windows)
+        self.rtts = RttBuffer(max([packets for name, packets in self.windows] or [1]))
+
+    @property
+    def size(self):
+        return self.samples.maxlen
+
+    def resize(self, size, windows=()):
+        if size != self.samples.maxlen:
+            self.samples = collections.deque(self.samples, maxlen=size)
+        self.windows = list(windows)
+        self.rtts.resize(max([packets for name, packets in self.windows] or [1]))
+
+    def add(self, timestamp, delays):
+        self.samples.append((timestamp, list(delays)))
+        for delay in delays:
+            self.rtts.add(delay)
+
+    def results(self, last=None):
+        """Returns whether the host answered, for the `last` samples, oldest first"""
+        samples = list(self.samples)[-last:] if last else self.samples
+        return [any(delay is not None for delay in delays) for timestamp, delays in samples]
+
+    def flags(self, last=3):
+        """Returns the (last_ping, suspicious, failure) availability flags"""
+        results = self.results(last)
+        return (bool(results) and results[-1], not all(results), not any(results))
+
+    def window_stats(self):
+        """Returns the round trip time and loss statistics of every window"""
+        return dict((name, self.rtts.stats(packets)) for name, packets in self.windows)
+
+    def summary(self):
+        """Returns the (min, avg, max, mdev) round trip time and the loss percentage over the shortest
+        window, the round trip time is None if all packets were lost"""
+        if not self.windows:
+            return None, None
+        stats = self.rtts.stats(min(packets for name, packets in self.windows))
+        if stats is None:
+            return None, None
+        rtt = (stats['min'], stats['avg'], stats['max'], stats['mdev']) if stats['avg'] is not None else None
+        return rtt, stats['loss']
+
+    def to_list(self):
+        return [{'timestamp': timestamp,
+                 'result': any(delay is not None for delay in delays),
+                 'rtt': [delay for delay in delays if delay is not None],
+                 'loss': 100.0 * delays.count(None) / len(delays) if delays else 100.0}
+                for timestamp, delays in self.samples]
+
+
+class PingHistoryRegistry(object):
+    """Ping histories of all computes, keyed by the compute name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histories = {}
+
+    def get(self, key):
+        return self._histories.get(key)
+
+    def record(self, key, timestamp, delays, size, windows=()):
+        with self._lock:
+            history = self._histories.get(key)
+            if history is None:
+                history = self._histories[key] = PingHistory(size, windows)
+            history.resize(size, windows)
+            history.add(timestamp, delays)
+            return history
+
+    def remove(self, key):
+        with self._lock:
+            self._histories.pop(key, None)
+
+
+ping_history = PingHistoryRegistry()
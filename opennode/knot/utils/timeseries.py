@@ -0,0 +1,112 @@
+"""Helpers for compact storage of metric time series."""
+
+
+def value_delta(old, new):
+    """Returns the largest absolute difference between two metric values.
+
+    Metric values may be numbers, tuples/lists of numbers (e.g. cpu load) or dicts of numbers (e.g. disk
+    usage per partition). Returns `None` if the values are not comparable, which means they always differ.
+
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        if set(old) != set(new):
+            return None
+        return max([0.0] + [value_delta(old[k], new[k]) for k in old]) if old else 0.0
+
+    if isinstance(old, (tuple, list)) and isinstance(new, (tuple, list)):
+        if len(old) != len(new):
+            return None
+        deltas = [value_delta(o, n) for o, n in zip(old, new)]
+        if None in deltas:
+            return None
+        return max([0.0] + deltas)
+
+    try:
+        return abs(float(new) - float(old))
+    except (TypeError, ValueError):
+        return 0.0 if old == new else None
+
+
+class DeltaEncoder(object):
+    """Change-only encoding of a single metric series.
+
+    A data point is stored only if its value differs from the last stored one by more than `epsilon`, or if
+    `max_gap` milliseconds have passed since the last stored point (heartbeat). Timestamps are in ms.
+
+    """
+
+    def __init__(self, epsilon=0.0, max_gap=None):
+        self.epsilon = epsilon
+        self.max_gap = max_gap
+        self.last = None
+        self.last_seen = None
+
+    def accept(self, timestamp, value):
+        """Returns True if the data point has to be stored."""
+        self.last_seen = timestamp
+
+        if self.last is not None:
+            last_timestamp, last_value = self.last
+            delta = value_delta(last_value, value)
+            if (delta is not None and delta <= self.epsilon and
+                    (self.max_gap is None or timestamp - last_timestamp < self.max_gap)):
+                return False
+
+        self.last = (timestamp, value)
+        return True
+
+
+def change_points(events, after=0, limit=None):
+    """Returns the points of a change-only encoded series which are in effect after `after`.
+
+    `events` is a sorted list of stored (timestamp, value) points. The result starts with the last point
+    stored at or before `after`, which holds the value at the beginning of the range, followed by the points
+    stored after `after`. Timestamps are the real ones of the stored points: a value holds until the next
+    point, so the series is not expanded to the sampling interval.
+
+    """
+    start = [e for e in events if e[0] <= after][-1:]
+    res = start + [e for e in events if e[0] > after]
+    return res[:limit] if limit is not None else res
+
+
+class RunningAggregate(object):
+    """Incrementally maintained sum, count and maximum over the latest values of a set of members."""
+
+    def __init__(self):
+        self.members = {}
+        self.sum = 0.0
+        self.max = None
+        self._max_member = None
+
+    @property
+    def count(self):
+        return len(self.members)
+
+    @property
+    def avg(self):
+        return self.sum / len(self.members) if self.members else None
+
+    def update(self, member, value):
+        self.sum += value - self.members.get(member, 0.0)
+        self.members[member] = value
+
+        if self.max is None or value >= self.max:
+            self.max = value
+            self._max_member = member
+        elif member == self._max_member:
+            self._recompute_max()
+
+    def remove(self, member):
+        if member not in self.members:
+            return
+        self.sum -= self.members.pop(member)
+        if member == self._max_member:
+            self._recompute_max()
+
+    def _recompute_max(self):
+        if not self.members:
+            self.max = self._max_member = None
+            self.sum = 0.0
+            return
+        self._max_member, self.max = max(self.members.iteritems(), key=lambda (m, v): v)